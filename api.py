@@ -1,14 +1,22 @@
 import sys
+import json
+import asyncio
 import uvicorn
-from fastapi import FastAPI, HTTPException
+import uuid
+from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from pydantic import BaseModel, ValidationError
 from typing import Optional, List, Any, Dict
+from datetime import datetime
 
 import os
 import splade_encoder
 import local_db
+import embedding_cache
 import watch
+from search_service import search_service, SearchOverloaded, SearchSuperseded
+from name_index import name_index
 import parsers
 from path_env import HOME_DIRECTORY
 
@@ -18,25 +26,47 @@ WATCH_INTERVAL = int(os.getenv("WATCH_INTERVAL", "10"))  # Default to 10s for re
 
 app = FastAPI(title="Local Semantic Search API")
 
+def _warm_up():
+    # Open the index and load + warm up the model off the startup path, so the port is up immediately
+    try:
+        local_db.ensure_initialized()
+        splade_encoder.warm_up()
+        print("Search backend ready.")
+    except Exception as e:
+        print(f"Error warming up search backend: {e}", file=sys.stderr)
+
 @app.on_event("startup")
 def startup_event():
+    import threading
+    threading.Thread(target=_warm_up, daemon=True).start()
     # Start the watcher in-process
     watch.start_watcher(WATCH_DIR, WATCH_INTERVAL)
     # Lazy load spelling vocabulary into SymSpell in a background thread to keep startup instant
-    import threading
     from spelling_service import spelling_service
     threading.Thread(target=spelling_service.load_if_needed, daemon=True).start()
+    # Build the in-memory filename index from the manifest in the background as well
+    threading.Thread(target=name_index.load_if_needed, daemon=True).start()
 
 @app.on_event("shutdown")
 def shutdown_event():
     # Stop the watcher cleanly
     watch.stop_watcher()
-    # Close Qdrant client cleanly to flush all writes to disk
-    try:
-        local_db.client.close()
-        print("Qdrant client closed cleanly.")
-    except Exception as e:
-        print(f"Error closing Qdrant client: {e}", file=sys.stderr)
+    # Persist pending click statistics
+    from personalization import personalization_store
+    personalization_store.flush()
+    # Apply queued vocabulary updates
+    import spelling_db
+    spelling_db.flush_vocabulary()
+    # Write buffered points of the native sparse index out as a segment
+    if local_db.native_index is not None:
+        local_db.native_index.flush()
+    # Close Qdrant client cleanly to flush all writes to disk (if it was ever opened)
+    if local_db.client.is_open:
+        try:
+            local_db.client.close()
+            print("Qdrant client closed cleanly.")
+        except Exception as e:
+            print(f"Error closing Qdrant client: {e}", file=sys.stderr)
 
 # Enable CORS so the Electron app can query this API from the frontend
 # Note: allowing credentials with wildcard origin is a security risk.
@@ -50,40 +80,146 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+class SearchFilters(BaseModel):
+    file_types: Optional[List[str]] = None
+    path_prefix: Optional[str] = None
+    min_size: Optional[int] = None
+    max_size: Optional[int] = None
+    modified_after: Optional[datetime] = None
+    modified_before: Optional[datetime] = None
+    created_after: Optional[datetime] = None
+    created_before: Optional[datetime] = None
+
+    def to_db_filters(self) -> Dict[str, Any]:
+        """Filter dict for local_db.search_documents, with dates as epoch seconds."""
+        filters = self.model_dump(exclude_none=True)
+        for key, value in filters.items():
+            if isinstance(value, datetime):
+                filters[key] = value.timestamp()
+        return filters
+
 class SearchQuery(BaseModel):
     query: str
     limit: Optional[int] = 20
+    filters: Optional[SearchFilters] = None
+    # Search-as-you-type: a query with a higher seq in the same session supersedes older ones
+    session_id: Optional[str] = None
+    seq: Optional[int] = None
 
 class ClickLog(BaseModel):
     path: str
 
+# Returned by the search endpoints while the database is still being opened in the background
+_STARTING_DETAIL = "Search is starting, retry shortly."
+
+async def _name_results(request: SearchQuery, filters: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """Filename matches only, marked partial: what /ws/search sends first, for HTTP clients."""
+    results = await run_in_threadpool(search_service.search_names, request.query, request.limit, filters)
+    return {"results": results, "corrected_query": request.query, "partial": True}
+
 @app.post("/search")
 async def search(request: SearchQuery):
+    """
+    Full search (filename matches merged with SPLADE results). While the model is being loaded,
+    or when the search pool is saturated, filename matches are returned right away instead,
+    with "partial": true, so HTTP clients get the same instant results the WebSocket sends first.
+    """
     if not request.query.strip():
         return {"results": [], "corrected_query": request.query}
+    if not local_db.is_ready():
+        # Answer right away instead of holding the request until initialization finishes
+        raise HTTPException(status_code=503, detail=_STARTING_DETAIL, headers={"Retry-After": "1"})
     
+    filters = request.filters.to_db_filters() if request.filters else None
+    if splade_encoder.is_loading():
+        return await _name_results(request, filters)
     try:
-        # Correct spelling typos in the query using spelling_service
-        from spelling_service import spelling_service
-        corrected_query = spelling_service.correct_query(request.query)
-        
-        # Generate SPLADE sparse vector representation of query
-        sparse_query = splade_encoder.encode(corrected_query)
-        
-        # Search Qdrant and apply personalized re-ranking
-        results = local_db.search_documents(sparse_query, limit=request.limit)
-        return {"results": results, "corrected_query": corrected_query}
+        # Spelling correction, query encoding and retrieval run on the inference pool
+        return await search_service.search(request.query, request.limit, filters, request.session_id, request.seq)
+    except SearchSuperseded:
+        return {"results": [], "corrected_query": request.query, "superseded": True}
+    except SearchOverloaded:
+        return await _name_results(request, filters)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail="Search timed out.")
     except Exception as e:
         print(f"Error executing search query: {e}", file=sys.stderr)
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.websocket("/ws/search")
+async def search_socket(websocket: WebSocket):
+    """
+    Persistent search-as-you-type channel. Each message is a SearchQuery; the connection is its own session,
+    so a newer message supersedes the queries still in flight and only the newest one's results are sent,
+    tagged with its seq. Filename matches are sent first as a "partial" message when there are any.
+    """
+    await websocket.accept()
+    session_id = uuid.uuid4().hex
+    latest = {"seq": -1}
+    tasks = set()
+
+    async def respond(request: SearchQuery, seq: int):
+        if not request.query.strip():
+            response = {"results": [], "corrected_query": request.query}
+        elif not local_db.is_ready():
+            response = {"error": _STARTING_DETAIL, "status": "starting"}
+        else:
+            filters = request.filters.to_db_filters() if request.filters else None
+            # Filename matches need no inference: send them right away, then the merged results.
+            # They still read payloads from the collection, which can wait on a write, so not on the event loop
+            name_results = await run_in_threadpool(search_service.search_names, request.query, request.limit, filters)
+            if name_results and seq == latest["seq"]:
+                try:
+                    await websocket.send_json({"seq": seq, "results": name_results, "partial": True})
+                except Exception:
+                    return
+            try:
+                response = await search_service.search(request.query, request.limit, filters, session_id, seq)
+            except SearchSuperseded:
+                return
+            except SearchOverloaded as e:
+                response = {"error": f"Search is overloaded: {e}"}
+            except asyncio.TimeoutError:
+                response = {"error": "Search timed out."}
+            except Exception as e:
+                print(f"Error executing search query: {e}", file=sys.stderr)
+                response = {"error": str(e)}
+        if seq != latest["seq"]:
+            return
+        try:
+            await websocket.send_json({"seq": seq, **response})
+        except Exception:
+            pass  # Client went away mid-search
+
+    try:
+        while True:
+            text = await websocket.receive_text()
+            data = None
+            try:
+                data = json.loads(text)
+                request = SearchQuery(**data)
+            except (json.JSONDecodeError, TypeError, ValidationError) as e:
+                # A malformed message gets an error reply; the session and its in-flight searches stay up
+                await websocket.send_json({"seq": data.get("seq") if isinstance(data, dict) else None, "error": str(e)})
+                continue
+            seq = request.seq if request.seq is not None else latest["seq"] + 1
+            latest["seq"] = max(latest["seq"], seq)
+            task = asyncio.create_task(respond(request, seq))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        for task in tasks:
+            task.cancel()
+
 @app.post("/click")
 async def log_click(request: ClickLog):
     if not request.path.strip():
         raise HTTPException(status_code=400, detail="Path cannot be empty.")
     
     try:
-        # Increment open count and update last_opened_at in Qdrant
+        # Increment open count and update last_opened_at in the personalization store
         local_db.log_click(request.path)
         return {"status": "success"}
     except Exception as e:
@@ -92,19 +228,39 @@ async def log_click(request: ClickLog):
 
 @app.get("/status")
 async def status():
+    from spelling_service import spelling_service
+    import spelling_db
+    readiness = {
+        "database": local_db.is_ready(),
+        "model": splade_encoder.is_loaded(),
+        "model_warm": splade_encoder.is_warm(),
+        "spelling": spelling_service.stats()["loaded"],
+        "name_index": name_index.stats()["loaded"],
+    }
+    if not (readiness["database"] and readiness["model"]):
+        # Don't block on initialization that is still running in the background
+        return {"status": "starting", "ready": False, "readiness": readiness}
     try:
         info = local_db.client.get_collection(local_db.COLLECTION_NAME)
         return {
             "status": "healthy",
+            "ready": True,
+            "readiness": readiness,
             "collection": local_db.COLLECTION_NAME,
             "points_count": info.points_count,
-            "indexed_vectors": info.indexed_vectors_count
+            "indexed_vectors": info.indexed_vectors_count,
+            "embedding_cache": embedding_cache.get_cache().stats(),
+            "search": search_service.stats(),
+            "inference": splade_encoder.scheduler_stats(),
+            "name_index": name_index.stats(),
+            "vocabulary_writer": spelling_db.vocabulary_writer.stats(),
+            "spelling": spelling_service.stats(),
+            "search_engine": local_db.SEARCH_ENGINE,
+            **({"native_index": local_db.native_index.stats()} if local_db.native_index is not None else {})
         }
     except Exception as e:
         return {"status": "error", "detail": str(e)}
 
-from fastapi.concurrency import run_in_threadpool
-
 @app.get("/content")
 async def get_document_content(path: str):
     if not path.strip():
@@ -0,0 +1,213 @@
+import os
+import sqlite3
+import hashlib
+import threading
+import time
+from typing import Dict, List, Optional
+
+import numpy as np
+
+import splade_encoder
+from path_env import DB_DIR
+
+CACHE_PATH = os.path.join(DB_DIR, "embedding_cache.sqlite")
+# Maximum number of cached chunk vectors (each is at most top_k=150 weights, ~1.2 KB)
+MAX_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", "500000"))
+
+
+class EmbeddingCache:
+    """
+    Persistent SQLite cache mapping (model, encode settings, chunk text) to a SPLADE sparse vector.
+    Entries carry a last-used timestamp and the least recently used ones are evicted
+    once the cache grows past max_entries.
+    """
+
+    def __init__(self, path: str = CACHE_PATH, max_entries: int = MAX_ENTRIES, model_id: str = splade_encoder.MODEL_ID):
+        self.max_entries = max_entries
+        self.model_id = model_id
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL;")
+        self._conn.execute("PRAGMA synchronous=NORMAL;")
+        with self._conn:
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS embeddings (
+                    key BLOB PRIMARY KEY,
+                    indices BLOB,
+                    weights BLOB,
+                    last_used INTEGER
+                )
+            """)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_embeddings_last_used ON embeddings(last_used)")
+        self._count = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def key(self, text: str, threshold: float, top_k: int) -> bytes:
+        h = hashlib.blake2b(digest_size=20)
+        h.update(f"{self.model_id}\0{threshold}\0{top_k}\0".encode())
+        h.update(text.encode("utf-8", errors="surrogatepass"))
+        return h.digest()
+
+    def get_many(self, keys: List[bytes]) -> Dict[bytes, Dict[int, float]]:
+        """Returns the cached vectors for the keys found and marks them as recently used."""
+        found: Dict[bytes, Dict[int, float]] = {}
+        unique_keys = list(dict.fromkeys(keys))
+        with self._lock:
+            # Stay well below SQLite's bound-parameter limit
+            for i in range(0, len(unique_keys), 500):
+                batch = unique_keys[i:i + 500]
+                rows = self._conn.execute(
+                    f"SELECT key, indices, weights FROM embeddings WHERE key IN ({','.join('?' * len(batch))})",
+                    batch,
+                ).fetchall()
+                for key, indices, weights in rows:
+                    found[key] = dict(zip(
+                        np.frombuffer(indices, dtype=np.int32).tolist(),
+                        np.frombuffer(weights, dtype=np.float32).tolist(),
+                    ))
+            if found:
+                now = time.time_ns()
+                with self._conn:
+                    self._conn.executemany(
+                        "UPDATE embeddings SET last_used = ? WHERE key = ?",
+                        [(now, k) for k in found],
+                    )
+            self.hits += sum(1 for k in keys if k in found)
+            self.misses += sum(1 for k in keys if k not in found)
+        return found
+
+    def put_many(self, entries: Dict[bytes, Dict[int, float]]):
+        if not entries:
+            return
+        now = time.time_ns()
+        rows = [
+            (
+                key,
+                np.fromiter(vec.keys(), dtype=np.int32, count=len(vec)).tobytes(),
+                np.fromiter(vec.values(), dtype=np.float32, count=len(vec)).tobytes(),
+                now,
+            )
+            for key, vec in entries.items()
+        ]
+        with self._lock:
+            with self._conn:
+                before = self._conn.total_changes
+                self._conn.executemany(
+                    "INSERT OR IGNORE INTO embeddings (key, indices, weights, last_used) VALUES (?, ?, ?, ?)",
+                    rows,
+                )
+                self._count += self._conn.total_changes - before
+                if self._count > self.max_entries:
+                    self._evict_unlocked()
+
+    def _evict_unlocked(self):
+        """Drops the least recently used entries down to 90% of max_entries. Assumes lock is held."""
+        excess = self._count - int(self.max_entries * 0.9)
+        self._conn.execute(
+            "DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY last_used LIMIT ?)",
+            (excess,),
+        )
+        self._count = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def stats(self) -> Dict[str, float]:
+        total = self.hits + self.misses
+        return {
+            "entries": self._count,
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+_cache: Optional[EmbeddingCache] = None
+_cache_lock = threading.Lock()
+
+# Single-token expansions held in memory once loaded (bounded by the tokenizer vocabulary)
+_token_expansions: Dict[int, Dict[int, float]] = {}
+_token_lock = threading.Lock()
+
+
+def get_cache() -> EmbeddingCache:
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = EmbeddingCache()
+    return _cache
+
+
+def encode_windows(windows: List[splade_encoder.TokenWindow], threshold: float = 0.05,
+                   top_k: int = 150) -> List[Dict[int, float]]:
+    """splade_encoder.encode_windows() that only runs the model for chunks not already cached."""
+    if not windows:
+        return []
+    try:
+        cache = get_cache()
+        keys = [cache.key(w.text, threshold, top_k) for w in windows]
+        cached = cache.get_many(keys)
+    except Exception as e:
+        print(f"Error reading embedding cache: {e}")
+        return splade_encoder.encode_windows(windows, threshold, top_k)
+
+    # Encode each distinct missing chunk once, even if it repeats within the batch
+    missing: Dict[bytes, splade_encoder.TokenWindow] = {}
+    for key, window in zip(keys, windows):
+        if key not in cached and key not in missing:
+            missing[key] = window
+    if missing:
+        vectors = splade_encoder.encode_windows(list(missing.values()), threshold, top_k)
+        fresh = dict(zip(missing.keys(), vectors))
+        try:
+            cache.put_many(fresh)
+        except Exception as e:
+            print(f"Error writing embedding cache: {e}")
+        cached.update(fresh)
+
+    return [cached[key] for key in keys]
+
+
+def _token_key(cache: EmbeddingCache, token_id: int) -> bytes:
+    return cache.key(f"\0token\0{token_id}", 0.0, splade_encoder.TOKEN_EXPANSION_TOP_K)
+
+
+def _load_token_expansions(token_ids: List[int]):
+    """Makes the expansions of token_ids available in memory: from SQLite if persisted, else from the model."""
+    cache = None
+    found: Dict[int, Dict[int, float]] = {}
+    try:
+        cache = get_cache()
+        keys = {_token_key(cache, t): t for t in token_ids}
+        found = {keys[k]: vec for k, vec in cache.get_many(list(keys)).items()}
+    except Exception as e:
+        print(f"Error reading embedding cache: {e}")
+
+    missing = [t for t in token_ids if t not in found]
+    if missing:
+        fresh = dict(zip(missing, splade_encoder.encode_token_expansions(missing)))
+        if cache is not None:
+            try:
+                cache.put_many({_token_key(cache, t): vec for t, vec in fresh.items()})
+            except Exception as e:
+                print(f"Error writing embedding cache: {e}")
+        found.update(fresh)
+    with _token_lock:
+        _token_expansions.update(found)
+
+
+def encode_names(names: List[str], threshold: float = 0.05, top_k: int = 150) -> List[Dict[int, float]]:
+    """
+    Encodes name-only documents (directories, metadata-only files) by pooling cached
+    per-token expansions instead of running the transformer over every name.
+    Only tokens never seen before go through the model, three tokens per row.
+    """
+    token_rows = [splade_encoder.name_token_ids(name) for name in names]
+    needed = list({t for row in token_rows for t in row if t not in _token_expansions})
+    if needed:
+        _load_token_expansions(needed)
+    return [
+        splade_encoder.max_pool([_token_expansions[t] for t in row], threshold, top_k)
+        for row in token_rows
+    ]
@@ -0,0 +1,199 @@
+import os
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+from queue import Queue, Empty, Full
+
+import parsers
+import local_db
+import splade_encoder
+
+# Pipeline configuration (can be customized via environment variables)
+PARSE_WORKERS = int(os.getenv("SYNC_PARSE_WORKERS", str(max(1, min(4, (os.cpu_count() or 2) - 1)))))
+ENCODE_BATCH_CHUNKS = int(os.getenv("SYNC_ENCODE_BATCH_CHUNKS", "64"))
+WRITE_BATCH_POINTS = int(os.getenv("SYNC_WRITE_BATCH_POINTS", "2048"))
+QUEUE_SIZE = int(os.getenv("SYNC_QUEUE_SIZE", "64"))
+
+# How long a stage waits for more input before flushing a partial batch
+_FLUSH_TIMEOUT = 0.2
+
+# End-of-stream marker passed between stages
+_DONE = object()
+
+
+def _put(q: Queue, item, stop_event: threading.Event) -> bool:
+    """Blocking put that gives up once the pipeline is stopped. Returns False if stopped."""
+    while not stop_event.is_set():
+        try:
+            q.put(item, timeout=_FLUSH_TIMEOUT)
+            return True
+        except Full:
+            continue
+    return False
+
+
+def _take_batch(q: Queue, size_of, batch_limit: int, stop_event: threading.Event) -> tuple[list, bool]:
+    """
+    Waits for one item, then keeps draining until batch_limit is reached or the
+    queue stays empty for _FLUSH_TIMEOUT. Returns (batch, reached_end_of_stream).
+    A stopped pipeline counts as the end of the stream.
+    """
+    while True:
+        if stop_event.is_set():
+            return [], True
+        try:
+            item = q.get(timeout=_FLUSH_TIMEOUT)
+            break
+        except Empty:
+            continue
+    if item is _DONE:
+        return [], True
+    batch = [item]
+    total = size_of(item)
+    while total < batch_limit:
+        try:
+            item = q.get(timeout=_FLUSH_TIMEOUT)
+        except Empty:
+            break
+        if item is _DONE:
+            return batch, True
+        batch.append(item)
+        total += size_of(item)
+    return batch, False
+
+
+def _parse_stage(paths: list[str], parsed_q: Queue, stop_event: threading.Event, workers: int, counters: dict):
+    """Parses files in a process pool, keeping at most 2 * workers parses in flight."""
+    def emit(doc):
+        if doc is not None:
+            _put(parsed_q, doc, stop_event)
+
+    remaining = iter(paths)
+    in_flight = {}
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            while True:
+                while len(in_flight) < workers * 2 and not stop_event.is_set():
+                    p = next(remaining, None)
+                    if p is None:
+                        break
+                    in_flight[pool.submit(parsers.parse_file, p)] = p
+                if not in_flight:
+                    break
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    p = in_flight.pop(future)
+                    try:
+                        emit(future.result())
+                    except BrokenProcessPool:
+                        in_flight[future] = p
+                        raise
+                    except Exception as e:
+                        counters["errors"] += 1
+                        print(f"Sync Error parsing {p}: {e}", file=sys.stderr)
+    except BrokenProcessPool as e:
+        # Worker processes could not start or died; finish the remaining files in-process
+        print(f"Sync: Parser process pool unavailable ({e}), parsing in-process.", file=sys.stderr)
+        for p in [*in_flight.values(), *remaining]:
+            if stop_event.is_set():
+                break
+            try:
+                emit(parsers.parse_file(p))
+            except Exception as err:
+                counters["errors"] += 1
+                print(f"Sync Error parsing {p}: {err}", file=sys.stderr)
+
+
+def _encode_stage(parsed_q: Queue, encoded_q: Queue, stop_event: threading.Event, batch_chunks: int, counters: dict):
+    """Groups parsed documents and encodes all their chunks in batched ONNX runs."""
+    # Text length is a cheap stand-in for the chunk count before chunking
+    def approx_chunks(doc):
+        return max(1, len(doc.text_content or "") // 1000)
+
+    while True:
+        docs, finished = _take_batch(parsed_q, approx_chunks, batch_chunks, stop_event)
+        if docs and not stop_event.is_set():
+            try:
+                encoded = local_db.encode_documents(docs)
+            except Exception as e:
+                print(f"Sync Error encoding batch of {len(docs)} documents: {e}", file=sys.stderr)
+                encoded = []
+                # Isolate the failing document(s)
+                for doc in docs:
+                    try:
+                        encoded.extend(local_db.encode_documents([doc]))
+                    except Exception as err:
+                        counters["errors"] += 1
+                        print(f"Sync Error encoding {doc.path}: {err}", file=sys.stderr)
+            for item in encoded:
+                _put(encoded_q, item, stop_event)
+        if finished:
+            _put(encoded_q, _DONE, stop_event)
+            return
+
+
+def _write_stage(encoded_q: Queue, stop_event: threading.Event, batch_points: int, total: int, counters: dict):
+    """Groups encoded documents from many files into large bulk upserts."""
+    def write(batch):
+        try:
+            local_db.write_documents(batch)
+            counters["written"] += len(batch)
+        except Exception as e:
+            print(f"Sync Error writing batch of {len(batch)} documents: {e}", file=sys.stderr)
+            for item in batch:
+                try:
+                    local_db.write_documents([item])
+                    counters["written"] += 1
+                except Exception as err:
+                    counters["errors"] += 1
+                    print(f"Sync Error indexing {item[0].path}: {err}", file=sys.stderr)
+
+    last_report = 0
+    while True:
+        batch, finished = _take_batch(encoded_q, lambda item: len(item[1]), batch_points, stop_event)
+        if batch and not stop_event.is_set():
+            # Bulk upserts compete with searches for CPU and the collection as well
+            splade_encoder.yield_to_interactive()
+            write(batch)
+            if counters["written"] - last_report >= 50:
+                last_report = counters["written"]
+                print(f"  Indexed {counters['written']}/{total} items...")
+        if finished:
+            return
+
+
+def run(paths: list[str], stop_event: threading.Event | None = None,
+        parse_workers: int = PARSE_WORKERS, encode_batch_chunks: int = ENCODE_BATCH_CHUNKS,
+        write_batch_points: int = WRITE_BATCH_POINTS, queue_size: int = QUEUE_SIZE) -> int:
+    """
+    Indexes paths through a staged pipeline:
+    parse (process pool) -> chunk + encode (batched) -> bulk Qdrant upsert.
+    Stages are connected by bounded queues, so a slow stage applies backpressure
+    to the ones before it. Returns the number of documents written.
+    """
+    stop_event = stop_event or threading.Event()
+    parsed_q: Queue = Queue(maxsize=queue_size)
+    encoded_q: Queue = Queue(maxsize=queue_size)
+    counters = {"written": 0, "errors": 0}
+
+    encoder = threading.Thread(
+        target=_encode_stage, args=(parsed_q, encoded_q, stop_event, encode_batch_chunks, counters), daemon=True
+    )
+    writer = threading.Thread(
+        target=_write_stage, args=(encoded_q, stop_event, write_batch_points, len(paths), counters), daemon=True
+    )
+    encoder.start()
+    writer.start()
+    try:
+        _parse_stage(paths, parsed_q, stop_event, parse_workers, counters)
+    finally:
+        _put(parsed_q, _DONE, stop_event)
+        encoder.join()
+        writer.join()
+
+    if stop_event.is_set():
+        print("Sync: Interrupted by shutdown signal.")
+    if counters["errors"]:
+        print(f"Sync: {counters['errors']} items failed to index.", file=sys.stderr)
+    return counters["written"]
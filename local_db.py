@@ -1,9 +1,11 @@
 import os
 import uuid
 from datetime import datetime
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, List, Optional, Tuple
+import time
 import numpy as np
 import threading
+from contextlib import ExitStack, contextmanager
 
 from qdrant_client import QdrantClient
 from qdrant_client.models import (
@@ -18,21 +20,181 @@ from qdrant_client.models import (
     Filter,
     FieldCondition,
     MatchValue,
+    MatchAny,
+    Range,
+    PayloadSelectorExclude,
     FilterSelector,
+    SetPayload,
+    SetPayloadOperation,
+    ScoredPoint,
 )
 from parsers import ParsedDocument
 import splade_encoder
+import embedding_cache
+import manifest
+from personalization import personalization_store, to_iso
+from name_index import name_index
+from sparse_index import SparseIndex
 from path_env import DB_DIR
 
 os.makedirs(DB_DIR, exist_ok=True)
 
 COLLECTION_NAME = "documents"
 
+# Database initialization (init_db) runs once, on first use of the client rather than at import
+_init_lock = threading.RLock()
+_db_ready = threading.Event()
+_init_thread: Optional[int] = None
+
+def ensure_initialized():
+    """Runs init_db() once. Other threads wait for it; the initializing thread passes through."""
+    global _init_thread
+    if _db_ready.is_set() or _init_thread == threading.get_ident():
+        return
+    with _init_lock:
+        if _db_ready.is_set():
+            return
+        _init_thread = threading.get_ident()
+        try:
+            init_db()
+        finally:
+            _init_thread = None
+        _db_ready.set()
+
+def is_ready() -> bool:
+    return _db_ready.is_set()
+
+class _ReadWriteLock:
+    """
+    Shared/exclusive lock preferring readers: a reader only waits while a writer holds the lock,
+    and a writer also yields to readers already waiting, so a stream of short write batches
+    (one writer re-acquiring right after releasing) can't starve searches.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._waiting_readers = 0
+        self._writing = False
+
+    @contextmanager
+    def read(self):
+        with self._cond:
+            self._waiting_readers += 1
+            while self._writing:
+                self._cond.wait()
+            self._waiting_readers -= 1
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if self._readers == 0:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        with self._cond:
+            while self._writing or self._readers or self._waiting_readers:
+                self._cond.wait()
+            self._writing = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writing = False
+                self._cond.notify_all()
+
+# Client methods that never mutate the local collection, so they may run concurrently with each other
+_CLIENT_READ_METHODS = frozenset({
+    "query_points", "query_points_groups", "query_batch_points", "search", "search_groups", "retrieve",
+    "scroll", "count", "get_collection", "get_collections", "collection_exists",
+})
+
+class _SerializedClient:
+    """
+    The embedded (local mode) Qdrant client is not safe for concurrent use: a search running
+    while an upsert grows the collection can fail on torn state. Reads share a reader/writer lock
+    and every other call holds it exclusively; bulk writes are issued in small batches
+    (see _upsert_batches) so a search never waits behind a whole sync batch.
+    Opening local storage loads the whole collection, so the client is created on first use.
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._client: Optional[QdrantClient] = None
+        self._connect_lock = threading.Lock()
+        self._lock = _ReadWriteLock()
+
+    def _connect(self) -> QdrantClient:
+        if self._client is None:
+            with self._connect_lock:
+                if self._client is None:
+                    self._client = self._factory()
+        ensure_initialized()
+        return self._client
+
+    @property
+    def is_open(self) -> bool:
+        return self._client is not None
+
+    def close(self):
+        """Closes the client if it was ever opened. Never opens it (nor initializes the database) just to close it."""
+        if self._client is not None:
+            with self._lock.write():
+                self._client.close()
+
+    def __getattr__(self, name):
+        attr = getattr(self._connect(), name)
+        if not callable(attr):
+            return attr
+        mode = self._lock.read if name in _CLIENT_READ_METHODS else self._lock.write
+
+        def locked(*args, **kwargs):
+            with mode():
+                return attr(*args, **kwargs)
+        return locked
+
 # Initialize Qdrant local client with thread safety check disabled for concurrent in-process access
-client = QdrantClient(path=DB_DIR, force_disable_check_same_thread=True)
+client = _SerializedClient(lambda: QdrantClient(path=DB_DIR, force_disable_check_same_thread=True))
+
+# Points per upsert call: each call holds the client exclusively, blocking searches for its duration
+CLIENT_WRITE_BATCH_POINTS = int(os.getenv("CLIENT_WRITE_BATCH_POINTS", "64"))
+
+def _upsert_batches(collection_name: str, groups: List[List[PointStruct]]):
+    """
+    Upserts groups of points in calls of about CLIENT_WRITE_BATCH_POINTS, releasing the client
+    between calls. A group (e.g. all chunks of one document) is never split across calls.
+    """
+    batch: List[PointStruct] = []
+    for group in groups:
+        batch.extend(group)
+        if len(batch) >= CLIENT_WRITE_BATCH_POINTS:
+            client.upsert(collection_name, batch)
+            batch = []
+    if batch:
+        client.upsert(collection_name, batch)
+
+# Sparse retrieval engine: "qdrant" scores with the collection itself, "native" uses the in-process
+# memory-mapped inverted index of sparse_index.py (the collection still stores payloads and vectors)
+SEARCH_ENGINE = os.getenv("SEARCH_ENGINE", "qdrant")
+native_index = SparseIndex(os.path.join(DB_DIR, "sparse_index")) if SEARCH_ENGINE == "native" else None
+
+# Two-stage retrieval: search one max-pooled vector per file first, then rescore only the chunks
+# of the best files, so first-stage work scales with files instead of chunks
+TWO_STAGE_RETRIEVAL = os.getenv("TWO_STAGE_RETRIEVAL", "0") == "1"
+DOC_COLLECTION_NAME = "documents_files"
+# Terms kept per file-level vector. Pruning makes stage 1 (and thus two-stage recall) approximate:
+# a file whose only matching terms were pruned is not rescored. Raise it to trade index size for recall.
+DOC_VECTOR_TOP_K = int(os.getenv("DOC_VECTOR_TOP_K", "400"))
+STAGE1_CANDIDATE_FACTOR = int(os.getenv("STAGE1_CANDIDATE_FACTOR", "3"))  # Files rescored per ranked file
+# Chunk payload fields copied onto file-level points (everything build_search_filter needs)
+_DOC_PAYLOAD_KEYS = ("path", "file_id", "ancestors", "name", "file_type", "size", "created_ts", "updated_ts",
+                     "updated_at", "total_chunks")
 
 # Per-path lock striping: prevents concurrent mutations on the same file path
-# Uses RLock for re-entrancy (upsert_document calls delete_path internally)
+# Uses RLock for re-entrancy (path-locked operations may call each other)
 _NUM_PATH_LOCKS = 64
 _path_locks = [threading.RLock() for _ in range(_NUM_PATH_LOCKS)]
 
@@ -40,6 +202,24 @@ def _get_path_lock(path: str) -> threading.RLock:
     """Return a striped lock for the given path to bound memory usage."""
     return _path_locks[hash(os.path.abspath(path)) % _NUM_PATH_LOCKS]
 
+def _get_path_locks(paths: List[str]) -> List[threading.RLock]:
+    """Return the distinct striped locks for many paths, in a stable acquisition order."""
+    stripes = sorted({hash(os.path.abspath(p)) % _NUM_PATH_LOCKS for p in paths})
+    return [_path_locks[i] for i in stripes]
+
+# Incremented after every change that can alter search results (writes, deletes, moves, clicks).
+# Caches of ranked results key on it, so they never serve results from before a change.
+_index_generation = 0
+_generation_lock = threading.Lock()
+
+def get_index_generation() -> int:
+    return _index_generation
+
+def bump_index_generation():
+    global _index_generation
+    with _generation_lock:
+        _index_generation += 1
+
 def backfill_vocabulary_if_needed():
     import spelling_db
     vocab = spelling_db.get_all_vocabulary()
@@ -76,6 +256,7 @@ def backfill_vocabulary_if_needed():
         for path, chunks in doc_texts.items():
             full_text = " ".join(chunks)
             spelling_db.update_document_vocabulary(path, full_text)
+        spelling_db.flush_vocabulary()
             
         print("Spelling database backfill completed successfully!")
     except Exception as e:
@@ -110,12 +291,36 @@ def init_db():
         # Create indexes for metadata payload
         print("Creating payload indexes...")
         client.create_payload_index(COLLECTION_NAME, "path", PayloadSchemaType.KEYWORD)
+        client.create_payload_index(COLLECTION_NAME, "file_id", PayloadSchemaType.KEYWORD)
+        client.create_payload_index(COLLECTION_NAME, "ancestors", PayloadSchemaType.KEYWORD)
         client.create_payload_index(COLLECTION_NAME, "size", PayloadSchemaType.INTEGER)
         client.create_payload_index(COLLECTION_NAME, "file_type", PayloadSchemaType.KEYWORD)
         client.create_payload_index(COLLECTION_NAME, "created_at", PayloadSchemaType.KEYWORD)
         client.create_payload_index(COLLECTION_NAME, "updated_at", PayloadSchemaType.KEYWORD)
-        client.create_payload_index(COLLECTION_NAME, "open_count", PayloadSchemaType.INTEGER)
-        client.create_payload_index(COLLECTION_NAME, "last_opened_at", PayloadSchemaType.KEYWORD)
+        client.create_payload_index(COLLECTION_NAME, "created_ts", PayloadSchemaType.FLOAT)
+        client.create_payload_index(COLLECTION_NAME, "updated_ts", PayloadSchemaType.FLOAT)
+
+    if TWO_STAGE_RETRIEVAL and not any(c.name == DOC_COLLECTION_NAME for c in collections):
+        print(f"Creating Qdrant collection '{DOC_COLLECTION_NAME}'...")
+        client.create_collection(
+            collection_name=DOC_COLLECTION_NAME,
+            vectors_config={},
+            sparse_vectors_config={"text-sparse": SparseVectorParams(index=SparseIndexParams(on_disk=True))}
+        )
+        for field, schema in (("path", PayloadSchemaType.KEYWORD), ("ancestors", PayloadSchemaType.KEYWORD),
+                              ("file_type", PayloadSchemaType.KEYWORD), ("size", PayloadSchemaType.INTEGER),
+                              ("created_ts", PayloadSchemaType.FLOAT), ("updated_ts", PayloadSchemaType.FLOAT)):
+            client.create_payload_index(DOC_COLLECTION_NAME, field, schema)
+
+    try:
+        migrate_payloads()
+    except Exception as e:
+        print(f"Error migrating point payloads: {e}")
+
+    try:
+        personalization_store.import_if_new(_load_payload_click_stats)
+    except Exception as e:
+        print(f"Error importing click statistics: {e}")
 
     # Backfill spelling database if needed
     try:
@@ -123,279 +328,855 @@ def init_db():
     except Exception as e:
         print(f"Error checking/backfilling spelling database: {e}")
 
-def get_point_id(filepath: str, chunk_index: int = 0) -> str:
-    # Generate a deterministic UUID based on absolute path and chunk index
-    abs_path = os.path.abspath(filepath)
-    unique_key = f"{abs_path}#chunk_{chunk_index}"
-    return str(uuid.uuid5(uuid.NAMESPACE_URL, unique_key))
-
-def upsert_document(doc: ParsedDocument):
-    lock = _get_path_lock(doc.path)
-    with lock:
-        # 1. Preserve existing personalization metrics if the document is being updated
-        open_count = 0
-        last_opened_at = None
+    if native_index is not None:
+        try:
+            # Native searches evaluate filters on the manifest, whose filter columns may predate it
+            if manifest.get_meta("filter_columns") == "0":
+                rebuild_manifest()
+                manifest.set_meta("filter_columns", "1")
+        except Exception as e:
+            print(f"Error backfilling manifest filter columns: {e}")
         try:
-            # Check base chunk (chunk 0) to retrieve existing metrics
-            base_id = get_point_id(doc.path, 0)
-            existing = client.retrieve(COLLECTION_NAME, [base_id])
-            if existing and existing[0].payload:
-                open_count = existing[0].payload.get("open_count", 0)
-                last_opened_at = existing[0].payload.get("last_opened_at")
-        except Exception:
-            pass
-
-        # 2. Delete all existing chunks/points associated with this file path
-        delete_path(doc.path)
-
-        # 3. Chunk text content
-        text = doc.text_content or ""
-        chunks = splade_encoder.chunk_text(text)
-        if not chunks:
-            chunks = [""]
-
-        # 4. Build all points and upsert in a single batch for near-atomicity
-        #    (minimizes the window between delete and re-insert)
+            sync_native_index()
+        except Exception as e:
+            print(f"Error building native sparse index: {e}")
+
+    try:
+        sync_doc_vectors()
+    except Exception as e:
+        print(f"Error building file-level vectors: {e}")
+
+def get_doc_point_id(file_id: str) -> str:
+    """Point id of a file's aggregated vector in the file-level collection."""
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"{file_id}#file"))
+
+def build_doc_point(file_id: str, chunk_payload: Dict[str, Any], sparse_vectors: List[Dict[int, float]]) -> PointStruct:
+    """File-level point: chunk vectors max-pooled and pruned to DOC_VECTOR_TOP_K terms."""
+    pooled = splade_encoder.max_pool(sparse_vectors, 0.0, DOC_VECTOR_TOP_K)
+    return PointStruct(
+        id=get_doc_point_id(file_id),
+        vector={"text-sparse": SparseVector(indices=list(pooled.keys()), values=list(pooled.values()))},
+        payload={k: chunk_payload.get(k) for k in _DOC_PAYLOAD_KEYS},
+    )
+
+def sync_doc_vectors():
+    """
+    Keeps the file-level collection in step with the setting. Writes only maintain it while
+    two-stage retrieval is enabled, so it is rebuilt from the chunk vectors when enabled again.
+    """
+    if not TWO_STAGE_RETRIEVAL:
+        if manifest.get_meta("doc_vectors") == "1":
+            manifest.set_meta("doc_vectors", "0")
+        return
+    files_count = client.count(DOC_COLLECTION_NAME, exact=True).count
+    if manifest.get_meta("doc_vectors") == "1" and files_count == len(manifest.get_file_id_map()):
+        return
+    print("Building file-level vectors for two-stage retrieval...")
+    client.delete(DOC_COLLECTION_NAME, points_selector=FilterSelector(filter=Filter()))
+    # Chunks of a file can be spread over scroll pages: pool incrementally, write each file once complete
+    pending: Dict[str, Tuple[Dict[str, Any], List[Dict[int, float]]]] = {}
+    offset = None
+    written = 0
+    while True:
+        records, offset = client.scroll(
+            collection_name=COLLECTION_NAME,
+            limit=2000,
+            with_payload=list(_DOC_PAYLOAD_KEYS) + ["chunk_index"],
+            with_vectors=["text-sparse"],
+            offset=offset
+        )
+        complete = []
+        for r in records:
+            vector = (r.vector or {}).get("text-sparse")
+            if vector is None or not r.payload.get("path"):
+                continue
+            file_id = r.payload.get("file_id") or r.payload["path"]
+            payload, vectors = pending.setdefault(file_id, (r.payload, []))
+            if r.payload.get("chunk_index") == 0:
+                pending[file_id] = (r.payload, vectors)
+            vectors.append(splade_encoder.max_pool([dict(zip(vector.indices, vector.values))], 0.0, DOC_VECTOR_TOP_K))
+            if len(vectors) >= (r.payload.get("total_chunks") or 1):
+                complete.append(file_id)
+        points = [build_doc_point(fid, *pending.pop(fid)) for fid in complete]
+        for fid, (payload, vectors) in (list(pending.items()) if offset is None else []):
+            points.append(build_doc_point(fid, payload, vectors))  # Partial files, written as they are
+        if points:
+            _upsert_batches(DOC_COLLECTION_NAME, [[point] for point in points])
+            written += len(points)
+        if offset is None:
+            break
+    manifest.set_meta("doc_vectors", "1")
+    print(f"Built {written} file-level vectors.")
+
+def sync_native_index():
+    """
+    Migration path to the native engine: (re)builds its index from the vectors stored in the
+    collection when it is missing or out of step (e.g. buffered writes lost in a crash).
+    """
+    points_count = client.count(COLLECTION_NAME, exact=True).count
+    if native_index.count() == points_count:
+        return
+    print(f"Building native sparse index from {points_count} points...")
+    native_index.clear()
+    offset = None
+    while True:
+        records, offset = client.scroll(
+            collection_name=COLLECTION_NAME,
+            limit=2000,
+            with_payload=["path", "file_id"],
+            with_vectors=["text-sparse"],
+            offset=offset
+        )
         points = []
-        for idx, chunk_text in enumerate(chunks):
-            sparse_vector = splade_encoder.encode(chunk_text)
-            point_id = get_point_id(doc.path, idx)
-
-            # Build payload with metadata + chunk indexing properties
-            payload = {
-                "path": doc.path,
-                "name": doc.name,
-                "file_type": doc.file_type,
-                "size": doc.size,
-                "created_at": doc.created_at,
-                "updated_at": doc.updated_at,
-                "open_count": open_count,
-                "last_opened_at": last_opened_at,
-                "chunk_index": idx,
-                "chunk_text": chunk_text,
-                "total_chunks": len(chunks)
-            }
-            # Add other custom metadata fields
-            if doc.metadata:
-                for k, v in doc.metadata.items():
-                    payload[f"meta_{k}"] = v
-
-            points.append(PointStruct(
-                id=point_id,
-                vector={
-                    "text-sparse": SparseVector(
-                        indices=list(sparse_vector.keys()),
-                        values=list(sparse_vector.values())
-                    )
-                },
-                payload=payload
-            ))
+        for r in records:
+            vector = (r.vector or {}).get("text-sparse")
+            if vector is None or not r.payload.get("path"):
+                continue
+            points.append((str(r.id), r.payload.get("file_id") or r.payload["path"], dict(zip(vector.indices, vector.values))))
+        native_index.replace_files([], points)
+        if offset is None:
+            break
+    native_index.flush()
+    print(f"Native sparse index built: {native_index.stats()}")
+
+def _ancestor_dirs(path: str) -> List[str]:
+    """All directories containing path, from the filesystem root down to its parent."""
+    ancestors = []
+    parent = os.path.dirname(path)
+    while parent and parent != path:
+        ancestors.append(parent)
+        path, parent = parent, os.path.dirname(parent)
+    ancestors.reverse()
+    return ancestors
+
+# Bump when build_points starts writing a payload field that older points lack,
+# and derive it in _derived_payload so existing points are backfilled once
+PAYLOAD_VERSION = 3
+
+# Payload indexes introduced by each payload version (for collections created before it)
+_VERSION_INDEXES = {
+    1: [("ancestors", PayloadSchemaType.KEYWORD)],
+    2: [("file_id", PayloadSchemaType.KEYWORD)],
+    3: [("created_ts", PayloadSchemaType.FLOAT), ("updated_ts", PayloadSchemaType.FLOAT)],
+}
+
+def _derived_payload(payload: Dict[str, Any]) -> Dict[str, Any]:
+    """Payload fields computed from a point's stored fields (shared by all chunks of a path)."""
+    return {
+        "ancestors": _ancestor_dirs(payload["path"]),
+        # Pre-existing points were keyed by path, so the path is their stable id
+        "file_id": payload.get("file_id") or payload["path"],
+        # Numeric epoch timestamps for vectorized ranking and range filters
+        "created_ts": _iso_to_epoch(payload.get("created_at")),
+        "updated_ts": _iso_to_epoch(payload.get("updated_at")),
+    }
+
+def migrate_payloads():
+    """Backfills derived payload fields on points written before PAYLOAD_VERSION."""
+    version = int(manifest.get_meta("payload_version", "0"))
+    if version >= PAYLOAD_VERSION:
+        return
+    for v in range(version + 1, PAYLOAD_VERSION + 1):
+        for field_name, schema in _VERSION_INDEXES.get(v, []):
+            client.create_payload_index(COLLECTION_NAME, field_name, schema)
+    if (client.get_collection(COLLECTION_NAME).points_count or 0) == 0:
+        manifest.set_meta("payload_version", str(PAYLOAD_VERSION))
+        return
+
+    print(f"Migrating point payloads to version {PAYLOAD_VERSION}...")
+    point_ids: Dict[str, list] = {}
+    payloads: Dict[str, Dict[str, Any]] = {}
+    offset = None
+    while True:
+        records, offset = client.scroll(
+            collection_name=COLLECTION_NAME,
+            limit=5000,
+            with_payload=True,
+            with_vectors=False,
+            offset=offset
+        )
+        for r in records:
+            p = r.payload.get("path")
+            if p:
+                point_ids.setdefault(p, []).append(r.id)
+                payloads.setdefault(p, r.payload)
+        if offset is None:
+            break
+
+    for p, ids in point_ids.items():
+        client.set_payload(COLLECTION_NAME, payload=_derived_payload(payloads[p]), points=ids)
+    manifest.set_meta("payload_version", str(PAYLOAD_VERSION))
+    print(f"Migrated payloads of {len(point_ids)} paths.")
+
+def get_point_id(file_id: str, chunk_index: int = 0) -> str:
+    # Generate a deterministic UUID based on the stable file id and chunk index.
+    # Files indexed before stable ids use their absolute path as file id,
+    # which reproduces their original path-derived point ids.
+    unique_key = f"{file_id}#chunk_{chunk_index}"
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, unique_key))
+
+def new_file_id() -> str:
+    return uuid.uuid4().hex
 
-        client.upsert(COLLECTION_NAME, points)
+# Encode directory and metadata-only names from cached token expansions instead of the full model
+FAST_NAME_ENCODING = os.getenv("FAST_NAME_ENCODING", "1") != "0"
 
-        # Update spelling vocabulary database and sync in-memory service
+EncodedDocument = Tuple[ParsedDocument, List[str], List[Dict[int, float]]]
+
+def encode_documents(docs: List[ParsedDocument]) -> List[EncodedDocument]:
+    """
+    Chunks and encodes many documents with one batched SPLADE pass over all their chunks.
+    Chunks already in the embedding cache skip the model entirely, and name-only documents
+    are encoded from per-token expansions without a full forward pass.
+    Returns (doc, chunk_texts, sparse_vectors) per document; empty documents get a single blank chunk.
+    """
+    fast_names = [i for i, doc in enumerate(docs) if FAST_NAME_ENCODING and doc.name_only and doc.text_content]
+    name_vectors = dict(zip(fast_names, embedding_cache.encode_names([docs[i].text_content for i in fast_names])))
+
+    doc_windows = [
+        [] if i in name_vectors else splade_encoder.chunk_windows(doc.text_content or "")
+        for i, doc in enumerate(docs)
+    ]
+    all_windows = [w for windows in doc_windows for w in windows]
+    all_vectors = embedding_cache.encode_windows(all_windows)
+
+    encoded = []
+    pos = 0
+    for i, (doc, windows) in enumerate(zip(docs, doc_windows)):
+        if i in name_vectors:
+            encoded.append((doc, [doc.text_content], [name_vectors[i]]))
+            continue
+        vectors = all_vectors[pos:pos + len(windows)]
+        pos += len(windows)
+        chunks = [w.text for w in windows]
+        encoded.append((doc, chunks or [""], vectors or [{}]))
+    return encoded
+
+def build_points(doc: ParsedDocument, file_id: str, chunks: List[str],
+                 sparse_vectors: List[Dict[int, float]]) -> List[PointStruct]:
+    points = []
+    ancestors = _ancestor_dirs(doc.path)
+    for idx, (chunk_text, sparse_vector) in enumerate(zip(chunks, sparse_vectors)):
+        point_id = get_point_id(file_id, idx)
+
+        # Build payload with metadata + chunk indexing properties
+        payload = {
+            "file_id": file_id,
+            "path": doc.path,
+            "ancestors": ancestors,
+            "name": doc.name,
+            "file_type": doc.file_type,
+            "size": doc.size,
+            "created_at": doc.created_at,
+            "updated_at": doc.updated_at,
+            "created_ts": _iso_to_epoch(doc.created_at),
+            "updated_ts": _iso_to_epoch(doc.updated_at),
+            "fingerprint": doc.fingerprint,
+            "chunk_index": idx,
+            "chunk_text": chunk_text,
+            "total_chunks": len(chunks)
+        }
+        # Add other custom metadata fields
+        if doc.metadata:
+            for k, v in doc.metadata.items():
+                payload[f"meta_{k}"] = v
+
+        points.append(PointStruct(
+            id=point_id,
+            vector={
+                "text-sparse": SparseVector(
+                    indices=list(sparse_vector.keys()),
+                    values=list(sparse_vector.values())
+                )
+            },
+            payload=payload
+        ))
+    return points
+
+def write_documents(encoded_docs: List[EncodedDocument]):
+    """
+    Replaces the indexed points of many already-encoded documents with a few batched upserts.
+    All chunks of a document go into the same upsert call, so an interrupted write never
+    leaves a document with fewer chunks than its total_chunks payload claims to be complete.
+    """
+    if not encoded_docs:
+        return
+    paths = [doc.path for doc, _, _ in encoded_docs]
+    with ExitStack() as stack:
+        for lock in _get_path_locks(paths):
+            stack.enter_context(lock)
+
+        # 1. Re-indexed files keep their stable id, new files get a fresh one
+        #    (click statistics live in the personalization store, keyed by path)
+        file_ids = manifest.get_file_ids(paths)
+        for p in paths:
+            if p not in file_ids:
+                file_ids[p] = new_file_id()
+
+        # 2. Build all points before touching the collection
+        doc_chunk_points = []
+        doc_points = []
+        for doc, chunks, sparse_vectors in encoded_docs:
+            chunk_points = build_points(doc, file_ids[doc.path], chunks, sparse_vectors)
+            doc_chunk_points.append(chunk_points)
+            if TWO_STAGE_RETRIEVAL:
+                doc_points.append([build_doc_point(file_ids[doc.path], chunk_points[0].payload, sparse_vectors)])
+
+        # 3. Delete the old chunks of these exact paths (a document may now have fewer chunks),
+        #    then upsert in small batches that each hold whole documents, so searches run in between
+        client.delete(
+            collection_name=COLLECTION_NAME,
+            points_selector=FilterSelector(
+                filter=Filter(
+                    must=[FieldCondition(key="path", match=MatchAny(any=paths))]
+                )
+            )
+        )
+        _upsert_batches(COLLECTION_NAME, doc_chunk_points)
+        if doc_points:
+            _upsert_batches(DOC_COLLECTION_NAME, doc_points)
+        if native_index is not None:
+            native_index.replace_files(
+                [file_ids[p] for p in paths],
+                [
+                    (get_point_id(file_ids[doc.path], i), file_ids[doc.path], vec)
+                    for doc, _, sparse_vectors in encoded_docs
+                    for i, vec in enumerate(sparse_vectors)
+                ],
+            )
+
+        # Record the files as complete only once all of their points are written
+        manifest.upsert_entries([
+            (doc.path, _iso_to_epoch(doc.updated_at), doc.updated_at, doc.size, len(chunks), doc.fingerprint,
+             file_ids[doc.path], doc.file_type, _iso_to_epoch(doc.created_at))
+            for doc, chunks, _ in encoded_docs
+        ])
+        name_index.add([(p, file_ids[p]) for p in paths])
+        bump_index_generation()
+
+        # Queue vocabulary updates; the writer applies them in batches and syncs the spelling service
         try:
             import spelling_db
-            from spelling_service import spelling_service
-            updated_vocab = spelling_db.update_document_vocabulary(doc.path, doc.text_content or "")
-            spelling_service.update_vocab(updated_vocab)
+            for doc, _, _ in encoded_docs:
+                spelling_db.update_document_vocabulary(doc.path, doc.text_content or "")
         except Exception as e:
             print(f"Error updating vocabulary for spelling correction: {e}")
 
+def upsert_document(doc: ParsedDocument):
+    write_documents(encode_documents([doc]))
+
+def _iso_to_epoch(value: Optional[str]) -> float:
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except (TypeError, ValueError):
+        return 0.0
+
+def get_fingerprint(path: str) -> Optional[str]:
+    """Return the stored content fingerprint of an indexed file, if any."""
+    entry = manifest.get_entry(os.path.abspath(path))
+    return entry["fingerprint"] if entry else None
+
+def refresh_updated_at(path: str, updated_at: str):
+    """Updates only the modification timestamp of an unchanged file, keeping its chunks and vectors."""
+    abs_path = os.path.abspath(path)
+    lock = _get_path_lock(abs_path)
+    with lock:
+        for collection_name in ((COLLECTION_NAME, DOC_COLLECTION_NAME) if TWO_STAGE_RETRIEVAL else (COLLECTION_NAME,)):
+            client.set_payload(
+                collection_name=collection_name,
+                payload={"updated_at": updated_at, "updated_ts": _iso_to_epoch(updated_at)},
+                points=Filter(
+                    must=[FieldCondition(key="path", match=MatchValue(value=abs_path))]
+                )
+            )
+        manifest.update_timestamp(abs_path, _iso_to_epoch(updated_at), updated_at)
+    bump_index_generation()
+
+def rebuild_manifest():
+    """
+    Repairs the manifest by scrolling every point in the collection.
+    Files with fewer chunks than their total_chunks payload are left out,
+    so the next sync re-indexes them.
+    """
+    files: Dict[str, Dict[str, Any]] = {}
+    offset = None
+    while True:
+        records, offset = client.scroll(
+            collection_name=COLLECTION_NAME,
+            limit=5000,
+            with_payload=["path", "file_id", "updated_at", "size", "total_chunks", "fingerprint", "file_type",
+                          "created_at"],
+            with_vectors=False,
+            offset=offset
+        )
+        for r in records:
+            p = r.payload.get("path")
+            if not p:
+                continue
+            p_abs = os.path.abspath(p)
+            info = files.get(p_abs)
+            if info is None:
+                files[p_abs] = {
+                    "updated_at": r.payload.get("updated_at") or "",
+                    "size": r.payload.get("size", 0),
+                    "actual_chunks": 1,
+                    "expected_total": r.payload.get("total_chunks", 1),  # Default to 1 if not set yet
+                    "fingerprint": r.payload.get("fingerprint"),
+                    "file_id": r.payload.get("file_id") or p_abs,
+                    "file_type": r.payload.get("file_type"),
+                    "created_ts": _iso_to_epoch(r.payload.get("created_at")),
+                }
+            else:
+                info["actual_chunks"] += 1
+                info["updated_at"] = max(info["updated_at"], r.payload.get("updated_at") or "")
+                info["expected_total"] = max(info["expected_total"], r.payload.get("total_chunks", 1))
+        if offset is None:
+            break
+
+    complete = {p: info for p, info in files.items() if info["actual_chunks"] >= info["expected_total"]}
+    manifest.replace_all([
+        (p, _iso_to_epoch(info["updated_at"]), info["updated_at"], info["size"], info["expected_total"],
+         info["fingerprint"], info["file_id"], info["file_type"], info["created_ts"])
+        for p, info in complete.items()
+    ])
+
+    # Partial files that no longer exist would never be re-indexed (and thus replaced), drop their points
+    orphaned = [p for p in files if p not in complete and not os.path.exists(p)]
+    if orphaned:
+        client.delete(
+            collection_name=COLLECTION_NAME,
+            points_selector=FilterSelector(
+                filter=Filter(
+                    must=[FieldCondition(key="path", match=MatchAny(any=orphaned))]
+                )
+            )
+        )
+    return len(complete)
+
+def load_manifest() -> Dict[str, Dict[str, Any]]:
+    """
+    Returns {path: {updated_at, total_chunks, fingerprint}} for every completely indexed file.
+    The collection is only scrolled as a repair when the manifest disagrees with its point count
+    (first run after upgrading, crash between a Qdrant write and the manifest write, interrupted indexing).
+    """
+    points_count = client.get_collection(COLLECTION_NAME).points_count or 0
+    if manifest.total_chunks() != points_count:
+        print(f"Manifest out of sync with collection ({points_count} points), rebuilding from Qdrant...")
+        rebuild_manifest()
+    return manifest.get_all()
+
 def delete_path(path: str) -> int:
+    """
+    Deletes a file, or a directory and its whole subtree, from the index.
+    Returns the number of indexed paths removed.
+    """
     abs_path = os.path.abspath(path)
     lock = _get_path_lock(abs_path)
     with lock:
-        deleted_count = 0
+        removed_file_ids = [file_id for _, file_id, _ in manifest.get_tree(abs_path)] if native_index is not None else []
 
-        # 1. First, delete vocabulary for this exact file path
+        # 1. Single filtered delete: the path itself plus every point whose
+        #    indexed 'ancestors' field contains it (directory children)
+        #    (and the same for file-level points when two-stage retrieval maintains them)
+        for collection_name in ((COLLECTION_NAME, DOC_COLLECTION_NAME) if TWO_STAGE_RETRIEVAL else (COLLECTION_NAME,)):
+            try:
+                client.delete(
+                    collection_name=collection_name,
+                    points_selector=FilterSelector(
+                        filter=Filter(
+                            should=[
+                                FieldCondition(key="path", match=MatchValue(value=abs_path)),
+                                FieldCondition(key="ancestors", match=MatchValue(value=abs_path)),
+                            ]
+                        )
+                    )
+                )
+            except Exception as e:
+                print(f"Error in filter-based deletion for {abs_path}: {e}")
+        if native_index is not None:
+            native_index.delete_files(removed_file_ids)
+
+        removed_paths = []
         try:
-            import spelling_db
-            from spelling_service import spelling_service
-            deleted_vocab = spelling_db.delete_document_vocabulary(abs_path)
-            spelling_service.update_vocab(deleted_vocab)
+            removed_paths = manifest.delete_tree(abs_path)
         except Exception as e:
-            print(f"Error deleting vocabulary for {abs_path}: {e}")
+            print(f"Error deleting manifest entries for {abs_path}: {e}")
+        personalization_store.delete_tree(abs_path)
+        name_index.delete_tree(abs_path)
+        bump_index_generation()
 
-        # Fast path: filter-based deletion for exact path match (multi-chunk files)
-        # Uses the KEYWORD index on 'path' for O(1) lookup instead of full O(n) scan
+        # 2. Queue vocabulary removal for the path and all child paths in one batch
         try:
-            client.delete(
-                collection_name=COLLECTION_NAME,
-                points_selector=FilterSelector(
-                    filter=Filter(
-                        must=[FieldCondition(key="path", match=MatchValue(value=abs_path))]
-                    )
-                )
-            )
+            import spelling_db
+            spelling_db.delete_tree_vocabulary(abs_path)
         except Exception as e:
-            print(f"Error in filter-based deletion for {abs_path}: {e}")
+            print(f"Error deleting vocabulary for {abs_path}: {e}")
+
+        return len(removed_paths)
+
+def move_path(src: str, dest: str) -> Optional[bool]:
+    """
+    Moves an indexed file or directory subtree from src to dest without re-encoding it.
+    Rewrites the path/name/ancestors payloads of every moved point (addressed by stable file id),
+    re-keys the manifest and transfers vocabulary ownership. Vectors are left untouched.
+    Returns None if src was not indexed, otherwise whether the moved root still needs
+    re-indexing (its basename changed and its only indexed content was that name).
+    """
+    abs_src = os.path.abspath(src)
+    abs_dest = os.path.abspath(dest)
+    if abs_src == abs_dest:
+        return False
+
+    with ExitStack() as stack:
+        for lock in _get_path_locks([abs_src, abs_dest]):
+            stack.enter_context(lock)
+
+        entries = manifest.get_tree(abs_src)
+        if not entries:
+            return None
 
-        # Directory children: scroll to find and batch-delete all points under this prefix
-        # Still O(n) but only needed for directory deletions (rare path)
-        prefix = abs_path if abs_path.endswith("/") else abs_path + "/"
+        # Whatever was indexed at the destination has been replaced
+        if manifest.get_tree(abs_dest):
+            delete_path(abs_dest)
+
+        operations = []
+        root_file_id = None
+        for old_path, file_id, total_chunks in entries:
+            new_path = abs_dest + old_path[len(abs_src):]
+            if old_path == abs_src:
+                root_file_id = file_id
+            operations.append(SetPayloadOperation(set_payload=SetPayload(
+                payload={
+                    "path": new_path,
+                    "name": os.path.basename(new_path) or new_path,
+                    "ancestors": _ancestor_dirs(new_path),
+                },
+                points=[get_point_id(file_id, i) for i in range(total_chunks or 1)],
+            )))
+        for i in range(0, len(operations), 1000):
+            client.batch_update_points(COLLECTION_NAME, operations[i:i + 1000])
+        if TWO_STAGE_RETRIEVAL:
+            # File-level points carry the same path fields (one point per file)
+            doc_operations = [
+                SetPayloadOperation(set_payload=SetPayload(payload=op.set_payload.payload, points=[get_doc_point_id(fid)]))
+                for op, (_, fid, _) in zip(operations, entries)
+            ]
+            for i in range(0, len(doc_operations), 1000):
+                client.batch_update_points(DOC_COLLECTION_NAME, doc_operations[i:i + 1000])
+
+        manifest.move_tree(abs_src, abs_dest)
+        personalization_store.move_tree(abs_src, abs_dest)
+        name_index.move_tree(abs_src, abs_dest)
+        bump_index_generation()
         try:
-            offset = None
-            to_delete = []
-            distinct_child_paths = set()
-            while True:
-                records, offset = client.scroll(
-                    collection_name=COLLECTION_NAME,
-                    limit=5000,
-                    with_payload=["path"],
-                    with_vectors=False,
-                    offset=offset
-                )
-                for r in records:
-                    p = r.payload.get("path", "")
-                    if p.startswith(prefix):
-                        to_delete.append(r.id)
-                        distinct_child_paths.add(p)
-                if offset is None:
-                    break
-
-            if to_delete:
-                for i in range(0, len(to_delete), 5000):
-                    batch = to_delete[i:i+5000]
-                    client.delete(COLLECTION_NAME, batch)
-                deleted_count = len(to_delete)
-
-                # Delete vocabulary for all child paths
-                import spelling_db
-                from spelling_service import spelling_service
-                for child_path in distinct_child_paths:
-                    try:
-                        deleted_vocab = spelling_db.delete_document_vocabulary(child_path)
-                        spelling_service.update_vocab(deleted_vocab)
-                    except Exception as e:
-                        print(f"Error deleting vocabulary for child {child_path}: {e}")
+            import spelling_db
+            spelling_db.move_tree_vocabulary(abs_src, abs_dest)
         except Exception as e:
-            print(f"Error deleting children of {abs_path}: {e}")
+            print(f"Error moving vocabulary from {abs_src} to {abs_dest}: {e}")
 
-        return deleted_count
+    # Directories and metadata-only files are indexed by their name alone
+    if root_file_id is None or os.path.basename(abs_src) == os.path.basename(abs_dest):
+        return False
+    try:
+        base = client.retrieve(COLLECTION_NAME, [get_point_id(root_file_id, 0)], with_payload=["chunk_text", "total_chunks"])
+        return bool(base) and base[0].payload.get("total_chunks") == 1 and \
+            base[0].payload.get("chunk_text") == os.path.basename(abs_src)
+    except Exception:
+        return True
 
 def log_click(path: str):
-    abs_path = os.path.abspath(path)
-    lock = _get_path_lock(abs_path)
-    with lock:
-        # Retrieve all chunks for this file using filtered scroll (uses KEYWORD index)
-        to_update = []
-        open_count = 0
-        try:
-            offset = None
-            while True:
-                records, offset = client.scroll(
-                    collection_name=COLLECTION_NAME,
-                    scroll_filter=Filter(
-                        must=[FieldCondition(key="path", match=MatchValue(value=abs_path))]
-                    ),
-                    limit=5000,
-                    with_payload=["open_count"],
-                    with_vectors=False,
-                    offset=offset
-                )
-                for r in records:
-                    to_update.append(r.id)
-                    open_count = max(open_count, r.payload.get("open_count", 0))
-                if offset is None:
-                    break
-        except Exception:
-            pass
-
-        if to_update:
-            client.set_payload(
-                collection_name=COLLECTION_NAME,
-                payload={
-                    "open_count": open_count + 1,
-                    "last_opened_at": datetime.now().isoformat()
-                },
-                points=to_update
-            )
+    # O(1) in-memory update, persisted write-behind by the personalization store
+    personalization_store.record_open(os.path.abspath(path))
+    bump_index_generation()
 
-def search_documents(sparse_query: Dict[int, float], limit: int = 50) -> List[Dict[str, Any]]:
+def _load_payload_click_stats() -> Dict[str, tuple]:
+    """Reads click statistics that older versions stored on chunk payloads."""
+    stats: Dict[str, tuple] = {}
+    offset = None
+    while True:
+        records, offset = client.scroll(
+            collection_name=COLLECTION_NAME,
+            scroll_filter=Filter(
+                must=[FieldCondition(key="open_count", range=Range(gt=0))]
+            ),
+            limit=5000,
+            with_payload=["path", "open_count", "last_opened_at"],
+            with_vectors=False,
+            offset=offset
+        )
+        for r in records:
+            p = r.payload.get("path")
+            if p and p not in stats:
+                stats[p] = (r.payload.get("open_count", 0), _iso_to_epoch(r.payload.get("last_opened_at")) or None)
+        if offset is None:
+            break
+    return stats
+
+def build_search_filter(filters: Optional[Dict[str, Any]]) -> Optional[Filter]:
+    """
+    Translates structured search filters into Qdrant conditions on indexed payload fields.
+    Supported keys: file_types (list of MIME types), path_prefix (directory or file),
+    min_size / max_size (bytes), modified_after / modified_before and
+    created_after / created_before (epoch seconds).
+    """
+    if not filters:
+        return None
+    must = []
+    file_types = filters.get("file_types")
+    if file_types:
+        must.append(FieldCondition(key="file_type", match=MatchAny(any=list(file_types))))
+
+    path_prefix = filters.get("path_prefix")
+    if path_prefix:
+        prefix = os.path.abspath(os.path.expanduser(path_prefix))
+        must.append(Filter(should=[
+            FieldCondition(key="path", match=MatchValue(value=prefix)),
+            FieldCondition(key="ancestors", match=MatchValue(value=prefix)),
+        ]))
+
+    if filters.get("min_size") is not None or filters.get("max_size") is not None:
+        must.append(FieldCondition(key="size", range=Range(gte=filters.get("min_size"), lte=filters.get("max_size"))))
+    if filters.get("modified_after") is not None or filters.get("modified_before") is not None:
+        must.append(FieldCondition(
+            key="updated_ts", range=Range(gte=filters.get("modified_after"), lte=filters.get("modified_before"))
+        ))
+    if filters.get("created_after") is not None or filters.get("created_before") is not None:
+        must.append(FieldCondition(
+            key="created_ts", range=Range(gte=filters.get("created_after"), lte=filters.get("created_before"))
+        ))
+    return Filter(must=must) if must else None
+
+def search_documents(sparse_query: Dict[int, float], limit: int = 50,
+                     filters: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
     if not sparse_query:
         return []
-        
-    # Query Qdrant for candidates
-    res = client.query_points(
+    if TWO_STAGE_RETRIEVAL:
+        results = _rerank(_two_stage_search(sparse_query, limit * RERANK_CANDIDATE_FACTOR, filters), limit)
+        _load_chunk_texts(results)
+        return results
+    if native_index is not None:
+        results = _rerank(_native_search(sparse_query, limit * RERANK_CANDIDATE_FACTOR, filters), limit)
+        _load_chunk_texts(results)
+        return results
+
+    # Query Qdrant for the best chunk of each candidate file (grouped by path server-side),
+    # with filters pushed down into the sparse search. Personalization can reorder files,
+    # so a few more files than needed are ranked. Only ranking fields are loaded here.
+    res = client.query_points_groups(
         collection_name=COLLECTION_NAME,
         query=SparseVector(
             indices=list(sparse_query.keys()),
             values=list(sparse_query.values())
         ),
         using="text-sparse",
-        limit=limit * 4  # Retrieve more candidates because multiple chunks might match the same file
+        group_by="path",
+        group_size=1,
+        limit=limit * RERANK_CANDIDATE_FACTOR,
+        query_filter=build_search_filter(filters),
+        with_payload=PayloadSelectorExclude(exclude=["chunk_text", "ancestors", "fingerprint"]),
     )
-    hits = res.points
-    
-    # Perform Personalized Re-ranking and Grouping by File Path
-    now = datetime.now()
-    ranked_results = {}
-    
-    for hit in hits:
-        payload = hit.payload
-        score = hit.score
-        path = payload.get("path")
-        
-        if not path:
-            continue
-            
-        # 1. Access Frequency Boost: multiplier based on open_count
-        open_count = payload.get("open_count", 0)
-        frequency_boost = 1.0 + 0.3 * np.log1p(open_count)
-        
-        # 2. Access Recency Boost: decay based on last_opened_at
-        recency_boost = 1.0
-        last_opened = payload.get("last_opened_at")
-        if last_opened:
-            try:
-                dt = datetime.fromisoformat(last_opened)
-                delta_days = (now - dt).total_seconds() / (3600 * 24)
-                # Exponential decay over time (halves every 7 days)
-                recency_boost += 0.5 * (0.5 ** (delta_days / 7.0))
-            except Exception:
-                pass
-                
-        # 3. Modification Recency Boost: decay based on updated_at
-        mod_boost = 1.0
-        updated = payload.get("updated_at")
-        if updated:
-            try:
-                dt = datetime.fromisoformat(updated)
-                delta_days = (now - dt).total_seconds() / (3600 * 24)
-                # Exponential decay over time (halves every 14 days)
-                mod_boost += 0.3 * (0.5 ** (delta_days / 14.0))
-            except Exception:
-                pass
-
-        # Calculate final personalized score
-        final_score = score * frequency_boost * recency_boost * mod_boost
-        
-        # Group and deduplicate by path, keeping the passage chunk with the highest score
-        if path not in ranked_results or final_score > ranked_results[path]["score"]:
-            ranked_results[path] = {
-                "id": hit.id,
-                "score": final_score,
-                "path": path,
-                "name": payload.get("name"),
-                "file_type": payload.get("file_type"),
-                "size": payload.get("size"),
-                "created_at": payload.get("created_at"),
-                "updated_at": payload.get("updated_at"),
-                "open_count": open_count,
-                "last_opened_at": last_opened,
-                "chunk_index": payload.get("chunk_index"),
-                "chunk_text": payload.get("chunk_text"),
-                "metadata": {k: v for k, v in payload.items() if k.startswith("meta_")}
-            }
-            
+    hits = [group.hits[0] for group in res.groups if group.hits and group.hits[0].payload.get("path")]
+    results = _rerank(hits, limit)
+    _load_chunk_texts(results)
+    return results
+
+def _load_chunk_texts(results: List[Dict[str, Any]]):
+    """Loads passage text only for the final winners."""
+    if results:
+        texts = {
+            r.id: r.payload.get("chunk_text")
+            for r in client.retrieve(COLLECTION_NAME, [r["id"] for r in results], with_payload=["chunk_text"])
+        }
+        for r in results:
+            r["chunk_text"] = texts.get(r["id"])
+
+def _two_stage_search(sparse_query: Dict[int, float], n: int, filters: Optional[Dict[str, Any]]) -> List[ScoredPoint]:
+    """
+    Stage 1 ranks files by their pooled vectors (filters pushed down); stage 2 rescores only the
+    chunks of the best n * STAGE1_CANDIDATE_FACTOR files with the grouped chunk query, restricted
+    to those files by a file_id filter. Returns the best chunk of each of the top n files.
+    Recall is approximate: pooled vectors keep only DOC_VECTOR_TOP_K terms, so a file matching
+    the query only on pruned terms can be missed by stage 1 (stage 2 scores are exact).
+    """
+    files = client.query_points(
+        collection_name=DOC_COLLECTION_NAME,
+        query=SparseVector(indices=list(sparse_query.keys()), values=list(sparse_query.values())),
+        using="text-sparse",
+        limit=n * STAGE1_CANDIDATE_FACTOR,
+        query_filter=build_search_filter(filters),
+        with_payload=["file_id"],
+    ).points
+    file_ids = [f.payload["file_id"] for f in files if f.payload.get("file_id")]
+    if not file_ids:
+        return []
+    res = client.query_points_groups(
+        collection_name=COLLECTION_NAME,
+        query=SparseVector(indices=list(sparse_query.keys()), values=list(sparse_query.values())),
+        using="text-sparse",
+        group_by="path",
+        group_size=1,
+        limit=n,
+        query_filter=Filter(must=[FieldCondition(key="file_id", match=MatchAny(any=file_ids))]),
+        with_payload=PayloadSelectorExclude(exclude=["chunk_text", "ancestors", "fingerprint"]),
+    )
+    return [group.hits[0] for group in res.groups if group.hits and group.hits[0].payload.get("path")]
+
+def _native_search(sparse_query: Dict[int, float], n: int, filters: Optional[Dict[str, Any]]) -> List[ScoredPoint]:
+    """
+    Best chunk of the top n files from the native engine, with payloads loaded from the collection.
+    Filters are pushed down: they select the allowed file ids from the manifest, and the index
+    only ranks chunks of those files.
+    """
+    ensure_initialized()  # The index and the manifest are only in sync once init_db() has run
+    ranked = native_index.search(sparse_query, n, _filter_file_ids(filters) if filters else None)
+    scores = dict(ranked)
+    records = client.retrieve(
+        COLLECTION_NAME, list(scores),
+        with_payload=PayloadSelectorExclude(exclude=["chunk_text", "ancestors", "fingerprint"]),
+    )
+    hits = [
+        ScoredPoint(id=r.id, version=0, score=scores[str(r.id)], payload=r.payload)
+        for r in records if r.payload.get("path")
+    ]
+    hits.sort(key=lambda h: -h.score)
+    return hits
+
+def _filter_file_ids(filters: Dict[str, Any]) -> List[str]:
+    """File ids of the indexed files passing the build_search_filter() conditions, from the manifest."""
+    path_prefix = filters.get("path_prefix")
+    return manifest.filter_file_ids(
+        file_types=list(filters.get("file_types") or []),
+        path_prefix=os.path.abspath(os.path.expanduser(path_prefix)) if path_prefix else None,
+        size_range=(filters.get("min_size"), filters.get("max_size")),
+        modified_range=(filters.get("modified_after"), filters.get("modified_before")),
+        created_range=(filters.get("created_after"), filters.get("created_before")),
+    )
+
+def _matches_filters(payload: Dict[str, Any], filters: Optional[Dict[str, Any]]) -> bool:
+    """Evaluates the build_search_filter() conditions against a single payload in Python."""
+    if not filters:
+        return True
+    if filters.get("file_types") and payload.get("file_type") not in filters["file_types"]:
+        return False
+    if filters.get("path_prefix"):
+        prefix = os.path.abspath(os.path.expanduser(filters["path_prefix"]))
+        path = payload.get("path") or ""
+        if path != prefix and not path.startswith(prefix.rstrip("/") + "/"):
+            return False
+    size = payload.get("size") or 0
+    if filters.get("min_size") is not None and size < filters["min_size"]:
+        return False
+    if filters.get("max_size") is not None and size > filters["max_size"]:
+        return False
+    updated_ts = payload.get("updated_ts") or _iso_to_epoch(payload.get("updated_at"))
+    created_ts = payload.get("created_ts") or _iso_to_epoch(payload.get("created_at"))
+    for ts, after, before in ((updated_ts, "modified_after", "modified_before"),
+                              (created_ts, "created_after", "created_before")):
+        if filters.get(after) is not None and ts < filters[after]:
+            return False
+        if filters.get(before) is not None and ts > filters[before]:
+            return False
+    return True
+
+def search_names(query: str, limit: int = 50, filters: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+    """
+    Filename/path matches from the in-memory name index, without running the model.
+    Results have the same shape as search_documents(), scored by match quality and personalization,
+    plus name_score: the raw match quality, without personalization boosts.
+    """
+    matches = name_index.search(query, limit * RERANK_CANDIDATE_FACTOR)
+    if not matches:
+        return []
+    # The first chunk of each file stands in for it (payload and passage preview)
+    name_scores = {get_point_id(file_id, 0): score for _, file_id, score in matches}
+    records = client.retrieve(
+        COLLECTION_NAME, list(name_scores), with_payload=PayloadSelectorExclude(exclude=["ancestors", "fingerprint"])
+    )
+    hits = [
+        ScoredPoint(id=r.id, version=0, score=name_scores[str(r.id)], payload=r.payload)
+        for r in records
+        if r.payload.get("path") and _matches_filters(r.payload, filters)
+    ]
+    results = _rerank(hits, limit)
+    for r in results:
+        r["name_score"] = name_scores[str(r["id"])]
+    return results
+
+_SECONDS_PER_DAY = 3600 * 24
+
+# Files ranked per requested result (personalization boosts can reorder retrieval order)
+RERANK_CANDIDATE_FACTOR = int(os.getenv("RERANK_CANDIDATE_FACTOR", "2"))
+
+def _rerank(hits: list, limit: int) -> List[Dict[str, Any]]:
+    """
+    Personalized re-ranking and grouping by file path, computed as array operations
+    over the whole candidate set. Result dicts are only built for the final top `limit`.
+    """
+    if not hits:
+        return []
+    n = len(hits)
+    paths = np.array([hit.payload["path"] for hit in hits], dtype=object)
+    scores = np.fromiter((hit.score for hit in hits), dtype=np.float64, count=n)
+    # Points written before numeric timestamps existed fall back to parsing updated_at
+    updated_ts = np.fromiter(
+        (hit.payload.get("updated_ts") or _iso_to_epoch(hit.payload.get("updated_at")) for hit in hits),
+        dtype=np.float64, count=n
+    )
+    click_stats = personalization_store.get_many(list(set(paths)))
+    open_counts = np.fromiter((click_stats.get(p, (0, None))[0] for p in paths), dtype=np.float64, count=n)
+    last_opened = np.fromiter(
+        (click_stats.get(p, (0, None))[1] or np.nan for p in paths), dtype=np.float64, count=n
+    )
+    now = time.time()
+
+    # 1. Access Frequency Boost: multiplier based on open_count
+    frequency_boost = 1.0 + 0.3 * np.log1p(open_counts)
+
+    # 2. Access Recency Boost: exponential decay over time (halves every 7 days), 0 if never opened
+    opened_days = (now - last_opened) / _SECONDS_PER_DAY
+    recency_boost = 1.0 + np.nan_to_num(0.5 * np.power(0.5, opened_days / 7.0), nan=0.0)
+
+    # 3. Modification Recency Boost: exponential decay over time (halves every 14 days)
+    modified_days = (now - updated_ts) / _SECONDS_PER_DAY
+    mod_boost = 1.0 + np.where(updated_ts > 0, 0.3 * np.power(0.5, modified_days / 14.0), 0.0)
+
+    # Calculate final personalized score
+    final_scores = scores * frequency_boost * recency_boost * mod_boost
+
+    # Group and deduplicate by path, keeping the passage chunk with the highest score:
+    # sort by (path group, score desc) and take the first row of every group
+    _, groups = np.unique(paths, return_inverse=True)
+    order = np.lexsort((-final_scores, groups))
+    sorted_groups = groups[order]
+    is_first = np.ones(n, dtype=bool)
+    is_first[1:] = sorted_groups[1:] != sorted_groups[:-1]
+    best = np.sort(order[is_first])  # back to retrieval order so ties keep their rank
+
     # Sort results by final score descending and slice to limit
-    sorted_results = list(ranked_results.values())
-    sorted_results.sort(key=lambda x: -x["score"])
-    return sorted_results[:limit]
+    top = best[np.argsort(-final_scores[best], kind="stable")[:limit]]
+
+    results = []
+    for i in top:
+        hit = hits[i]
+        payload = hit.payload
+        open_count, last_opened_ts = click_stats.get(payload["path"], (0, None))
+        results.append({
+            "id": hit.id,
+            "score": float(final_scores[i]),
+            "path": payload["path"],
+            "name": payload.get("name"),
+            "file_type": payload.get("file_type"),
+            "size": payload.get("size"),
+            "created_at": payload.get("created_at"),
+            "updated_at": payload.get("updated_at"),
+            "open_count": open_count,
+            "last_opened_at": to_iso(last_opened_ts),
+            "chunk_index": payload.get("chunk_index"),
+            "chunk_text": payload.get("chunk_text"),  # filled in by the caller when not loaded
+            "metadata": {k: v for k, v in payload.items() if k.startswith("meta_")}
+        })
+    return results
 
-# Initialize Database on load
-init_db()
 
 if __name__ == "__main__":
     print("Testing local_db...")
@@ -413,15 +1194,14 @@ if __name__ == "__main__":
     print("Dummy document upserted.")
     
     # Check if exists
-    point_id = get_point_id(dummy_doc.path, 0)
+    point_id = get_point_id(manifest.get_entry(dummy_doc.path)["file_id"], 0)
     res = client.retrieve(COLLECTION_NAME, [point_id])
     print("Retrieved document chunk 0:", res[0].payload)
     
     # Test click logging
     print("Logging click...")
     log_click(dummy_doc.path)
-    res = client.retrieve(COLLECTION_NAME, [point_id])
-    print("After click:", res[0].payload)
+    print("After click:", personalization_store.get_many([dummy_doc.path]))
     
     # Test search
     print("Searching...")
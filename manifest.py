@@ -0,0 +1,233 @@
+import os
+import sqlite3
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+from path_env import DB_DIR
+
+MANIFEST_PATH = os.path.join(DB_DIR, "manifest.sqlite")
+
+# Long-lived connection shared by the watcher, the sync pipeline and the API threads
+_conn: Optional[sqlite3.Connection] = None
+_lock = threading.RLock()
+
+# (path, mtime, updated_at, size, total_chunks, fingerprint, file_id, file_type, created_ts)
+ManifestRow = Tuple[str, float, str, int, int, Optional[str], str, Optional[str], float]
+
+_COLUMNS = "path, mtime, updated_at, size, total_chunks, fingerprint, file_id, file_type, created_ts"
+
+
+def _get_conn() -> sqlite3.Connection:
+    global _conn
+    if _conn is None:
+        with _lock:
+            if _conn is None:
+                os.makedirs(DB_DIR, exist_ok=True)
+                conn = sqlite3.connect(MANIFEST_PATH, timeout=10, check_same_thread=False)
+                conn.execute("PRAGMA journal_mode=WAL;")
+                with conn:
+                    conn.execute("""
+                        CREATE TABLE IF NOT EXISTS files (
+                            path TEXT PRIMARY KEY,
+                            mtime REAL,
+                            updated_at TEXT,
+                            size INTEGER,
+                            total_chunks INTEGER,
+                            fingerprint TEXT,
+                            file_id TEXT,
+                            file_type TEXT,
+                            created_ts REAL
+                        )
+                    """)
+                    conn.execute("""
+                        CREATE TABLE IF NOT EXISTS meta (
+                            key TEXT PRIMARY KEY,
+                            value TEXT
+                        )
+                    """)
+                    # Manifests created before stable file ids
+                    columns = [row[1] for row in conn.execute("PRAGMA table_info(files)")]
+                    if "file_id" not in columns:
+                        conn.execute("ALTER TABLE files ADD COLUMN file_id TEXT")
+                    # Manifests created before search filters were evaluated on it: backfilled from the collection
+                    if "file_type" not in columns:
+                        conn.execute("ALTER TABLE files ADD COLUMN file_type TEXT")
+                        conn.execute("ALTER TABLE files ADD COLUMN created_ts REAL")
+                        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('filter_columns', '0')")
+                _conn = conn
+    return _conn
+
+
+def _subtree_bounds(path: str) -> Tuple[str, str]:
+    """
+    Returns [low, high) bounds selecting every path strictly under the directory path.
+    '0' is the character right after '/', so the range is an index-friendly prefix match.
+    """
+    prefix = path if path.endswith("/") else path + "/"
+    return prefix, prefix[:-1] + "0"
+
+
+def upsert_entries(rows: List[ManifestRow]):
+    """Records fully indexed files. Called after their points are written."""
+    if not rows:
+        return
+    conn = _get_conn()
+    with _lock, conn:
+        conn.executemany(
+            f"INSERT OR REPLACE INTO files ({_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            rows,
+        )
+
+
+def update_timestamp(path: str, mtime: float, updated_at: str):
+    conn = _get_conn()
+    with _lock, conn:
+        conn.execute("UPDATE files SET mtime = ?, updated_at = ? WHERE path = ?", (mtime, updated_at, path))
+
+
+def delete_tree(path: str) -> List[str]:
+    """Removes a path and everything under it. Returns the removed paths."""
+    low, high = _subtree_bounds(path)
+    conn = _get_conn()
+    with _lock, conn:
+        removed = [row[0] for row in conn.execute(
+            "SELECT path FROM files WHERE path = ? OR (path >= ? AND path < ?)", (path, low, high)
+        )]
+        conn.execute("DELETE FROM files WHERE path = ? OR (path >= ? AND path < ?)", (path, low, high))
+    return removed
+
+
+def get_entry(path: str) -> Optional[Dict[str, Any]]:
+    conn = _get_conn()
+    with _lock:
+        row = conn.execute(
+            "SELECT mtime, updated_at, size, total_chunks, fingerprint, COALESCE(file_id, path) FROM files WHERE path = ?",
+            (path,)
+        ).fetchone()
+    if row is None:
+        return None
+    return {
+        "mtime": row[0], "updated_at": row[1], "size": row[2],
+        "total_chunks": row[3], "fingerprint": row[4], "file_id": row[5],
+    }
+
+
+def get_file_ids(paths: List[str]) -> Dict[str, str]:
+    """
+    Returns {path: file_id} for the indexed paths among paths.
+    Files indexed before stable ids use their path as id (their point ids were derived from it).
+    """
+    found: Dict[str, str] = {}
+    unique_paths = list(dict.fromkeys(paths))
+    conn = _get_conn()
+    with _lock:
+        for i in range(0, len(unique_paths), 500):
+            batch = unique_paths[i:i + 500]
+            rows = conn.execute(
+                f"SELECT path, COALESCE(file_id, path) FROM files WHERE path IN ({','.join('?' * len(batch))})",
+                batch,
+            ).fetchall()
+            found.update(rows)
+    return found
+
+
+def get_tree(path: str) -> List[Tuple[str, str, int]]:
+    """Returns (path, file_id, total_chunks) for a path and everything under it."""
+    low, high = _subtree_bounds(path)
+    conn = _get_conn()
+    with _lock:
+        return conn.execute(
+            "SELECT path, COALESCE(file_id, path), total_chunks FROM files WHERE path = ? OR (path >= ? AND path < ?)",
+            (path, low, high)
+        ).fetchall()
+
+
+def move_tree(src: str, dest: str):
+    """Re-keys a path and everything under it from src to dest."""
+    low, high = _subtree_bounds(src)
+    conn = _get_conn()
+    with _lock, conn:
+        conn.execute(
+            "UPDATE files SET path = ? || substr(path, ?) WHERE path = ? OR (path >= ? AND path < ?)",
+            (dest, len(src) + 1, src, low, high)
+        )
+
+
+def get_all() -> Dict[str, Dict[str, Any]]:
+    """Returns {path: {updated_at, total_chunks, fingerprint}} for every indexed file."""
+    conn = _get_conn()
+    with _lock:
+        rows = conn.execute("SELECT path, updated_at, total_chunks, fingerprint FROM files").fetchall()
+    return {
+        row[0]: {"updated_at": row[1], "total_chunks": row[2], "fingerprint": row[3]}
+        for row in rows
+    }
+
+
+def get_file_id_map() -> Dict[str, str]:
+    """Returns {path: file_id} for every indexed file."""
+    conn = _get_conn()
+    with _lock:
+        return dict(conn.execute("SELECT path, COALESCE(file_id, path) FROM files").fetchall())
+
+
+def filter_file_ids(file_types: Optional[List[str]] = None, path_prefix: Optional[str] = None,
+                    size_range: Tuple[Optional[int], Optional[int]] = (None, None),
+                    modified_range: Tuple[Optional[float], Optional[float]] = (None, None),
+                    created_range: Tuple[Optional[float], Optional[float]] = (None, None)) -> List[str]:
+    """
+    Returns the file ids of indexed files matching every given condition: a MIME type among
+    file_types, the path itself or anything under it, and inclusive (low, high) ranges where
+    None leaves that end open. Mirrors local_db.build_search_filter() on the manifest columns.
+    """
+    clauses: List[str] = []
+    params: List[Any] = []
+    if file_types:
+        clauses.append(f"file_type IN ({','.join('?' * len(file_types))})")
+        params.extend(file_types)
+    if path_prefix:
+        low, high = _subtree_bounds(path_prefix)
+        clauses.append("(path = ? OR (path >= ? AND path < ?))")
+        params.extend((path_prefix, low, high))
+    for column, (low, high) in (("size", size_range), ("mtime", modified_range), ("created_ts", created_range)):
+        if low is not None:
+            clauses.append(f"COALESCE({column}, 0) >= ?")
+            params.append(low)
+        if high is not None:
+            clauses.append(f"COALESCE({column}, 0) <= ?")
+            params.append(high)
+    where = f" WHERE {' AND '.join(clauses)}" if clauses else ""
+    conn = _get_conn()
+    with _lock:
+        return [row[0] for row in conn.execute(f"SELECT COALESCE(file_id, path) FROM files{where}", params)]
+
+
+def total_chunks() -> int:
+    """Sum of chunk counts over all files: the number of points the collection should hold."""
+    conn = _get_conn()
+    with _lock:
+        return conn.execute("SELECT COALESCE(SUM(total_chunks), 0) FROM files").fetchone()[0]
+
+
+def replace_all(rows: List[ManifestRow]):
+    """Replaces the whole manifest in one transaction (used when repairing from the collection)."""
+    conn = _get_conn()
+    with _lock, conn:
+        conn.execute("DELETE FROM files")
+        conn.executemany(
+            f"INSERT OR REPLACE INTO files ({_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            rows,
+        )
+
+
+def get_meta(key: str, default: Optional[str] = None) -> Optional[str]:
+    conn = _get_conn()
+    with _lock:
+        row = conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else default
+
+
+def set_meta(key: str, value: str):
+    conn = _get_conn()
+    with _lock, conn:
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
@@ -0,0 +1,152 @@
+import os
+import threading
+from typing import Dict, List, Optional, Set, Tuple
+
+import manifest
+
+# Shortest query token looked up in the trigram index (shorter tokens only filter by path)
+MIN_TOKEN_LENGTH = 3
+
+
+def _trigrams(text: str) -> Set[str]:
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def _name_score(name: str, query: str, tokens: List[str]) -> float:
+    """Match quality in (0, 1]: exact name > name prefix > all tokens in the name > tokens spread over the path."""
+    stem = os.path.splitext(name)[0]
+    if name == query or stem == query:
+        return 1.0
+    if name.startswith(query):
+        return 0.9
+    if all(t in name for t in tokens):
+        return 0.75 if query in name else 0.7
+    return 0.5
+
+
+class NameIndex:
+    """
+    In-memory trigram index over the basenames of indexed paths, answering filename
+    lookups without running the model. Built from the manifest on first use and kept
+    current by local_db as files are written, deleted and moved.
+    """
+
+    def __init__(self):
+        self._paths: List[Optional[str]] = []
+        self._names: List[str] = []  # lowercased basenames
+        self._file_ids: List[str] = []
+        self._ids: Dict[str, int] = {}  # path -> slot
+        self._free: List[int] = []
+        self._grams: Dict[str, Set[int]] = {}
+        self._lock = threading.Lock()
+        self._is_loaded = False
+
+    def load_if_needed(self):
+        if self._is_loaded:
+            return
+        with self._lock:
+            if self._is_loaded:
+                return
+            for path, file_id in manifest.get_file_id_map().items():
+                self._add_unlocked(path, file_id)
+            self._is_loaded = True
+            print(f"Filename index built over {len(self._ids)} paths.")
+
+    def _add_unlocked(self, path: str, file_id: str):
+        if path in self._ids:
+            self._file_ids[self._ids[path]] = file_id
+            return
+        name = (os.path.basename(path) or path).lower()
+        if self._free:
+            slot = self._free.pop()
+            self._paths[slot], self._names[slot], self._file_ids[slot] = path, name, file_id
+        else:
+            slot = len(self._paths)
+            self._paths.append(path)
+            self._names.append(name)
+            self._file_ids.append(file_id)
+        self._ids[path] = slot
+        for gram in _trigrams(name):
+            self._grams.setdefault(gram, set()).add(slot)
+
+    def _remove_unlocked(self, path: str):
+        slot = self._ids.pop(path, None)
+        if slot is None:
+            return
+        for gram in _trigrams(self._names[slot]):
+            postings = self._grams.get(gram)
+            if postings is not None:
+                postings.discard(slot)
+                if not postings:
+                    del self._grams[gram]
+        self._paths[slot] = None
+        self._names[slot] = ""
+        self._free.append(slot)
+
+    def _subtree_unlocked(self, path: str) -> List[str]:
+        prefix = path if path.endswith("/") else path + "/"
+        return [p for p in self._ids if p == path or p.startswith(prefix)]
+
+    # Updates are no-ops until the index is loaded: loading reads the manifest, which is written first
+
+    def add(self, entries: List[Tuple[str, str]]):
+        """Adds or updates (path, file_id) entries."""
+        with self._lock:
+            if self._is_loaded:
+                for path, file_id in entries:
+                    self._add_unlocked(path, file_id)
+
+    def delete_tree(self, path: str):
+        with self._lock:
+            if self._is_loaded:
+                for p in self._subtree_unlocked(path):
+                    self._remove_unlocked(p)
+
+    def move_tree(self, src: str, dest: str):
+        with self._lock:
+            if self._is_loaded:
+                moved = [(p, self._file_ids[self._ids[p]]) for p in self._subtree_unlocked(src)]
+                for p, _ in moved:
+                    self._remove_unlocked(p)
+                for p, file_id in moved:
+                    self._add_unlocked(dest + p[len(src):], file_id)
+
+    def search(self, query: str, limit: int = 20) -> List[Tuple[str, str, float]]:
+        """
+        Returns up to limit (path, file_id, score) name matches. At least one query token
+        must occur in the basename and every token must occur somewhere in the path.
+        """
+        tokens = query.lower().split()
+        keys = [t for t in dict.fromkeys(tokens) if len(t) >= MIN_TOKEN_LENGTH]
+        if not keys:
+            return []
+        self.load_if_needed()
+        normalized = " ".join(tokens)
+
+        hits = []
+        with self._lock:
+            candidates: Set[int] = set()
+            for key in keys:
+                postings = sorted((self._grams.get(g, set()) for g in _trigrams(key)), key=len)
+                if postings[0]:
+                    # Trigrams can match out of order, so confirm the substring
+                    candidates.update(
+                        slot for slot in postings[0].intersection(*postings[1:]) if key in self._names[slot]
+                    )
+            for slot in candidates:
+                name, path = self._names[slot], self._paths[slot]
+                if len(tokens) > 1:
+                    lower_path = path.lower()
+                    if any(t not in lower_path for t in tokens):
+                        continue
+                hits.append((path, self._file_ids[slot], _name_score(name, normalized, tokens), len(name)))
+        # Better matches first, then shorter names (closer to the query)
+        hits.sort(key=lambda h: (-h[2], h[3]))
+        return [(path, file_id, score) for path, file_id, score, _ in hits[:limit]]
+
+    def stats(self):
+        return {"paths": len(self._ids), "trigrams": len(self._grams), "loaded": self._is_loaded}
+
+
+# Global thread-safe singleton
+name_index = NameIndex()
@@ -14,6 +14,8 @@ import docx
 from python_calamine import CalamineWorkbook
 from pptx import Presentation
 
+from util import file_fingerprint, stat_fingerprint
+
 # ---------------------------------------------------------------------------
 # Junk extension blacklist — files that should never be indexed
 # ---------------------------------------------------------------------------
@@ -116,6 +118,8 @@ class ParsedDocument:
     dense_vectors: Dict[str, List[float]] = field(default_factory=dict)
     sparse_vectors: Dict[str, Dict[int, float]] = field(default_factory=dict)
     metadata: Dict[str, Any] = field(default_factory=dict)
+    fingerprint: Optional[str] = None
+    name_only: bool = False  # text_content is just the name (directories, metadata-only files)
 
 class BaseParser(ABC):
     @abstractmethod
@@ -312,7 +316,8 @@ class DirectoryParser(BaseParser):
             size=0,
             created_at=datetime.fromtimestamp(stats.st_ctime).isoformat(),
             updated_at=datetime.fromtimestamp(stats.st_mtime).isoformat(),
-            text_content=name
+            text_content=name,
+            name_only=True
         )
 
 class MetadataOnlyParser(BaseParser):
@@ -336,10 +341,40 @@ class MetadataOnlyParser(BaseParser):
             size=stats.st_size,
             created_at=datetime.fromtimestamp(stats.st_ctime).isoformat(),
             updated_at=datetime.fromtimestamp(stats.st_mtime).isoformat(),
-            text_content=name  # Index just the filename so it's searchable
+            text_content=name,  # Index just the filename so it's searchable
+            name_only=True
         )
 
 def parse_file(path: str, preview_mode: bool = False) -> Optional[ParsedDocument]:
+    """
+    Parses a file and, outside preview mode, attaches its fingerprint. Name-only documents
+    (directories, metadata-only files) get a size+mtime fingerprint without reading any bytes.
+    Content is hashed after parsing and only kept if size and mtime are the same as before the
+    parse: a fingerprint of newer bytes than the parsed text would hide the change from later syncs.
+    """
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"File {path} does not exist.")
+    stats = os.stat(path)
+    doc = _parse_tiers(path, stats, preview_mode)
+    if doc is None or preview_mode:
+        return doc
+    if doc.name_only:
+        doc.fingerprint = stat_fingerprint(stats)
+        return doc
+    try:
+        fingerprint = file_fingerprint(path, stats.st_size)
+        after = os.stat(path)
+    except OSError as e:
+        print(f"Could not fingerprint {path} ({e})", file=sys.stderr)
+        return doc
+    if (after.st_size, after.st_mtime_ns) == (stats.st_size, stats.st_mtime_ns):
+        doc.fingerprint = fingerprint
+    else:
+        # No fingerprint: the next sync or watcher check re-indexes the file
+        print(f"{path} changed while being parsed, not fingerprinting it", file=sys.stderr)
+    return doc
+
+def _parse_tiers(path: str, stats: os.stat_result, preview_mode: bool = False) -> Optional[ParsedDocument]:
     """Tiered indexing pipeline:
     1. Directories → DirectoryParser
     2. Junk blacklist → skip (returns None)
@@ -347,11 +382,6 @@ def parse_file(path: str, preview_mode: bool = False) -> Optional[ParsedDocument
     4. UTF-8 text fallback → index as plain text
     5. Metadata-only → index name/path only
     """
-    if not os.path.exists(path):
-        raise FileNotFoundError(f"File {path} does not exist.")
-        
-    stats = os.stat(path)
-    
     # Tier: Directories
     if os.path.isdir(path):
         return DirectoryParser().parse(path, stats, preview_mode)
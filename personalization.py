@@ -0,0 +1,144 @@
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from path_env import DB_DIR
+
+STORE_PATH = os.path.join(DB_DIR, "personalization.sqlite")
+# How often pending click statistics are written behind to SQLite
+FLUSH_INTERVAL = float(os.getenv("PERSONALIZATION_FLUSH_INTERVAL", "2.0"))
+
+
+class PersonalizationStore:
+    """
+    Click/open statistics per path, served from memory and written behind to SQLite.
+    Recording an open is an O(1) dict update; a background thread persists dirty paths.
+    """
+
+    def __init__(self, path: str = STORE_PATH):
+        self._path = path
+        self._stats: Dict[str, Tuple[int, float]] = {}  # path -> (open_count, last_opened_ts)
+        self._dirty: set[str] = set()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._flusher: Optional[threading.Thread] = None
+        self._is_loaded = False
+
+    def load_if_needed(self):
+        if self._is_loaded:
+            return
+        with self._lock:
+            if self._is_loaded:
+                return
+            os.makedirs(os.path.dirname(self._path), exist_ok=True)
+            conn = sqlite3.connect(self._path, timeout=10, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL;")
+            with conn:
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS opens (
+                        path TEXT PRIMARY KEY,
+                        open_count INTEGER,
+                        last_opened_at REAL
+                    )
+                """)
+            self._stats = {row[0]: (row[1], row[2]) for row in conn.execute(
+                "SELECT path, open_count, last_opened_at FROM opens"
+            )}
+            self._conn = conn
+            self._is_loaded = True
+            self._flusher = threading.Thread(target=self._flush_loop, daemon=True)
+            self._flusher.start()
+
+    def import_if_new(self, load_existing):
+        """
+        One-time import of statistics previously stored on chunk payloads.
+        load_existing() returns {path: (open_count, last_opened_ts)}.
+        """
+        self.load_if_needed()
+        if self._conn.execute("PRAGMA user_version").fetchone()[0] >= 1:
+            return
+        imported = load_existing()
+        with self._lock:
+            for p, stats in imported.items():
+                self._stats.setdefault(p, stats)
+                self._dirty.add(p)
+        self.flush()
+        with self._conn:
+            self._conn.execute("PRAGMA user_version = 1")
+        if imported:
+            print(f"Imported click statistics of {len(imported)} files.")
+
+    def record_open(self, path: str, opened_at: Optional[float] = None):
+        self.load_if_needed()
+        with self._lock:
+            open_count, _ = self._stats.get(path, (0, None))
+            self._stats[path] = (open_count + 1, opened_at if opened_at is not None else time.time())
+            self._dirty.add(path)
+
+    def get_many(self, paths: List[str]) -> Dict[str, Tuple[int, float]]:
+        """Returns {path: (open_count, last_opened_ts)} for the paths that have been opened."""
+        self.load_if_needed()
+        # Watcher threads delete and move keys under the lock, so look them up under it too
+        with self._lock:
+            stats = self._stats
+            return {p: stats[p] for p in paths if p in stats}
+
+    def _subtree(self, path: str) -> List[str]:
+        prefix = path if path.endswith("/") else path + "/"
+        return [p for p in self._stats if p == path or p.startswith(prefix)]
+
+    def delete_tree(self, path: str):
+        self.load_if_needed()
+        with self._lock:
+            for p in self._subtree(path):
+                del self._stats[p]
+                self._dirty.add(p)
+
+    def move_tree(self, src: str, dest: str):
+        self.load_if_needed()
+        with self._lock:
+            for p in self._subtree(src):
+                new_path = dest + p[len(src):]
+                self._stats[new_path] = self._stats.pop(p)
+                self._dirty.add(p)
+                self._dirty.add(new_path)
+
+    def flush(self):
+        """Writes all pending changes to SQLite in one transaction."""
+        if not self._is_loaded:
+            return
+        with self._flush_lock:
+            with self._lock:
+                dirty, self._dirty = self._dirty, set()
+                upserts = [(p, *self._stats[p]) for p in dirty if p in self._stats]
+                deletes = [(p,) for p in dirty if p not in self._stats]
+            if not dirty:
+                return
+            try:
+                with self._conn:
+                    self._conn.executemany("DELETE FROM opens WHERE path = ?", deletes)
+                    self._conn.executemany(
+                        "INSERT OR REPLACE INTO opens (path, open_count, last_opened_at) VALUES (?, ?, ?)",
+                        upserts,
+                    )
+            except Exception as e:
+                print(f"Error flushing click statistics: {e}")
+                with self._lock:
+                    self._dirty |= dirty
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(FLUSH_INTERVAL)
+            self.flush()
+
+
+def to_iso(ts: Optional[float]) -> Optional[str]:
+    return datetime.fromtimestamp(ts).isoformat() if ts else None
+
+
+# Global thread-safe singleton
+personalization_store = PersonalizationStore()
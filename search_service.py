@@ -0,0 +1,308 @@
+import os
+import json
+import asyncio
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+import splade_encoder
+import local_db
+
+# Search concurrency settings (can be customized via environment variables)
+SEARCH_WORKERS = int(os.getenv("SEARCH_WORKERS", "4"))  # Threads running spelling + encode + retrieval
+SEARCH_MAX_PENDING = int(os.getenv("SEARCH_MAX_PENDING", "16"))  # Queued + running searches before rejecting
+SEARCH_TIMEOUT = float(os.getenv("SEARCH_TIMEOUT", "10"))  # Seconds a request waits for its result
+QUERY_BATCH_WINDOW_MS = float(os.getenv("QUERY_BATCH_WINDOW_MS", "3"))  # Max wait for more queries to join a batch
+MAX_SEARCH_SESSIONS = 1024  # Sessions whose latest sequence number is remembered for supersession
+QUERY_BATCH_MAX = int(os.getenv("QUERY_BATCH_MAX", "16"))  # Max queries encoded in one ONNX run
+QUERY_VECTOR_CACHE_SIZE = int(os.getenv("QUERY_VECTOR_CACHE_SIZE", "2048"))  # Corrected query -> sparse vector
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", "256"))  # Query + filters + limit -> ranked results
+NAME_MATCH_WEIGHT = float(os.getenv("NAME_MATCH_WEIGHT", "1.5"))  # Weight of filename matches vs. content matches
+
+# Reciprocal rank fusion constant: higher values flatten the advantage of top ranks
+_RRF_K = 10
+
+
+def merge_results(name_results: List[Dict[str, Any]], semantic_results: List[Dict[str, Any]],
+                  limit: int) -> List[Dict[str, Any]]:
+    """
+    Reciprocal rank fusion of filename matches and SPLADE results, deduplicated by path.
+    Name matches contribute in proportion to their raw match quality (name_score), ranked by it too,
+    so an exact filename leads; personalization only acts through the semantic results' ranking.
+    Returned results carry the fused value as their score (copies: the inputs may be cached).
+    """
+    fused: Dict[str, list] = {}
+    for rank, r in enumerate(semantic_results):
+        fused[r["path"]] = [1.0 / (_RRF_K + rank + 1), r]
+    for rank, r in enumerate(sorted(name_results, key=lambda r: -r["name_score"])):
+        weight = NAME_MATCH_WEIGHT * min(1.0, r["name_score"])
+        entry = fused.setdefault(r["path"], [0.0, r])
+        entry[0] += weight / (_RRF_K + rank + 1)
+    ordered = sorted(fused.values(), key=lambda e: -e[0])
+    return [{**r, "score": score} for score, r in ordered[:limit]]
+
+
+class LRUCache:
+    """Thread-safe bounded mapping that evicts the least recently used entry and counts hits."""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._data: "OrderedDict[Any, Any]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._data),
+            "max_entries": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+class _QueuedQuery:
+    __slots__ = ("text", "enqueued_at", "done", "lead", "result", "error")
+
+    def __init__(self, text: str):
+        self.text = text
+        self.enqueued_at = time.monotonic()
+        self.done = threading.Event()
+        self.lead = False
+        self.result: Optional[Dict[int, float]] = None
+        self.error: Optional[BaseException] = None
+
+
+class QueryBatcher:
+    """
+    Coalesces concurrent query encodings into batched ONNX runs.
+    A query arriving while the encoder is idle runs immediately, so a lone query pays no extra latency.
+    Queries arriving while a run is in progress queue up; when it finishes, the oldest queued query's
+    thread becomes the next leader, waits up to window_ms (from the oldest enqueue) for the batch
+    to fill to max_batch, then encodes the whole batch and hands the results back.
+    """
+
+    def __init__(self, window_ms: float = QUERY_BATCH_WINDOW_MS, max_batch: int = QUERY_BATCH_MAX):
+        self.window = window_ms / 1000.0
+        self.max_batch = max_batch
+        self.batches = 0
+        self.queries = 0
+        self._queue: List[_QueuedQuery] = []
+        self._busy = False
+        self._lock = threading.Lock()
+        # Signalled on every enqueue, so a leader collecting a batch wakes as soon as it could fill
+        self._enqueued = threading.Condition(self._lock)
+
+    def encode(self, text: str) -> Dict[int, float]:
+        if not text.strip():
+            return {}
+        request = _QueuedQuery(text)
+        with self._lock:
+            self._queue.append(request)
+            if not self._busy:
+                self._busy = True
+                request.lead = True
+            else:
+                self._enqueued.notify()
+        if not request.lead:
+            request.done.wait()
+        if request.lead:
+            self._run_batch(idle_start=not request.done.is_set())
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def _run_batch(self, idle_start: bool):
+        """Encodes one batch as leader, then passes leadership to the oldest queued query."""
+        with self._lock:
+            if not idle_start:
+                # Promoted leader: give concurrent keystrokes a brief chance to join
+                deadline = self._queue[0].enqueued_at + self.window
+                while len(self._queue) < self.max_batch:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._enqueued.wait(remaining)
+            batch, self._queue = self._queue[:self.max_batch], self._queue[self.max_batch:]
+        try:
+            vectors = splade_encoder.encode_batch([q.text for q in batch], batch_size=len(batch))
+            for q, vec in zip(batch, vectors):
+                q.result = vec
+        except Exception as e:
+            for q in batch:
+                q.error = e
+        with self._lock:
+            self.batches += 1
+            self.queries += len(batch)
+            if self._queue:
+                self._queue[0].lead = True
+                self._queue[0].done.set()
+            else:
+                self._busy = False
+        for q in batch:
+            q.done.set()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "window_ms": self.window * 1000.0,
+            "max_batch": self.max_batch,
+            "batches": self.batches,
+            "avg_batch_size": self.queries / self.batches if self.batches else 0.0,
+        }
+
+
+class SearchOverloaded(Exception):
+    """Raised when more than max_pending searches are already queued or running."""
+
+
+class SearchSuperseded(Exception):
+    """Raised when a newer query of the same session arrived before this one finished."""
+
+
+class SearchService:
+    """
+    Runs the search pipeline (spelling correction, SPLADE query encoding, retrieval + re-ranking)
+    on a dedicated bounded thread pool so it never blocks the API event loop.
+    """
+
+    def __init__(self, workers: int = SEARCH_WORKERS, max_pending: int = SEARCH_MAX_PENDING,
+                 timeout: float = SEARCH_TIMEOUT):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="search")
+        self._pending = 0
+        self._lock = threading.Lock()
+        self.batcher = QueryBatcher()
+        # Vectors depend only on the (fixed) model; results are keyed by index generation as well
+        self.vector_cache = LRUCache(QUERY_VECTOR_CACHE_SIZE)
+        self.result_cache = LRUCache(RESULT_CACHE_SIZE)
+        self.superseded = 0
+        self._latest_seq: "OrderedDict[str, int]" = OrderedDict()  # session_id -> newest seq seen
+
+    def _register(self, session_id: Optional[str], seq: Optional[int]):
+        """Records seq as the newest query of its session. Raises SearchSuperseded if a newer one exists."""
+        if session_id is None or seq is None:
+            return
+        with self._lock:
+            latest = self._latest_seq.get(session_id)
+            if latest is not None and seq < latest:
+                self.superseded += 1
+                raise SearchSuperseded(f"query {seq} of session {session_id} superseded by {latest}")
+            self._latest_seq[session_id] = seq
+            self._latest_seq.move_to_end(session_id)
+            while len(self._latest_seq) > MAX_SEARCH_SESSIONS:
+                self._latest_seq.popitem(last=False)
+
+    def _check_current(self, session_id: Optional[str], seq: Optional[int]):
+        if session_id is None or seq is None:
+            return
+        if self._latest_seq.get(session_id, seq) > seq:
+            with self._lock:
+                self.superseded += 1
+            raise SearchSuperseded(f"query {seq} of session {session_id} superseded")
+
+    def run_search(self, query: str, limit: int, filters: Optional[Dict[str, Any]] = None,
+                   session_id: Optional[str] = None, seq: Optional[int] = None) -> Dict[str, Any]:
+        """
+        The synchronous search pipeline, run as interactive work (bulk indexing yields to it).
+        Queries of a session that a newer query has superseded are dropped before each expensive stage.
+        """
+        with splade_encoder.interactive():
+            return self._run_search(query, limit, filters, session_id, seq)
+
+    def _run_search(self, query: str, limit: int, filters: Optional[Dict[str, Any]],
+                    session_id: Optional[str], seq: Optional[int]) -> Dict[str, Any]:
+        generation = local_db.get_index_generation()
+        result_key = (generation, query, limit, json.dumps(filters, sort_keys=True) if filters else None)
+        cached = self.result_cache.get(result_key)
+        if cached is not None:
+            return cached
+
+        # Correct spelling typos in the query using spelling_service
+        from spelling_service import spelling_service
+        self._check_current(session_id, seq)
+        corrected_query = spelling_service.correct_query(query)
+
+        # Generate SPLADE sparse vector representation of query, batched with concurrent searches
+        sparse_query = self.vector_cache.get(corrected_query)
+        if sparse_query is None:
+            self._check_current(session_id, seq)
+            sparse_query = self.batcher.encode(corrected_query)
+            self.vector_cache.put(corrected_query, sparse_query)
+
+        # Search Qdrant and apply personalized re-ranking, then fold in filename matches
+        self._check_current(session_id, seq)
+        results = local_db.search_documents(sparse_query, limit=limit, filters=filters)
+        results = merge_results(self.search_names(query, limit, filters), results, limit)
+        response = {"results": results, "corrected_query": corrected_query}
+        # Keyed by the generation read before searching, so a concurrent write leaves it unreachable
+        self.result_cache.put(result_key, response)
+        return response
+
+    def search_names(self, query: str, limit: int, filters: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+        """Filename matches only: no spelling correction or model inference. Blocking (payloads come from the collection)."""
+        try:
+            return local_db.search_names(query, limit=limit, filters=filters)
+        except Exception as e:
+            print(f"Error searching file names: {e}")
+            return []
+
+    def _release(self, _future):
+        with self._lock:
+            self._pending -= 1
+
+    async def search(self, query: str, limit: int, filters: Optional[Dict[str, Any]] = None,
+                     session_id: Optional[str] = None, seq: Optional[int] = None) -> Dict[str, Any]:
+        """
+        Runs a search on the inference pool.
+        Raises SearchOverloaded when the queue is full, asyncio.TimeoutError after timeout seconds
+        and SearchSuperseded when a query with a higher seq arrives for the same session_id.
+        """
+        self._register(session_id, seq)
+        with self._lock:
+            if self._pending >= self.max_pending:
+                raise SearchOverloaded(f"{self._pending} searches already pending")
+            self._pending += 1
+        future = self._executor.submit(self.run_search, query, limit, filters, session_id, seq)
+        # A timed-out search keeps its slot until its worker actually finishes
+        future.add_done_callback(self._release)
+        return await asyncio.wait_for(asyncio.wrap_future(future), timeout=self.timeout)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "workers": self.workers,
+            "max_pending": self.max_pending,
+            "timeout": self.timeout,
+            "pending": self._pending,
+            "superseded": self.superseded,
+            "batching": self.batcher.stats(),
+            "query_vector_cache": self.vector_cache.stats(),
+            "result_cache": self.result_cache.stats(),
+        }
+
+
+# Global singleton
+search_service = SearchService()
@@ -0,0 +1,604 @@
+import os
+import json
+import heapq
+import math
+import shutil
+import threading
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+import numpy as np
+
+# Points buffered in memory before they are written out as a new segment
+FLUSH_POINTS = int(os.getenv("SPARSE_INDEX_FLUSH_POINTS", "4096"))
+# Segments of similar size (one size tier) merged together once there are this many of them
+MERGE_FACTOR = int(os.getenv("SPARSE_INDEX_MERGE_FACTOR", "4"))
+# Live points merged per lock acquisition when pointing them at a merged segment
+_REMAP_BATCH = 20000
+
+# Weights are stored as uint8 levels of each term's maximum weight
+_QUANT_LEVELS = 255
+
+# (point_id, file_id, sparse vector)
+IndexedPoint = Tuple[str, str, Dict[int, float]]
+
+
+def _atomic_save(path: str, array: np.ndarray):
+    tmp = path + ".tmp.npy"
+    np.save(tmp, array)
+    os.replace(tmp, path)
+
+
+class _Segment:
+    """
+    Immutable on-disk segment: posting lists in CSR layout keyed by SPLADE token id.
+    The posting arrays are memory-mapped; only the term directory and the deletion mask are in RAM.
+    Deletions never rewrite a segment, they only flip its deletion mask.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.name = os.path.basename(path)
+        self.terms = np.load(os.path.join(path, "terms.npy"))  # sorted term ids
+        self.offsets = np.load(os.path.join(path, "offsets.npy"))  # len(terms) + 1
+        self.max_weights = np.load(os.path.join(path, "max_weights.npy"))  # per-term upper bound
+        self.post_docs = np.load(os.path.join(path, "post_docs.npy"), mmap_mode="r")
+        self.post_weights = np.load(os.path.join(path, "post_weights.npy"), mmap_mode="r")
+        self.doc_files = np.load(os.path.join(path, "doc_files.npy"))  # doc ordinal -> file ordinal
+        with open(os.path.join(path, "docs.json")) as f:
+            docs = json.load(f)
+        self.point_ids: List[str] = docs["point_ids"]
+        self.file_ids: List[str] = docs["file_ids"]
+        deleted_path = os.path.join(path, "deleted.npy")
+        self.deleted = np.load(deleted_path) if os.path.exists(deleted_path) \
+            else np.zeros(len(self.point_ids), dtype=bool)
+        self.dirty = False
+        self.global_files: Optional[np.ndarray] = None  # file ordinal -> index-wide file ordinal
+
+    @property
+    def num_docs(self) -> int:
+        return len(self.point_ids)
+
+    @property
+    def live_docs(self) -> int:
+        return int(self.num_docs - self.deleted.sum())
+
+    @staticmethod
+    def write(path: str, points: List[IndexedPoint]) -> "_Segment":
+        """Builds a segment from points and writes it atomically (to a temporary directory, then renamed)."""
+        file_ordinals: Dict[str, int] = {}
+        doc_files = np.fromiter(
+            (file_ordinals.setdefault(file_id, len(file_ordinals)) for _, file_id, _ in points),
+            dtype=np.int32, count=len(points)
+        )
+        lengths = np.fromiter((len(vec) for _, _, vec in points), dtype=np.int64, count=len(points))
+        total = int(lengths.sum())
+        terms = np.fromiter((t for _, _, vec in points for t in vec.keys()), dtype=np.int32, count=total)
+        weights = np.fromiter((w for _, _, vec in points for w in vec.values()), dtype=np.float32, count=total)
+        docs = np.repeat(np.arange(len(points), dtype=np.uint32), lengths)
+        return _Segment._write_postings(path, terms, docs, weights, doc_files,
+                                        [p for p, _, _ in points], list(file_ordinals))
+
+    @staticmethod
+    def merge(path: str, segments: List["_Segment"], deleted: List[np.ndarray]) -> Tuple["_Segment", List[np.ndarray]]:
+        """
+        Writes the points of segments that are live in the given deletion masks as one new segment,
+        concatenating their posting arrays (no per-point decoding).
+        Returns the segment and, per source segment, the new ordinal of each of its docs (-1 if dropped).
+        """
+        parts_terms, parts_docs, parts_weights, parts_files = [], [], [], []
+        point_ids: List[str] = []
+        file_ordinals: Dict[str, int] = {}
+        ordinal_maps = []
+        base = 0
+        for segment, dead in zip(segments, deleted):
+            live = ~dead
+            ordinals = np.where(live, np.cumsum(live) - 1 + base, -1)
+            ordinal_maps.append(ordinals)
+            counts = np.diff(segment.offsets)
+            docs = np.asarray(segment.post_docs)
+            keep = live[docs]
+            parts_terms.append(np.repeat(segment.terms, counts)[keep])
+            parts_docs.append(ordinals[docs[keep]].astype(np.uint32))
+            parts_weights.append(
+                (np.asarray(segment.post_weights, dtype=np.float32)
+                 * np.repeat(segment.max_weights / _QUANT_LEVELS, counts))[keep]
+            )
+            file_map = np.array([file_ordinals.setdefault(f, len(file_ordinals)) for f in segment.file_ids],
+                                dtype=np.int32)
+            live_docs = np.flatnonzero(live)
+            parts_files.append(file_map[segment.doc_files[live_docs]])
+            point_ids.extend(segment.point_ids[d] for d in live_docs.tolist())
+            base += len(live_docs)
+        merged = _Segment._write_postings(
+            path, np.concatenate(parts_terms), np.concatenate(parts_docs), np.concatenate(parts_weights),
+            np.concatenate(parts_files), point_ids, list(file_ordinals)
+        )
+        return merged, ordinal_maps
+
+    @staticmethod
+    def _write_postings(path: str, terms: np.ndarray, docs: np.ndarray, weights: np.ndarray,
+                        doc_files: np.ndarray, point_ids: List[str], file_ids: List[str]) -> "_Segment":
+        tmp = path + ".tmp"
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        total = len(terms)
+
+        # Group postings by term, doc ordinals ascending within each list
+        order = np.lexsort((docs, terms))
+        terms, docs, weights = terms[order], docs[order], weights[order]
+        unique_terms, starts = np.unique(terms, return_index=True)
+        offsets = np.append(starts, total).astype(np.int64)
+        if total:
+            max_weights = np.maximum.reduceat(weights, starts).astype(np.float32)
+            scale = np.repeat(max_weights, np.diff(offsets))
+            levels = np.clip(np.rint(weights / scale * _QUANT_LEVELS), 1, _QUANT_LEVELS).astype(np.uint8)
+        else:
+            max_weights = np.zeros(0, dtype=np.float32)
+            levels = np.zeros(0, dtype=np.uint8)
+
+        np.save(os.path.join(tmp, "terms.npy"), unique_terms.astype(np.int32))
+        np.save(os.path.join(tmp, "offsets.npy"), offsets)
+        np.save(os.path.join(tmp, "max_weights.npy"), max_weights)
+        np.save(os.path.join(tmp, "post_docs.npy"), docs.astype(np.uint32))
+        np.save(os.path.join(tmp, "post_weights.npy"), levels)
+        np.save(os.path.join(tmp, "doc_files.npy"), doc_files.astype(np.int32))
+        with open(os.path.join(tmp, "docs.json"), "w") as f:
+            json.dump({"point_ids": point_ids, "file_ids": file_ids}, f)
+        os.replace(tmp, path)
+        return _Segment(path)
+
+    def postings(self, term: int) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        """Returns (doc ordinals, dequantized weights) of a term, or None if it does not occur."""
+        i = np.searchsorted(self.terms, term)
+        if i >= len(self.terms) or self.terms[i] != term:
+            return None
+        start, end = self.offsets[i], self.offsets[i + 1]
+        scale = self.max_weights[i] / _QUANT_LEVELS
+        return np.asarray(self.post_docs[start:end]), self.post_weights[start:end] * scale
+
+    def upper_bound(self, term: int) -> float:
+        i = np.searchsorted(self.terms, term)
+        if i >= len(self.terms) or self.terms[i] != term:
+            return 0.0
+        return float(self.max_weights[i])
+
+    def save_deleted(self):
+        if self.dirty:
+            _atomic_save(os.path.join(self.path, "deleted.npy"), self.deleted)
+            self.dirty = False
+
+    def _term_range(self, term: int) -> Optional[Tuple[int, int, float]]:
+        """Returns (start, end, dequantization scale) of a term's posting list, or None."""
+        i = np.searchsorted(self.terms, term)
+        if i >= len(self.terms) or self.terms[i] != term:
+            return None
+        return int(self.offsets[i]), int(self.offsets[i + 1]), float(self.max_weights[i]) / _QUANT_LEVELS
+
+    def _offer(self, heap: "_TopFiles", excluded: np.ndarray, docs: np.ndarray, scores: np.ndarray):
+        """Feeds the best partial scores among docs to the top-k heap (a subset keeps theta a lower bound)."""
+        improved = np.flatnonzero(scores > heap.theta)
+        if len(improved) > 4 * heap.k:
+            improved = improved[np.argpartition(-scores[improved], 4 * heap.k - 1)[:4 * heap.k]]
+        improved = improved[~excluded[docs[improved]]]
+        heap.offer(self.doc_files[docs[improved]], scores[improved])
+
+    def search(self, query: List[Tuple[int, float]], k: int,
+               excluded: Optional[np.ndarray] = None) -> List[Tuple[float, str, str]]:
+        """
+        MaxScore retrieval grouped by file.
+        Query terms are visited by decreasing upper bound (query weight * max posting weight). While the
+        bounds of the terms left could still lift an unseen document past the k-th best file score
+        (theta, kept in a bounded top-k heap), terms are essential: their posting lists are read in full.
+        The remaining non-essential terms only score the surviving candidates, probing their postings
+        by binary search, and candidates whose upper bound falls below theta are dropped.
+        Docs set in excluded (default: the deleted ones) never enter the top k nor the candidates.
+        Returns up to k (score, point_id, file_id) with the best chunk of each file.
+        """
+        if excluded is None:
+            excluded = self.deleted
+        bounded = sorted(((qw * b, t, qw) for t, qw in query if (b := self.upper_bound(t)) > 0), reverse=True)
+        if not bounded or self.num_docs == 0 or k <= 0:
+            return []
+        remaining = sum(b[0] for b in bounded)
+        scored = 0.0
+        heap = _TopFiles(k)
+        acc = np.zeros(self.num_docs, dtype=np.float32)
+        position = 0
+
+        # Essential terms: any live document in their lists may still reach the top k
+        for bound, term, qw in bounded:
+            if remaining <= heap.theta:
+                break
+            remaining -= bound
+            scored += bound
+            position += 1
+            start, end, scale = self._term_range(term)
+            # Native-width indices make the scatter below markedly faster than uint32 ones
+            docs = self.post_docs[start:end].astype(np.intp)
+            acc[docs] += np.asarray(self.post_weights[start:end], dtype=np.float32) * np.float32(qw * scale)
+            # theta can't exceed the bounds scored so far, so it can't end this phase before they outweigh the rest
+            if remaining < scored:
+                self._offer(heap, excluded, docs, acc[docs])
+
+        # Candidates: scored documents whose upper bound still reaches theta
+        floor = heap.theta - remaining
+        cand_docs = np.flatnonzero(acc >= floor) if floor > 0 else np.flatnonzero(acc)
+        cand_docs = cand_docs[~excluded[cand_docs]]
+        cand_scores = acc[cand_docs]
+        # Non-essential terms: only the candidates are scored, probing the posting lists
+        for bound, term, qw in bounded[position:]:
+            cand_docs = cand_docs[cand_scores + remaining >= heap.theta]
+            remaining -= bound
+            if len(cand_docs) == 0:
+                break
+            start, end, scale = self._term_range(term)
+            postings = self.post_docs[start:end]
+            if end - start <= len(cand_docs):
+                # Short list: adding all of it is cheaper than probing every candidate
+                docs = postings.astype(np.intp)
+                weights = self.post_weights[start:end]
+            else:
+                pos = np.searchsorted(postings, cand_docs)
+                found = pos < len(postings)
+                found[found] = np.asarray(postings[pos[found]]) == cand_docs[found]
+                docs, weights = cand_docs[found], self.post_weights[start:end][pos[found]]
+            acc[docs] += np.asarray(weights, dtype=np.float32) * np.float32(qw * scale)
+            self._offer(heap, excluded, docs, acc[docs])
+            cand_scores = acc[cand_docs]
+
+        cand_scores = acc[cand_docs]
+        keep = cand_scores >= heap.theta
+        cand_docs, cand_scores = cand_docs[keep], cand_scores[keep]
+        if len(cand_docs) == 0:
+            return []
+        # Best chunk per file, then the k best files
+        order = np.lexsort((-cand_scores, self.doc_files[cand_docs]))
+        files = self.doc_files[cand_docs[order]]
+        first = np.flatnonzero(np.r_[True, files[1:] != files[:-1]])
+        best_docs, best_scores = cand_docs[order][first], cand_scores[order][first]
+        top = np.argsort(-best_scores, kind="stable")[:k]
+        return [
+            (float(best_scores[i]), self.point_ids[best_docs[i]], self.file_ids[self.doc_files[best_docs[i]]])
+            for i in top
+        ]
+
+
+class _TopFiles:
+    """Bounded top-k of file scores; theta is the k-th best score once k files have been seen, else 0."""
+
+    def __init__(self, k: int):
+        self.k = k
+        self.theta = 0.0
+        self._best: Dict[int, float] = {}  # file ordinal -> best partial score
+        self._heap: List[Tuple[float, int]] = []  # (score, file), lazily invalidated
+
+    def offer(self, files: np.ndarray, scores: np.ndarray):
+        if len(files) == 0:
+            return
+        # One (best) score per file, and at most k of them can matter
+        order = np.lexsort((-scores, files))
+        files, scores = files[order], scores[order]
+        first = np.flatnonzero(np.r_[True, files[1:] != files[:-1]])
+        files, scores = files[first], scores[first]
+        if len(files) > self.k:
+            top = np.argpartition(-scores, self.k - 1)[:self.k]
+            files, scores = files[top], scores[top]
+        for f, score in zip(files.tolist(), scores.tolist()):
+            if score <= self._best.get(f, 0.0) or (len(self._best) >= self.k and f not in self._best and score <= self.theta):
+                continue
+            self._best[f] = score
+            heapq.heappush(self._heap, (score, f))
+            while len(self._best) > self.k:
+                self._pop_min()
+        if len(self._best) >= self.k:
+            self.theta = self._peek_min()
+
+    def _peek_min(self) -> float:
+        # Drop stale entries (files whose score has grown since)
+        while self._heap and self._best.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+        return self._heap[0][0]
+
+    def _pop_min(self):
+        self._peek_min()
+        _, f = heapq.heappop(self._heap)
+        del self._best[f]
+
+
+class SparseIndex:
+    """
+    In-process sparse retrieval engine over SPLADE vectors: an inverted index of memory-mapped,
+    quantized posting lists in immutable segments, plus an in-memory buffer of recent writes.
+    Updates are applied as delete + insert keyed by point id; the buffer is flushed into a new
+    segment every flush_points points. Segments are merged log-structured style: once merge_factor
+    segments fall into the same size tier they are rewritten as one, outside the index lock.
+    """
+
+    def __init__(self, path: str, flush_points: int = FLUSH_POINTS, merge_factor: int = MERGE_FACTOR):
+        self.path = path
+        self.flush_points = flush_points
+        self.merge_factor = max(2, merge_factor)
+        self._lock = threading.RLock()
+        self._merge_lock = threading.Lock()  # One merge at a time
+        self._segments: List[_Segment] = []
+        self._next_segment = 0
+        self._building: Set[str] = set()  # Segment directories being written by a merge
+        # Merged-away segment -> (merged segment, new ordinal per doc) while its points are being remapped
+        self._forward: Dict[_Segment, Tuple[_Segment, np.ndarray]] = {}
+        self._epoch = 0  # Bumped by clear(), so an in-flight merge is discarded
+        # Write buffer: point_id -> (file_id, vector), with its own small inverted index
+        self._buffer: Dict[str, Tuple[str, Dict[int, float]]] = {}
+        self._buffer_postings: Dict[int, Dict[str, float]] = {}
+        # Where each live point is stored: (segment, doc ordinal), or None while buffered
+        self._live: Dict[str, Optional[Tuple[_Segment, int]]] = {}
+        self._by_file: Dict[str, Set[str]] = {}
+        # Index-wide file ordinals, so a set of allowed files becomes one boolean mask per search
+        self._file_ordinals: Dict[str, int] = {}
+        self._is_loaded = False
+
+    def load_if_needed(self):
+        if self._is_loaded:
+            return
+        with self._lock:
+            if self._is_loaded:
+                return
+            os.makedirs(self.path, exist_ok=True)
+            state = self._read_state()
+            self._next_segment = state["next_segment"]
+            for name in state["segments"]:
+                segment = _Segment(os.path.join(self.path, name))
+                self._add_file_ordinals(segment)
+                self._segments.append(segment)
+                for d, point_id in enumerate(segment.point_ids):
+                    if not segment.deleted[d]:
+                        self._track(point_id, segment.file_ids[segment.doc_files[d]], (segment, d))
+            self._is_loaded = True
+
+    def _read_state(self) -> dict:
+        try:
+            with open(os.path.join(self.path, "segments.json")) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {"segments": [], "next_segment": 0}
+
+    def _write_state(self):
+        tmp = os.path.join(self.path, "segments.json.tmp")
+        with open(tmp, "w") as f:
+            json.dump({"segments": [s.name for s in self._segments], "next_segment": self._next_segment}, f)
+        os.replace(tmp, os.path.join(self.path, "segments.json"))
+        # Segments no longer listed (merged away) can go
+        listed = {s.name for s in self._segments}
+        for name in os.listdir(self.path):
+            if name.startswith("seg_") and name not in listed and name.split(".")[0] not in self._building:
+                shutil.rmtree(os.path.join(self.path, name), ignore_errors=True)
+
+    def _add_file_ordinals(self, segment: _Segment):
+        segment.global_files = np.array(
+            [self._file_ordinals.setdefault(file_id, len(self._file_ordinals)) for file_id in segment.file_ids],
+            dtype=np.int64
+        )
+
+    def _track(self, point_id: str, file_id: str, location: Optional[Tuple[_Segment, int]]):
+        self._live[point_id] = location
+        self._by_file.setdefault(file_id, set()).add(point_id)
+
+    def _remove_unlocked(self, point_id: str):
+        location = self._live.pop(point_id, None)
+        if location is not None:
+            segment, d = location
+            segment.deleted[d] = True
+            segment.dirty = True
+            file_id = segment.file_ids[segment.doc_files[d]]
+            if segment in self._forward:
+                # Merged away but not remapped yet: the point now lives in the merged segment
+                merged, ordinals = self._forward[segment]
+                merged.deleted[ordinals[d]] = True
+                merged.dirty = True
+        elif point_id in self._buffer:
+            file_id, vec = self._buffer.pop(point_id)
+            for t in vec:
+                postings = self._buffer_postings.get(t)
+                if postings is not None:
+                    postings.pop(point_id, None)
+                    if not postings:
+                        del self._buffer_postings[t]
+        else:
+            return
+        ids = self._by_file.get(file_id)
+        if ids is not None:
+            ids.discard(point_id)
+            if not ids:
+                del self._by_file[file_id]
+
+    def count(self) -> int:
+        self.load_if_needed()
+        return len(self._live)
+
+    def replace_files(self, file_ids: List[str], points: List[IndexedPoint]):
+        """Drops every point of file_ids, then adds points (the new chunks of those files)."""
+        self.load_if_needed()
+        with self._lock:
+            for file_id in file_ids:
+                for point_id in list(self._by_file.get(file_id, ())):
+                    self._remove_unlocked(point_id)
+            for point_id, file_id, vec in points:
+                self._remove_unlocked(point_id)
+                self._buffer[point_id] = (file_id, vec)
+                for t, w in vec.items():
+                    self._buffer_postings.setdefault(t, {})[point_id] = w
+                self._track(point_id, file_id, None)
+            full = len(self._buffer) >= self.flush_points
+        if full:
+            self.flush()
+
+    def delete_files(self, file_ids: List[str]):
+        self.replace_files(file_ids, [])
+
+    def flush(self):
+        """Writes buffered points as a new segment and persists deletions, then merges segments if needed."""
+        if not self._is_loaded:
+            return
+        with self._lock:
+            if self._buffer:
+                points = [(p, file_id, vec) for p, (file_id, vec) in self._buffer.items()]
+                segment = _Segment.write(os.path.join(self.path, self._next_name()), points)
+                self._add_file_ordinals(segment)
+                self._segments.append(segment)
+                for d, (point_id, _, _) in enumerate(points):
+                    self._live[point_id] = (segment, d)
+                self._buffer.clear()
+                self._buffer_postings.clear()
+            for segment in self._segments:
+                segment.save_deleted()
+            self._write_state()
+        self._merge_if_needed()
+
+    def _next_name(self) -> str:
+        name = f"seg_{self._next_segment:06d}"
+        self._next_segment += 1
+        return name
+
+    def _tier(self, segment: _Segment) -> int:
+        """Size tier by live points: tier t holds flush_points * merge_factor^t up to the next power."""
+        return max(0, int(math.log(max(segment.live_docs, 1) / self.flush_points, self.merge_factor)))
+
+    def _pick_merge_unlocked(self) -> Optional[List[_Segment]]:
+        """The oldest merge_factor segments of the smallest tier that has that many, if any."""
+        tiers: Dict[int, List[_Segment]] = {}
+        for segment in self._segments:
+            tiers.setdefault(self._tier(segment), []).append(segment)
+        for tier in sorted(tiers):
+            if len(tiers[tier]) >= self.merge_factor:
+                return tiers[tier][:self.merge_factor]
+        return None
+
+    def _merge_if_needed(self):
+        """
+        Merges similar-sized segments until no tier is full. Each merged segment is built from
+        snapshots of the deletion masks without holding the index lock; deletions made meanwhile
+        are carried over when it is swapped in, and live points are then remapped in batches.
+        """
+        if not self._merge_lock.acquire(blocking=False):
+            return  # Another thread is merging and will re-check the tiers
+        try:
+            while True:
+                with self._lock:
+                    group = self._pick_merge_unlocked()
+                    if group is None:
+                        return
+                    snapshots = [segment.deleted.copy() for segment in group]
+                    name = self._next_name()
+                    self._building.add(name)
+                    epoch = self._epoch
+                try:
+                    merged, ordinal_maps = _Segment.merge(os.path.join(self.path, name), group, snapshots)
+                finally:
+                    with self._lock:
+                        self._building.discard(name)
+                with self._lock:
+                    if epoch != self._epoch:
+                        shutil.rmtree(merged.path, ignore_errors=True)
+                        return
+                    for segment, snapshot, ordinals in zip(group, snapshots, ordinal_maps):
+                        # Points deleted or replaced while the merge was being built
+                        merged.deleted[ordinals[segment.deleted & ~snapshot]] = True
+                        self._forward[segment] = (merged, ordinals)
+                    merged.dirty = True
+                    merged.save_deleted()
+                    self._add_file_ordinals(merged)
+                    position = self._segments.index(group[0])
+                    self._segments = [s for s in self._segments if s not in group]
+                    self._segments.insert(position, merged)
+                    self._write_state()
+                self._remap(merged, group, ordinal_maps)
+        finally:
+            self._merge_lock.release()
+
+    def _remap(self, merged: _Segment, group: List[_Segment], ordinal_maps: List[np.ndarray]):
+        """Points the live locations of merged-away segments at the merged segment, a batch per lock hold."""
+        moves = [
+            (segment.point_ids[d], segment, d, int(ordinals[d]))
+            for segment, ordinals in zip(group, ordinal_maps)
+            for d in np.flatnonzero(ordinals >= 0).tolist()
+        ]
+        for i in range(0, len(moves), _REMAP_BATCH):
+            with self._lock:
+                for point_id, segment, d, new_d in moves[i:i + _REMAP_BATCH]:
+                    location = self._live.get(point_id)
+                    if location is not None and location[0] is segment and location[1] == d:
+                        self._live[point_id] = (merged, new_d)
+        with self._lock:
+            for segment in group:
+                self._forward.pop(segment, None)
+
+    def clear(self):
+        """Removes every segment and buffered point."""
+        with self._lock:
+            self._epoch += 1
+            self._segments = []
+            self._forward.clear()
+            self._buffer.clear()
+            self._buffer_postings.clear()
+            self._live.clear()
+            self._by_file.clear()
+            self._file_ordinals.clear()
+            self._is_loaded = True
+            os.makedirs(self.path, exist_ok=True)
+            self._write_state()
+
+    def _search_buffer(self, query: List[Tuple[int, float]], k: int,
+                       file_ids: Optional[Set[str]]) -> List[Tuple[float, str, str]]:
+        scores: Dict[str, float] = {}
+        for t, qw in query:
+            for point_id, w in self._buffer_postings.get(t, {}).items():
+                scores[point_id] = scores.get(point_id, 0.0) + qw * w
+        best: Dict[str, Tuple[float, str]] = {}
+        for point_id, score in scores.items():
+            file_id = self._buffer[point_id][0]
+            if file_ids is not None and file_id not in file_ids:
+                continue
+            if file_id not in best or score > best[file_id][0]:
+                best[file_id] = (score, point_id)
+        top = sorted(best.items(), key=lambda item: -item[1][0])[:k]
+        return [(score, point_id, file_id) for file_id, (score, point_id) in top]
+
+    def search(self, sparse_query: Dict[int, float], limit: int,
+               file_ids: Optional[Iterable[str]] = None) -> List[Tuple[str, float]]:
+        """
+        Returns (point_id, score) of the best-scoring chunk of each of the top `limit` files,
+        ranked by dot product like the Qdrant sparse query grouped by file.
+        When file_ids is given only chunks of those files are ranked (a filter pushed into the search).
+        """
+        self.load_if_needed()
+        query = [(int(t), float(w)) for t, w in sparse_query.items() if w > 0]
+        if not query or limit <= 0:
+            return []
+        allowed_ids = set(file_ids) if file_ids is not None else None
+        with self._lock:
+            allowed = None
+            if allowed_ids is not None:
+                allowed = np.zeros(len(self._file_ordinals), dtype=bool)
+                allowed[np.fromiter((self._file_ordinals[f] for f in allowed_ids if f in self._file_ordinals),
+                                    dtype=np.intp)] = True
+            candidates = self._search_buffer(query, limit, allowed_ids)
+            for segment in self._segments:
+                excluded = None
+                if allowed is not None:
+                    excluded = segment.deleted | ~allowed[segment.global_files][segment.doc_files]
+                    if excluded.all():
+                        continue
+                candidates.extend(segment.search(query, limit, excluded))
+        # A file's chunks all live in one segment (or the buffer), so the per-part winners merge directly
+        best: Dict[str, Tuple[float, str]] = {}
+        for score, point_id, file_id in candidates:
+            if file_id not in best or score > best[file_id][0]:
+                best[file_id] = (score, point_id)
+        ranked = sorted(best.values(), key=lambda item: -item[0])[:limit]
+        return [(point_id, score) for score, point_id in ranked]
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "points": len(self._live),
+            "segments": len(self._segments),
+            "buffered": len(self._buffer),
+        }
@@ -1,10 +1,16 @@
 import os
 import sqlite3
 import re
-from typing import Dict, List, Tuple
+import threading
+from typing import Callable, Dict, List, Optional
 from path_env import DB_DIR
 
 DB_PATH = os.path.join(DB_DIR, "vocab.sqlite")
+# Pending vocabulary changes are written behind in one transaction every N files or M milliseconds
+VOCAB_FLUSH_FILES = int(os.getenv("VOCAB_FLUSH_FILES", "64"))
+VOCAB_FLUSH_INTERVAL_MS = float(os.getenv("VOCAB_FLUSH_INTERVAL_MS", "500"))
+# Max host parameters per IN (...) clause
+_SQL_BATCH = 500
 
 def tokenize_words(text: str) -> List[str]:
     if not text:
@@ -12,141 +18,244 @@ def tokenize_words(text: str) -> List[str]:
     # Lowercase and match alphabetic words of length 2 to 20
     return re.findall(r"\b[a-z]{2,20}\b", text.lower())
 
-def init_vocab_db():
-    """Initialize the vocabulary database schema in WAL mode."""
-    os.makedirs(DB_DIR, exist_ok=True)
-    conn = sqlite3.connect(DB_PATH, timeout=10)
-    try:
-        conn.execute("PRAGMA journal_mode=WAL;")
-        with conn:
-            conn.execute("""
-                CREATE TABLE IF NOT EXISTS document_words (
-                    path TEXT,
-                    word TEXT,
-                    count INTEGER,
-                    PRIMARY KEY (path, word)
-                )
-            """)
-            conn.execute("CREATE INDEX IF NOT EXISTS idx_doc_words_path ON document_words(path)")
-            
-            conn.execute("""
-                CREATE TABLE IF NOT EXISTS vocabulary (
-                    word TEXT PRIMARY KEY,
-                    frequency INTEGER
-                )
-            """)
-    finally:
-        conn.close()
+def _count_words(text: str) -> Dict[str, int]:
+    counts: Dict[str, int] = {}
+    for w in tokenize_words(text):
+        counts[w] = counts.get(w, 0) + 1
+    return counts
+
+def _tree_bounds(abs_path: str):
+    # Range scan on the path index: every path starting with prefix ('0' follows '/')
+    prefix = abs_path if abs_path.endswith("/") else abs_path + "/"
+    return abs_path, prefix, prefix[:-1] + "0"
 
-def update_document_vocabulary(path: str, text: str) -> Dict[str, int]:
+class VocabularyWriter:
     """
-    Updates word frequencies for a document path.
-    Returns a dictionary of {word: new_total_frequency} for all modified terms.
+    Write-behind vocabulary store over one long-lived SQLite connection.
+    Document word counts are queued in memory (the latest content of a path wins) and a background
+    thread applies them every VOCAB_FLUSH_FILES files or VOCAB_FLUSH_INTERVAL_MS milliseconds:
+    deltas of all queued documents are merged and written with executemany in a single transaction,
+    then the new totals of every changed word are handed to the listeners in one batch.
     """
-    abs_path = os.path.abspath(path)
-    words = tokenize_words(text)
-    
-    # Count frequencies in the new document content
-    new_counts: Dict[str, int] = {}
-    for w in words:
-        new_counts[w] = new_counts.get(w, 0) + 1
-        
-    conn = sqlite3.connect(DB_PATH, timeout=10)
-    updated_frequencies: Dict[str, int] = {}
-    try:
-        conn.execute("PRAGMA journal_mode=WAL;")
-        with conn:
-            # 1. Retrieve old counts
-            cursor = conn.execute("SELECT word, count FROM document_words WHERE path = ?", (abs_path,))
-            old_counts = {row[0]: row[1] for row in cursor.fetchall()}
-            
-            # 2. Compute deltas
-            deltas: Dict[str, int] = {}
-            for word, count in new_counts.items():
-                deltas[word] = count - old_counts.get(word, 0)
-            for word, count in old_counts.items():
-                if word not in new_counts:
-                    deltas[word] = -count
-                    
-            # 3. Apply deltas to vocabulary table
-            for word, delta in deltas.items():
-                if delta == 0:
-                    continue
+
+    def __init__(self, path: str = DB_PATH, flush_files: int = VOCAB_FLUSH_FILES,
+                 flush_interval_ms: float = VOCAB_FLUSH_INTERVAL_MS):
+        self._path = path
+        self.flush_files = flush_files
+        self.flush_interval = flush_interval_ms / 1000.0
+        self._pending: Dict[str, Optional[Dict[str, int]]] = {}  # path -> new word counts, None = deleted
+        self._listeners: List[Callable[[Dict[str, int]], None]] = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()  # Serializes every use of the connection
+        self._wake = threading.Event()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._flusher: Optional[threading.Thread] = None
+        self._is_loaded = False
+        self.flushes = 0
+        self.documents = 0
+
+    def load_if_needed(self):
+        if self._is_loaded:
+            return
+        with self._lock:
+            if self._is_loaded:
+                return
+            os.makedirs(os.path.dirname(self._path), exist_ok=True)
+            conn = sqlite3.connect(self._path, timeout=10, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL;")
+            with conn:
                 conn.execute("""
-                    INSERT INTO vocabulary (word, frequency)
-                    VALUES (?, ?)
-                    ON CONFLICT(word) DO UPDATE SET frequency = frequency + excluded.frequency
-                """, (word, delta))
-                
-            # Clean up vocabulary entries that dropped to <= 0
-            conn.execute("DELETE FROM vocabulary WHERE frequency <= 0")
-            
-            # 4. Refresh document_words table
-            conn.execute("DELETE FROM document_words WHERE path = ?", (abs_path,))
-            if new_counts:
-                conn.executemany(
-                    "INSERT INTO document_words (path, word, count) VALUES (?, ?, ?)",
-                    [(abs_path, word, count) for word, count in new_counts.items()]
+                    CREATE TABLE IF NOT EXISTS document_words (
+                        path TEXT,
+                        word TEXT,
+                        count INTEGER,
+                        PRIMARY KEY (path, word)
+                    )
+                """)
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_doc_words_path ON document_words(path)")
+
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS vocabulary (
+                        word TEXT PRIMARY KEY,
+                        frequency INTEGER
+                    )
+                """)
+            self._conn = conn
+            self._is_loaded = True
+            self._flusher = threading.Thread(target=self._flush_loop, daemon=True)
+            self._flusher.start()
+
+    def add_listener(self, listener: Callable[[Dict[str, int]], None]):
+        """Registers listener({word: new_total_frequency}), called after each flush that changed words."""
+        self._listeners.append(listener)
+
+    def _queue(self, updates: Dict[str, Optional[Dict[str, int]]]):
+        self.load_if_needed()
+        with self._lock:
+            self._pending.update(updates)
+            full = len(self._pending) >= self.flush_files
+        if full:
+            self._wake.set()
+
+    def update_document(self, path: str, text: str):
+        """Queues the word counts of a document's new content."""
+        self._queue({os.path.abspath(path): _count_words(text)})
+
+    def delete_documents(self, paths: List[str]):
+        self._queue({os.path.abspath(p): None for p in paths})
+
+    def delete_tree(self, path: str):
+        """Queues the removal of a path and every document under it (directory subtree)."""
+        self.load_if_needed()
+        abs_path, low, high = _tree_bounds(os.path.abspath(path))
+        # Hold the flush lock so documents being flushed right now are seen in the table
+        with self._flush_lock:
+            cursor = self._conn.execute(
+                "SELECT DISTINCT path FROM document_words WHERE path = ? OR (path >= ? AND path < ?)",
+                (abs_path, low, high)
+            )
+            stored = [row[0] for row in cursor.fetchall()]
+            with self._lock:
+                queued = [p for p in self._pending if p == abs_path or low <= p < high]
+                for p in stored + queued:
+                    self._pending[p] = None
+        if stored or queued:
+            self._wake.set()
+
+    def move_tree(self, src: str, dest: str):
+        """Transfers word ownership of a path and its subtree to their new location after a move."""
+        abs_src, low, high = _tree_bounds(os.path.abspath(src))
+        abs_dest = os.path.abspath(dest)
+        # Queued documents under src must land in the table before their rows are re-keyed
+        self.flush()
+        with self._flush_lock:
+            with self._conn:
+                self._conn.execute(
+                    "UPDATE document_words SET path = ? || substr(path, ?) WHERE path = ? OR (path >= ? AND path < ?)",
+                    (abs_dest, len(abs_src) + 1, abs_src, low, high)
                 )
-                
-            # 5. Fetch post-transaction total frequencies for all affected words
-            for word in deltas.keys():
-                cursor = conn.execute("SELECT frequency FROM vocabulary WHERE word = ?", (word,))
-                row = cursor.fetchone()
-                updated_frequencies[word] = row[0] if row else 0
-    finally:
-        conn.close()
-        
-    return updated_frequencies
-
-def delete_document_vocabulary(path: str) -> Dict[str, int]:
-    """
-    Removes a document from the vocabulary database.
-    Returns a dictionary of {word: new_total_frequency} for all affected terms.
-    """
-    abs_path = os.path.abspath(path)
-    conn = sqlite3.connect(DB_PATH, timeout=10)
-    updated_frequencies: Dict[str, int] = {}
-    try:
-        conn.execute("PRAGMA journal_mode=WAL;")
+
+    def get_all(self) -> Dict[str, int]:
+        """Returns the stored global vocabulary as a {word: frequency} mapping (queued changes excluded)."""
+        self.load_if_needed()
+        with self._flush_lock:
+            cursor = self._conn.execute("SELECT word, frequency FROM vocabulary")
+            return {row[0]: row[1] for row in cursor.fetchall()}
+
+    def flush(self):
+        """Applies all queued document changes in one transaction and notifies the listeners."""
+        if not self._is_loaded:
+            return
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            if not pending:
+                return
+            try:
+                updated_frequencies = self._apply(pending)
+            except Exception as e:
+                print(f"Error flushing vocabulary updates: {e}")
+                with self._lock:
+                    # Changes queued meanwhile are newer than the failed ones
+                    self._pending = {**pending, **self._pending}
+                return
+            self.flushes += 1
+            self.documents += len(pending)
+        if updated_frequencies:
+            for listener in self._listeners:
+                try:
+                    listener(updated_frequencies)
+                except Exception as e:
+                    print(f"Error applying vocabulary updates: {e}")
+
+    def _apply(self, pending: Dict[str, Optional[Dict[str, int]]]) -> Dict[str, int]:
+        """Writes pending {path: new_counts_or_None}. Returns {word: new_total_frequency} of changed words."""
+        conn = self._conn
+        paths = list(pending)
         with conn:
-            # 1. Retrieve old counts
-            cursor = conn.execute("SELECT word, count FROM document_words WHERE path = ?", (abs_path,))
-            old_counts = {row[0]: row[1] for row in cursor.fetchall()}
-            
-            if not old_counts:
-                return {}
-                
-            # 2. Decrement vocabulary frequencies
-            for word, count in old_counts.items():
-                conn.execute(
-                    "UPDATE vocabulary SET frequency = frequency - ? WHERE word = ?",
-                    (count, word)
+            # 1. Merge the deltas of all documents against their stored counts
+            deltas: Dict[str, int] = {}
+            for i in range(0, len(paths), _SQL_BATCH):
+                batch = paths[i:i + _SQL_BATCH]
+                cursor = conn.execute(
+                    f"SELECT word, count FROM document_words WHERE path IN ({','.join('?' * len(batch))})", batch
                 )
-                
-            # Clean up vocabulary entries that dropped to <= 0
+                for word, count in cursor:
+                    deltas[word] = deltas.get(word, 0) - count
+            for counts in pending.values():
+                for word, count in (counts or {}).items():
+                    deltas[word] = deltas.get(word, 0) + count
+            changed = [(word, delta) for word, delta in deltas.items() if delta != 0]
+
+            # 2. Apply deltas to the vocabulary table and drop words that fell to <= 0
+            conn.executemany("""
+                INSERT INTO vocabulary (word, frequency)
+                VALUES (?, ?)
+                ON CONFLICT(word) DO UPDATE SET frequency = frequency + excluded.frequency
+            """, changed)
             conn.execute("DELETE FROM vocabulary WHERE frequency <= 0")
-            
-            # 3. Delete from document_words
-            conn.execute("DELETE FROM document_words WHERE path = ?", (abs_path,))
-            
-            # 4. Fetch post-transaction total frequencies for all affected words
-            for word in old_counts.keys():
-                cursor = conn.execute("SELECT frequency FROM vocabulary WHERE word = ?", (word,))
-                row = cursor.fetchone()
-                updated_frequencies[word] = row[0] if row else 0
-    finally:
-        conn.close()
-        
-    return updated_frequencies
+
+            # 3. Replace the document_words rows of every pending path
+            conn.executemany("DELETE FROM document_words WHERE path = ?", [(p,) for p in paths])
+            conn.executemany(
+                "INSERT INTO document_words (path, word, count) VALUES (?, ?, ?)",
+                [(p, word, count) for p, counts in pending.items() if counts for word, count in counts.items()]
+            )
+
+            # 4. Read back the post-transaction totals of the changed words
+            words = [word for word, _ in changed]
+            updated_frequencies = dict.fromkeys(words, 0)
+            for i in range(0, len(words), _SQL_BATCH):
+                batch = words[i:i + _SQL_BATCH]
+                cursor = conn.execute(
+                    f"SELECT word, frequency FROM vocabulary WHERE word IN ({','.join('?' * len(batch))})", batch
+                )
+                updated_frequencies.update(cursor.fetchall())
+        return updated_frequencies
+
+    def _flush_loop(self):
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+    def stats(self):
+        return {
+            "pending_documents": len(self._pending),
+            "flushes": self.flushes,
+            "avg_documents_per_flush": self.documents / self.flushes if self.flushes else 0.0,
+        }
+
+# Global thread-safe singleton
+vocabulary_writer = VocabularyWriter()
+
+def init_vocab_db():
+    """Initialize the vocabulary database schema in WAL mode."""
+    vocabulary_writer.load_if_needed()
+
+def update_document_vocabulary(path: str, text: str):
+    """Queues the new word counts of a document path; applied by the next flush."""
+    vocabulary_writer.update_document(path, text)
+
+def delete_document_vocabulary(path: str):
+    """Queues the removal of a document from the vocabulary database."""
+    vocabulary_writer.delete_documents([path])
+
+def delete_documents_vocabulary(paths: List[str]):
+    """Queues the removal of many documents from the vocabulary database."""
+    vocabulary_writer.delete_documents(paths)
+
+def delete_tree_vocabulary(path: str):
+    """Queues the removal of a path and every document under it (directory subtree)."""
+    vocabulary_writer.delete_tree(path)
+
+def move_tree_vocabulary(src: str, dest: str):
+    """Transfers word ownership of a path and its subtree to their new location after a move."""
+    vocabulary_writer.move_tree(src, dest)
+
+def flush_vocabulary():
+    vocabulary_writer.flush()
 
 def get_all_vocabulary() -> Dict[str, int]:
     """Returns the entire global vocabulary table as a {word: frequency} mapping."""
-    init_vocab_db()
-    conn = sqlite3.connect(DB_PATH, timeout=10)
-    try:
-        conn.execute("PRAGMA journal_mode=WAL;")
-        cursor = conn.execute("SELECT word, frequency FROM vocabulary")
-        return {row[0]: row[1] for row in cursor.fetchall()}
-    finally:
-        conn.close()
+    return vocabulary_writer.get_all()
@@ -1,13 +1,75 @@
+import os
 import threading
 import re
+from functools import lru_cache
+from typing import Dict, Mapping, Optional
 from symspellpy import SymSpell, Verbosity
 import spelling_db
 
+# Deleted words are tombstoned and filtered at lookup time; the index is rebuilt in the background
+# once tombstones exceed both a minimum count and a fraction of the dictionary
+SPELLING_COMPACT_MIN_TOMBSTONES = int(os.getenv("SPELLING_COMPACT_MIN_TOMBSTONES", "256"))
+SPELLING_COMPACT_RATIO = float(os.getenv("SPELLING_COMPACT_RATIO", "0.1"))
+# Frequency changes kept as overrides on top of the base counts before they are folded in
+SPELLING_MAX_OVERRIDES = int(os.getenv("SPELLING_MAX_OVERRIDES", "4096"))
+# Per-token corrections cached per published snapshot
+SPELLING_TOKEN_CACHE_SIZE = int(os.getenv("SPELLING_TOKEN_CACHE_SIZE", "1024"))
+
+def _new_sym_spell() -> SymSpell:
+    return SymSpell(max_dictionary_edit_distance=3, prefix_length=7)
+
+class _Snapshot:
+    """
+    Immutable view of the dictionary that queries read without locking.
+    sym_spell is append-only and shared between snapshots (a word is added before it is published),
+    so frequencies and liveness come from the snapshot: base counts plus a small overrides map,
+    where a count of 0 marks a deleted (tombstoned) word.
+    """
+
+    __slots__ = ("sym_spell", "base", "overrides", "tombstones", "correct")
+
+    def __init__(self, sym_spell: SymSpell, base: Mapping[str, int], overrides: Mapping[str, int], tombstones: int):
+        self.sym_spell = sym_spell
+        self.base = base
+        self.overrides = overrides
+        self.tombstones = tombstones
+        # A fresh cache per snapshot: publishing a new version invalidates every cached correction
+        self.correct = lru_cache(maxsize=SPELLING_TOKEN_CACHE_SIZE)(self._correct)
+
+    def count(self, word: str) -> int:
+        count = self.overrides.get(word)
+        return self.base.get(word, 0) if count is None else count
+
+    def _correct(self, word: str, max_ed: int) -> Optional[str]:
+        """Best live suggestion for a lowercase word: closest edit distance, then highest frequency."""
+        suggestions = self.sym_spell.lookup(word, Verbosity.CLOSEST, max_edit_distance=max_ed)
+        live = [(s.distance, -self.count(s.term), s.term) for s in suggestions if self.count(s.term) > 0]
+        if suggestions and not live:
+            # Every closest candidate was deleted: fall back to all candidates within max_ed
+            live = [
+                (s.distance, -self.count(s.term), s.term)
+                for s in self.sym_spell.lookup(word, Verbosity.ALL, max_edit_distance=max_ed)
+                if self.count(s.term) > 0
+            ]
+        return min(live)[2] if live else None
+
 class SpellingService:
+    """
+    Spelling correction with read-copy-update: queries read the current _Snapshot reference without
+    taking any lock, while writers (serialized by _lock) prepare the next version and publish it
+    with a single attribute assignment.
+    """
+
     def __init__(self):
-        self.sym_spell = SymSpell(max_dictionary_edit_distance=3, prefix_length=7)
+        self._snapshot = _Snapshot(_new_sym_spell(), {}, {}, 0)
         self._lock = threading.Lock()
         self._is_loaded = False
+        self._replay: Optional[Dict[str, int]] = None  # Updates made while a compaction is running
+        self.compactions = 0
+
+    @property
+    def sym_spell(self) -> SymSpell:
+        return self._snapshot.sym_spell
 
     def load_if_needed(self):
         """Lazy load the vocabulary from SQLite into SymSpell if not already loaded."""
@@ -21,11 +83,15 @@ class SpellingService:
 
     def _load_from_db_unlocked(self):
         """Loads all vocabulary into a fresh SymSpell instance. Assumes lock is held."""
-        new_sym_spell = SymSpell(max_dictionary_edit_distance=3, prefix_length=7)
-        vocab = spelling_db.get_all_vocabulary()
+        self._snapshot = self._build_from_db()
+
+    @staticmethod
+    def _build_from_db() -> _Snapshot:
+        new_sym_spell = _new_sym_spell()
+        vocab = {word: freq for word, freq in spelling_db.get_all_vocabulary().items() if freq > 0}
         for word, freq in vocab.items():
             new_sym_spell.create_dictionary_entry(word, freq)
-        self.sym_spell = new_sym_spell
+        return _Snapshot(new_sym_spell, vocab, {}, 0)
 
     def correct_query(self, query: str) -> str:
         """
@@ -37,6 +103,8 @@ class SpellingService:
         if not query.strip():
             return query
 
+        # One snapshot for the whole query, read without locking
+        snapshot = self._snapshot
         words = query.split()
         corrected_words = []
         for word in words:
@@ -61,13 +129,9 @@ class SpellingService:
             else:
                 max_ed = 3
 
-            with self._lock:
-                suggestions = self.sym_spell.lookup(
-                    clean_word_lower, Verbosity.CLOSEST, max_edit_distance=max_ed
-                )
+            suggested_term = snapshot.correct(clean_word_lower, max_ed)
 
-            if suggestions:
-                suggested_term = suggestions[0].term
+            if suggested_term is not None:
                 # Match the casing pattern of the original word
                 if clean_word.isupper():
                     suggested_term = suggested_term.upper()
@@ -81,21 +145,77 @@ class SpellingService:
 
     def update_vocab(self, updates: dict[str, int]):
         """
-        Dynamically updates the in-memory SymSpell instance.
-        If a word's count is <= 0 (deleted), performs an atomic rebuild from the SQLite
-        database to clean up delete paths and avoid KeyError inside symspellpy.
+        Publishes a new snapshot with the given total word frequencies.
+        Words whose count is <= 0 (deleted) are tombstoned instead of removed, which would require
+        rewriting their delete lists; a background compaction rebuilds the index once enough pile up.
         """
         if not updates:
             return
         self.load_if_needed()
         with self._lock:
-            if any(freq <= 0 for freq in updates.values()):
-                # Rebuild to clean up delete structures
-                self._load_from_db_unlocked()
-            else:
-                # Fast incremental update
-                for word, freq in updates.items():
-                    self.sym_spell.create_dictionary_entry(word, freq)
+            self._snapshot = self._apply_unlocked(self._snapshot, updates)
+            if self._replay is not None:
+                self._replay.update(updates)
+            snapshot = self._snapshot
+            compact = self._replay is None and snapshot.tombstones >= max(
+                SPELLING_COMPACT_MIN_TOMBSTONES, SPELLING_COMPACT_RATIO * len(snapshot.sym_spell.words)
+            )
+            if compact:
+                self._replay = {}
+        if compact:
+            threading.Thread(target=self._compact, daemon=True).start()
+
+    @staticmethod
+    def _apply_unlocked(snapshot: _Snapshot, updates: Dict[str, int]) -> _Snapshot:
+        """Returns the next snapshot; only copies the overrides, the shared SymSpell is appended to."""
+        sym_spell, words = snapshot.sym_spell, snapshot.sym_spell.words
+        base, overrides = snapshot.base, dict(snapshot.overrides)
+        tombstones = snapshot.tombstones
+        for word, freq in updates.items():
+            freq = max(freq, 0)
+            previous = snapshot.count(word)
+            if freq > 0 and word not in words:
+                # Readers ignore the new entry until the snapshot counting it is published
+                sym_spell.create_dictionary_entry(word, freq)
+            elif word in words:
+                tombstones += (previous > 0 and freq == 0) - (previous == 0 and freq > 0)
+            overrides[word] = freq
+        if len(overrides) > SPELLING_MAX_OVERRIDES:
+            merged = dict(base)
+            merged.update(overrides)
+            # Tombstoned words keep an explicit 0 so they stay filtered until compaction
+            base, overrides = merged, {}
+        return _Snapshot(sym_spell, base, overrides, tombstones)
+
+    def _compact(self):
+        """Rebuilds the index from SQLite without the lock, then publishes it with the updates made meanwhile."""
+        try:
+            snapshot = self._build_from_db()
+        except Exception as e:
+            print(f"Error compacting spelling index: {e}")
+            with self._lock:
+                self._replay = None
+            return
+        with self._lock:
+            # Updates carry absolute frequencies, so replaying ones the rebuild already saw is harmless
+            self._snapshot = self._apply_unlocked(snapshot, self._replay)
+            self._replay = None
+            self.compactions += 1
+
+    def stats(self):
+        snapshot = self._snapshot
+        correct_cache = snapshot.correct.cache_info()
+        return {
+            "loaded": self._is_loaded,
+            "words": len(snapshot.sym_spell.words) - snapshot.tombstones,
+            "tombstones": snapshot.tombstones,
+            "overrides": len(snapshot.overrides),
+            "compactions": self.compactions,
+            "token_cache": {"entries": correct_cache.currsize, "hits": correct_cache.hits,
+                            "misses": correct_cache.misses},
+        }
 
 # Global thread-safe singleton
 spelling_service = SpellingService()
+# Frequency changes are pushed in one batch per vocabulary flush
+spelling_db.vocabulary_writer.add_listener(spelling_service.update_vocab)
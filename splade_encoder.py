@@ -1,5 +1,9 @@
 import os
 import sys
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
 import numpy as np
 from tokenizers import Tokenizer
 import onnxruntime as ort
@@ -9,46 +13,172 @@ from huggingface_hub import hf_hub_download
 MODEL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "models", "splade")
 os.makedirs(MODEL_DIR, exist_ok=True)
 
-print("Initializing SPLADE ONNX models (downloading if not present)...")
-try:
-    onnx_path = hf_hub_download(repo_id="castorini/splade-v3-onnx", filename="splade-v3-8bit.onnx", local_dir=MODEL_DIR)
-    tokenizer_path = hf_hub_download(repo_id="distilbert-base-uncased", filename="tokenizer.json", local_dir=MODEL_DIR)
-except Exception as e:
-    print(f"Error downloading SPLADE model: {e}", file=sys.stderr)
-    raise e
+MODEL_REPO_ID = "castorini/splade-v3-onnx"
+MODEL_FILENAME = "splade-v3-8bit.onnx"
+# Identifies the weights producing the vectors (used to key persisted embeddings)
+MODEL_ID = f"{MODEL_REPO_ID}/{MODEL_FILENAME}"
 
-# Initialize Tokenizer and ONNX Runtime session
-tokenizer = Tokenizer.from_file(tokenizer_path)
-tokenizer.enable_truncation(max_length=512)
+# Interactive queries and bulk ingestion run on separate sessions with their own thread budgets,
+# so indexing cannot take every core from a search (can be customized via environment variables)
+_CPUS = os.cpu_count() or 2
+INTERACTIVE_THREADS = int(os.getenv("SPLADE_INTERACTIVE_THREADS", str(max(1, _CPUS // 2))))
+BULK_THREADS = int(os.getenv("SPLADE_BULK_THREADS", str(max(1, _CPUS - INTERACTIVE_THREADS))))
+# Longest a bulk batch waits for in-flight queries before running anyway (avoids starving ingestion)
+BULK_MAX_PAUSE = float(os.getenv("SPLADE_BULK_MAX_PAUSE", "2.0"))
 
-# Set CPUExecutionProvider for local inference
-session = ort.InferenceSession(onnx_path, providers=['CPUExecutionProvider'])
-input_names = [i.name for i in session.get_inputs()]
-output_names = [o.name for o in session.get_outputs()]
+# Model state, created by load() on first use so importing this module stays cheap
+tokenizer = None
+chunk_tokenizer = None
+CLS_ID = None
+SEP_ID = None
+session = None
+bulk_session = None
+input_names: list[str] = []
+output_names: list[str] = []
+_load_lock = threading.Lock()
+_is_loaded = False
+_is_warm = False
 
-def encode(text: str, threshold: float = 0.05, top_k: int = 150) -> dict[int, float]:
-    if not text.strip():
-        return {}
+def _download(repo_id: str, filename: str) -> str:
+    """Resolves a model file from the local cache first, only contacting the hub when it is missing."""
+    try:
+        return hf_hub_download(repo_id=repo_id, filename=filename, local_dir=MODEL_DIR, local_files_only=True)
+    except Exception:
+        return hf_hub_download(repo_id=repo_id, filename=filename, local_dir=MODEL_DIR)
 
-    # Tokenize input
-    encoding = tokenizer.encode(text)
-    input_ids = np.array([encoding.ids], dtype=np.int64)
-    attention_mask = np.array([encoding.attention_mask], dtype=np.int64)
-    
-    # Dynamically build feed dict based on ONNX inputs
-    feed_dict = {}
-    if "input_ids" in input_names:
-        feed_dict["input_ids"] = input_ids
-    if "attention_mask" in input_names:
-        feed_dict["attention_mask"] = attention_mask
-    if "token_type_ids" in input_names:
-        feed_dict["token_type_ids"] = np.array([encoding.type_ids], dtype=np.int64)
+def _optimized_model_path(onnx_path: str) -> str:
+    # Optimized graphs depend on the onnxruntime build, so the version is part of the name
+    stat = os.stat(onnx_path)
+    base, _ = os.path.splitext(onnx_path)
+    return f"{base}.ort-{ort.__version__}.{int(stat.st_mtime)}-{stat.st_size}.optimized.onnx"
 
-    # Run inference
-    outputs = session.run(None, feed_dict)
-    indices = outputs[0]  # shape: (sparse_len,)
-    weights = outputs[1]  # shape: (sparse_len,)
-    
+def _make_session(onnx_path: str, threads: int) -> ort.InferenceSession:
+    """
+    Builds a CPU session. The first start serializes the optimized graph next to the model;
+    later starts load that graph with optimizations disabled and skip the optimization pass.
+    """
+    options = ort.SessionOptions()
+    options.intra_op_num_threads = threads
+    options.inter_op_num_threads = 1
+    options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+    optimized_path = _optimized_model_path(onnx_path)
+    if os.path.exists(optimized_path):
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_DISABLE_ALL
+        try:
+            return ort.InferenceSession(optimized_path, sess_options=options, providers=['CPUExecutionProvider'])
+        except Exception as e:
+            print(f"Discarding unusable optimized SPLADE graph: {e}", file=sys.stderr)
+            os.remove(optimized_path)
+    # Extended (not layout) optimizations are the ones that can be saved and reloaded
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED
+    options.optimized_model_filepath = optimized_path
+    try:
+        return ort.InferenceSession(onnx_path, sess_options=options, providers=['CPUExecutionProvider'])
+    except Exception as e:
+        print(f"Could not serialize optimized SPLADE graph ({e}), optimizing in memory.", file=sys.stderr)
+        options.optimized_model_filepath = ""
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        return ort.InferenceSession(onnx_path, sess_options=options, providers=['CPUExecutionProvider'])
+
+def load():
+    """Downloads (if needed) and loads the tokenizers and ONNX sessions once; safe to call from any thread."""
+    global tokenizer, chunk_tokenizer, CLS_ID, SEP_ID, session, bulk_session, input_names, output_names, _is_loaded
+    if _is_loaded:
+        return
+    with _load_lock:
+        if _is_loaded:
+            return
+        print("Initializing SPLADE ONNX models (downloading if not present)...")
+        try:
+            onnx_path = _download(MODEL_REPO_ID, MODEL_FILENAME)
+            tokenizer_path = _download("distilbert-base-uncased", "tokenizer.json")
+        except Exception as e:
+            print(f"Error downloading SPLADE model: {e}", file=sys.stderr)
+            raise e
+
+        # Initialize Tokenizer and ONNX Runtime session
+        tokenizer = Tokenizer.from_file(tokenizer_path)
+        tokenizer.enable_truncation(max_length=512)
+
+        # Separate non-truncating tokenizer for chunking: the whole text (or block) must be
+        # tokenized, otherwise everything after the first 512 tokens would be dropped
+        chunk_tokenizer = Tokenizer.from_file(tokenizer_path)
+        chunk_tokenizer.no_truncation()
+        CLS_ID = tokenizer.token_to_id("[CLS]")
+        SEP_ID = tokenizer.token_to_id("[SEP]")
+
+        session = _make_session(onnx_path, INTERACTIVE_THREADS)
+        bulk_session = _make_session(onnx_path, BULK_THREADS)
+        input_names = [i.name for i in session.get_inputs()]
+        output_names = [o.name for o in session.get_outputs()]
+        _is_loaded = True
+
+def warm_up():
+    """Loads the model and runs a first inference on both sessions, so the first query is not the slow one."""
+    global _is_warm
+    load()
+    encode("warm up")
+    _encode_token_rows([[CLS_ID, SEP_ID]], [[1, 1]], [[0, 0]], 0.05, 1, 1, bulk=True)
+    _is_warm = True
+
+def is_loaded() -> bool:
+    return _is_loaded
+
+def is_loading() -> bool:
+    """True while another thread is downloading or loading the model (a query would wait for it)."""
+    return not _is_loaded and _load_lock.locked()
+
+def is_warm() -> bool:
+    return _is_warm
+
+# Priority between the two: bulk batches wait while interactive work is in flight
+_interactive_in_flight = 0
+_interactive_cond = threading.Condition()
+_bulk_pauses = 0
+
+@contextmanager
+def interactive():
+    """Marks latency-sensitive work (a search request); bulk encoding yields until it finishes."""
+    global _interactive_in_flight
+    with _interactive_cond:
+        _interactive_in_flight += 1
+    try:
+        yield
+    finally:
+        with _interactive_cond:
+            _interactive_in_flight -= 1
+            if _interactive_in_flight == 0:
+                _interactive_cond.notify_all()
+
+def yield_to_interactive(max_pause: float = BULK_MAX_PAUSE):
+    """Called by bulk work between batches: waits (at most max_pause seconds) while queries are in flight."""
+    global _bulk_pauses
+    if not _interactive_in_flight:
+        return
+    with _interactive_cond:
+        if _interactive_in_flight:
+            _bulk_pauses += 1
+            deadline = time.monotonic() + max_pause
+            while _interactive_in_flight and time.monotonic() < deadline:
+                _interactive_cond.wait(deadline - time.monotonic())
+
+def scheduler_stats() -> dict:
+    return {
+        "interactive_threads": INTERACTIVE_THREADS,
+        "bulk_threads": BULK_THREADS,
+        "interactive_in_flight": _interactive_in_flight,
+        "bulk_pauses": _bulk_pauses,
+    }
+
+# Inputs are padded to the longest row of each batch, so rows of similar length
+# are grouped together to keep padding waste low
+ENCODE_BATCH_SIZE = int(os.getenv("SPLADE_BATCH_SIZE", "32"))
+
+# Whether the ONNX graph emits outputs that can be split per batch row.
+# None until the first multi-row run has been inspected.
+_supports_batching = None
+
+def _sparsify(indices: np.ndarray, weights: np.ndarray, threshold: float, top_k: int) -> dict[int, float]:
     # Filter by weight threshold
     mask = weights > threshold
     filtered_indices = indices[mask]
@@ -62,78 +192,261 @@ def encode(text: str, threshold: float = 0.05, top_k: int = 150) -> dict[int, fl
     # Return as {index: weight}
     return {int(idx): float(w) for idx, w in zip(final_indices, final_weights)}
 
-def chunk_text(text: str, chunk_size: int = 256, overlap: int = 32, max_chunks: int = 1000) -> list[str]:
+def _build_feed(ids_rows: list[list[int]], mask_rows: list[list[int]], type_rows: list[list[int]]) -> dict[str, np.ndarray]:
+    """Right-pads the token rows of one batch and builds the ONNX feed dict."""
+    max_len = max(len(r) for r in ids_rows)
+    input_ids = np.zeros((len(ids_rows), max_len), dtype=np.int64)
+    attention_mask = np.zeros((len(ids_rows), max_len), dtype=np.int64)
+    token_type_ids = np.zeros((len(ids_rows), max_len), dtype=np.int64)
+    for row, (ids, mask, types) in enumerate(zip(ids_rows, mask_rows, type_rows)):
+        input_ids[row, :len(ids)] = ids
+        attention_mask[row, :len(mask)] = mask
+        token_type_ids[row, :len(types)] = types
+
+    # Dynamically build feed dict based on ONNX inputs
+    feed_dict = {}
+    if "input_ids" in input_names:
+        feed_dict["input_ids"] = input_ids
+    if "attention_mask" in input_names:
+        feed_dict["attention_mask"] = attention_mask
+    if "token_type_ids" in input_names:
+        feed_dict["token_type_ids"] = token_type_ids
+    return feed_dict
+
+def _split_rows(outputs: list, num_rows: int):
+    """
+    Splits the sparse ONNX outputs of a batched run into per-row (indices, weights).
+    Returns None if the output layout does not identify the batch row of each entry.
+    """
+    indices = np.asarray(outputs[0])
+    weights = np.asarray(outputs[1])
+    if num_rows == 1 and indices.ndim == 1:
+        return [(indices, weights)]
+
+    # Coordinate layout: indices is (nnz, 2) holding [row, token_id]
+    if indices.ndim == 2 and indices.shape[1] == 2 and weights.ndim == 1:
+        rows = indices[:, 0]
+        return [(indices[rows == r, 1], weights[rows == r]) for r in range(num_rows)]
+
+    # Padded layout: one (indices, weights) row per batch entry
+    if indices.ndim == 2 and indices.shape[0] == num_rows and weights.shape == indices.shape:
+        return [(indices[r], weights[r]) for r in range(num_rows)]
+
+    return None
+
+def _encode_token_rows(ids_rows: list[list[int]], mask_rows: list[list[int]], type_rows: list[list[int]],
+                       threshold: float, top_k: int, batch_size: int, bulk: bool = False) -> list[dict[int, float]]:
+    """
+    Runs pre-tokenized rows through an ONNX session in length-bucketed batches.
+    Bulk work uses the bulk session and yields to in-flight queries before every batch.
+    """
+    load()
+    global _supports_batching
+    results: list[dict[int, float]] = [{} for _ in ids_rows]
+
+    # Sort by token length so each batch pads to a similar length
+    order = sorted(range(len(ids_rows)), key=lambda i: len(ids_rows[i]))
+    if _supports_batching is False:
+        batch_size = 1
+
+    pos = 0
+    while pos < len(order):
+        batch = order[pos:pos + batch_size]
+        feed_dict = _build_feed(
+            [ids_rows[i] for i in batch],
+            [mask_rows[i] for i in batch],
+            [type_rows[i] for i in batch],
+        )
+        if bulk:
+            yield_to_interactive()
+        outputs = (bulk_session if bulk else session).run(None, feed_dict)
+        rows = _split_rows(outputs, len(batch))
+        if rows is None:
+            # The graph flattens the batch; fall back to one row per run from here on
+            print("SPLADE ONNX outputs cannot be split per row, disabling batched inference.", file=sys.stderr)
+            _supports_batching = False
+            batch_size = 1
+            continue
+        if len(batch) > 1:
+            _supports_batching = True
+
+        for i, (indices, weights) in zip(batch, rows):
+            results[i] = _sparsify(indices, weights, threshold, top_k)
+        pos += len(batch)
+
+    return results
+
+def encode(text: str, threshold: float = 0.05, top_k: int = 150) -> dict[int, float]:
     if not text.strip():
+        return {}
+    load()
+
+    # Tokenize input
+    encoding = tokenizer.encode(text)
+    return _encode_token_rows(
+        [encoding.ids], [encoding.attention_mask], [encoding.type_ids], threshold, top_k, 1
+    )[0]
+
+def encode_batch(texts: list[str], threshold: float = 0.05, top_k: int = 150,
+                 batch_size: int = ENCODE_BATCH_SIZE) -> list[dict[int, float]]:
+    """
+    Encodes many texts with batched ONNX inference.
+    Returns one sparse vector per input text, in input order, with the same
+    threshold/top_k semantics as encode(). Blank texts map to {}.
+    """
+    results: list[dict[int, float]] = [{} for _ in texts]
+    non_empty = [i for i, t in enumerate(texts) if t.strip()]
+    if not non_empty:
+        return results
+    load()
+
+    encodings = tokenizer.encode_batch([texts[i] for i in non_empty])
+    vectors = _encode_token_rows(
+        [e.ids for e in encodings],
+        [e.attention_mask for e in encodings],
+        [e.type_ids for e in encodings],
+        threshold, top_k, batch_size,
+    )
+    for i, vec in zip(non_empty, vectors):
+        results[i] = vec
+    return results
+
+# Strongest terms kept per single-token expansion (used to encode names without a full forward pass)
+TOKEN_EXPANSION_TOP_K = 64
+
+def name_token_ids(name: str) -> list[int]:
+    """Tokenizes a file or directory name without special tokens."""
+    load()
+    return chunk_tokenizer.encode(name, add_special_tokens=False).ids
+
+def encode_token_expansions(token_ids: list[int], top_k: int = TOKEN_EXPANSION_TOP_K,
+                            batch_size: int = ENCODE_BATCH_SIZE) -> list[dict[int, float]]:
+    """
+    Runs each vocabulary token alone ([CLS] token [SEP]) through the model and returns
+    its term expansion. Rows are 3 tokens long, so this is far cheaper than encoding texts.
+    """
+    if not token_ids:
         return []
-        
+    load()
+    rows = [[CLS_ID, t, SEP_ID] for t in token_ids]
+    return _encode_token_rows(rows, [[1, 1, 1]] * len(rows), [[0, 0, 0]] * len(rows), 0.0, top_k, batch_size, bulk=True)
+
+def max_pool(vectors: list[dict[int, float]], threshold: float = 0.05, top_k: int = 150) -> dict[int, float]:
+    """
+    Max-pools sparse vectors per term (the pooling SPLADE applies over token positions), then
+    applies threshold/top_k. Used to approximate a name from its token expansions and to build
+    document-level vectors from chunk vectors.
+    """
+    pooled: dict[int, float] = {}
+    for vector in vectors:
+        for idx, w in vector.items():
+            if w > pooled.get(idx, 0.0):
+                pooled[idx] = w
+    if not pooled:
+        return {}
+    indices = np.fromiter(pooled.keys(), dtype=np.int64, count=len(pooled))
+    weights = np.fromiter(pooled.values(), dtype=np.float32, count=len(pooled))
+    return _sparsify(indices, weights, threshold, top_k)
+
+@dataclass
+class TokenWindow:
+    """A chunk of text together with the model-ready token ids it was cut from."""
+    text: str
+    ids: list[int]
+    attention_mask: list[int]
+    span: tuple[int, int]  # (start_char, end_char) of the chunk in the source text
+
+def _windows_from_encoding(text: str, ids: list[int], offsets: list[tuple[int, int]], base_offset: int,
+                           chunk_size: int, overlap: int, max_windows: int,
+                           stop_char: int | None = None) -> list[TokenWindow]:
+    """
+    Slides a chunk_size window over already-tokenized text (no special tokens).
+    Windows starting at or after stop_char are left to the next block.
+    """
+    windows = []
+    step = chunk_size - overlap
+    for i in range(0, len(ids), step):
+        if len(windows) >= max_windows:
+            break
+        chunk_offsets = offsets[i:i + chunk_size]
+        if not chunk_offsets:
+            continue
+        non_zero_offsets = [off for off in chunk_offsets if off != (0, 0)]
+        if not non_zero_offsets:
+            continue
+        start_char = non_zero_offsets[0][0]
+        end_char = non_zero_offsets[-1][1]
+
+        # Avoid duplicating chunks from the overlap region
+        if stop_char is not None and start_char >= stop_char:
+            break
+
+        window_ids = [CLS_ID] + ids[i:i + chunk_size] + [SEP_ID]
+        windows.append(TokenWindow(
+            text=text[start_char:end_char],
+            ids=window_ids,
+            attention_mask=[1] * len(window_ids),
+            span=(base_offset + start_char, base_offset + end_char),
+        ))
+        if i + chunk_size >= len(ids):
+            break
+    return windows
+
+def chunk_windows(text: str, chunk_size: int = 256, overlap: int = 32, max_chunks: int = 1000) -> list[TokenWindow]:
+    """
+    Splits text into overlapping token windows.
+    Each window carries the token ids used to cut it, so it can be passed to
+    encode_windows() without tokenizing the chunk text a second time.
+    """
+    if not text.strip():
+        return []
+    load()
+
     # Process text in character blocks to avoid tokenizer OOM on huge files
     SAFE_CHAR_BLOCK = 50000 
     char_overlap = 1000
     
-    chunks = []
-    
     # If it's small, fast path without block logic
     if len(text) <= SAFE_CHAR_BLOCK:
-        encoding = tokenizer.encode(text)
-        tokens = encoding.tokens
-        if len(tokens) <= chunk_size:
-            return [text]
-            
-        offsets = encoding.offsets
-        step = chunk_size - overlap
-        for i in range(0, len(tokens), step):
-            if len(chunks) >= max_chunks:
-                break
-            chunk_offsets = offsets[i:i + chunk_size]
-            if not chunk_offsets:
-                continue
-            non_zero_offsets = [off for off in chunk_offsets if off != (0, 0)]
-            if not non_zero_offsets:
-                continue
-            start_char = non_zero_offsets[0][0]
-            end_char = non_zero_offsets[-1][1]
-            chunks.append(text[start_char:end_char])
-            if i + chunk_size >= len(tokens):
-                break
-        return chunks
+        encoding = chunk_tokenizer.encode(text, add_special_tokens=False)
+        if len(encoding.ids) <= chunk_size:
+            ids = [CLS_ID] + encoding.ids + [SEP_ID]
+            return [TokenWindow(text=text, ids=ids, attention_mask=[1] * len(ids), span=(0, len(text)))]
+        return _windows_from_encoding(text, encoding.ids, encoding.offsets, 0, chunk_size, overlap, max_chunks)
 
     # Block-wise processing for large files
+    windows = []
     char_step = SAFE_CHAR_BLOCK - char_overlap
     for char_idx in range(0, len(text), char_step):
-        if len(chunks) >= max_chunks:
+        if len(windows) >= max_chunks:
             break
             
         text_block = text[char_idx:char_idx + SAFE_CHAR_BLOCK]
-        encoding = tokenizer.encode(text_block)
-        tokens = encoding.tokens
-        offsets = encoding.offsets
-        
-        step = chunk_size - overlap
-        for i in range(0, len(tokens), step):
-            if len(chunks) >= max_chunks:
-                break
-            
-            chunk_offsets = offsets[i:i + chunk_size]
-            if not chunk_offsets:
-                continue
-                
-            non_zero_offsets = [off for off in chunk_offsets if off != (0, 0)]
-            if not non_zero_offsets:
-                continue
-                
-            start_char = non_zero_offsets[0][0]
-            end_char = non_zero_offsets[-1][1]
-            
-            # Avoid duplicating chunks from the overlap region
-            if start_char >= char_step and char_idx + SAFE_CHAR_BLOCK < len(text):
-                break
-                
-            chunks.append(text_block[start_char:end_char])
-            
-            if i + chunk_size >= len(tokens):
-                break
+        encoding = chunk_tokenizer.encode(text_block, add_special_tokens=False)
+        is_last_block = char_idx + SAFE_CHAR_BLOCK >= len(text)
+        windows.extend(_windows_from_encoding(
+            text_block, encoding.ids, encoding.offsets, char_idx, chunk_size, overlap,
+            max_chunks - len(windows), stop_char=None if is_last_block else char_step,
+        ))
+        if is_last_block:
+            break
                 
-    return chunks
+    return windows
+
+def chunk_text(text: str, chunk_size: int = 256, overlap: int = 32, max_chunks: int = 1000) -> list[str]:
+    return [w.text for w in chunk_windows(text, chunk_size, overlap, max_chunks)]
+
+def encode_windows(windows: list[TokenWindow], threshold: float = 0.05, top_k: int = 150,
+                   batch_size: int = ENCODE_BATCH_SIZE) -> list[dict[int, float]]:
+    """Encodes token windows from chunk_windows() directly, skipping re-tokenization (bulk ingestion path)."""
+    if not windows:
+        return []
+    return _encode_token_rows(
+        [w.ids for w in windows],
+        [w.attention_mask for w in windows],
+        [[0] * len(w.ids) for w in windows],
+        threshold, top_k, batch_size, bulk=True,
+    )
 
 if __name__ == "__main__":
     print("Testing SPLADE encoding...")
@@ -148,6 +461,15 @@ if __name__ == "__main__":
     for idx, w in sorted_vec:
         print(f"  {inv_vocab.get(idx, f'#{idx}')}: {w:.4f}")
 
+    print("\nTesting encode_batch...")
+    batch_vectors = encode_batch([test_text, "", "local semantic file search"])
+    print(f"Batch sizes: {[len(v) for v in batch_vectors]}, matches single encode: {batch_vectors[0].keys() == vectors.keys()}")
+
+    print("\nTesting chunk_windows + encode_windows...")
+    windows = chunk_windows(" ".join(["search"] * 600))
+    window_vectors = encode_windows(windows)
+    print(f"{len(windows)} windows, spans: {[w.span for w in windows]}, vector sizes: {[len(v) for v in window_vectors]}")
+
     print("\nTesting chunk_text...")
     long_text = " ".join(["word"] * 500)
     text_chunks = chunk_text(long_text, chunk_size=100, overlap=10)
@@ -1,8 +1,10 @@
-import { useState, useEffect } from 'react';
+import { useState, useEffect, useRef } from 'react';
 import axios from 'axios';
 
 export const SEARCH_ENDPOINT = 'http://localhost:8000';
 const URL = `${SEARCH_ENDPOINT}/search`;
+const WS_URL = `${SEARCH_ENDPOINT.replace(/^http/, 'ws')}/ws/search`;
+const RECONNECT_DELAY = 1000;
 
 export interface SearchResult {
   id: string;
@@ -18,14 +20,55 @@ export interface SearchResult {
   metadata?: Record<string, any>;
 }
 
-export function useSearch(query: string, debounceTime = 500) {
+// The backend drops superseded queries, so a short debounce only coalesces bursts of keystrokes
+export function useSearch(query: string, debounceTime = 80) {
   const [results, setResults] = useState<SearchResult[]>([]);  // Holds the search results
   const [loading, setLoading] = useState(false);  // Indicates if a search is in progress
 
+  const socketRef = useRef<WebSocket | null>(null);
+  const seqRef = useRef(0);  // Sequence number of the newest query sent
+  const sessionRef = useRef(Math.random().toString(36).slice(2));  // Session id for HTTP fallback
+
+  // Keep one persistent search connection, reconnecting if the backend restarts
+  useEffect(() => {
+    let closed = false;
+    let reconnectTimeout: ReturnType<typeof setTimeout> | undefined;
+
+    const connect = () => {
+      const socket = new WebSocket(WS_URL);
+      socket.onmessage = (event) => {
+        const data = JSON.parse(event.data);
+        // Ignore responses to queries the user has already typed past
+        if (data.seq !== seqRef.current) return;
+        if (data.error) {
+          console.error(data.error);
+        } else {
+          setResults(data.results || []);
+        }
+        // Filename matches arrive first; keep loading until the merged results replace them
+        if (!data.partial) setLoading(false);
+      };
+      socket.onclose = () => {
+        if (socketRef.current === socket) socketRef.current = null;
+        if (!closed) reconnectTimeout = setTimeout(connect, RECONNECT_DELAY);
+      };
+      socketRef.current = socket;
+    };
+    connect();
+
+    return () => {
+      closed = true;
+      clearTimeout(reconnectTimeout);
+      socketRef.current?.close();
+    };
+  }, []);
+
   useEffect(() => {
     // If the query is empty, don't trigger search
     if (!query) {
+      seqRef.current += 1;  // Invalidate responses still in flight
       setResults([]);
+      setLoading(false);
       return;
     }
 
@@ -39,16 +82,25 @@ export function useSearch(query: string, debounceTime = 500) {
   }, [query, debounceTime]);
 
   const search = async (query: string) => {
-    try {
-      setLoading(true);
+    const seq = ++seqRef.current;
+    setLoading(true);
 
-      const response = await axios.post(URL, { query });
-      setResults(response.data.results || []);
+    const socket = socketRef.current;
+    if (socket && socket.readyState === WebSocket.OPEN) {
+      socket.send(JSON.stringify({ query, seq }));
+      return;
+    }
 
+    // No live connection: fall back to HTTP, still letting the backend drop superseded queries.
+    // While the model is loading or the backend is busy it answers with filename matches only (partial)
+    try {
+      const response = await axios.post(URL, { query, session_id: sessionRef.current, seq });
+      if (seq !== seqRef.current || response.data.superseded) return;
+      setResults(response.data.results || []);
     } catch (err) {
       console.error(err);
     } finally {
-      setLoading(false);
+      if (seq === seqRef.current) setLoading(false);
     }
   };
 
@@ -56,4 +108,4 @@ export function useSearch(query: string, debounceTime = 500) {
     results,
     loading,
   };
-}
\ No newline at end of file
+}
@@ -1,5 +1,6 @@
 import os
 import sys
+import hashlib
 
 PRUNE_DIR_NAMES = {
     # Dependency & Compiler Build Folders
@@ -111,3 +112,36 @@ def walk(root: str, ignore_dir: tuple[str, ...]) -> list[str]:
             children.append(os.path.join(dirpath, filename))
             
     return children
+
+_FINGERPRINT_READ_SIZE = 1024 * 1024
+
+def file_fingerprint(filepath: str, size: int | None = None) -> str:
+    """Return a content fingerprint "<size>-<blake2b hex>" computed by streaming the file."""
+    if size is None:
+        size = os.path.getsize(filepath)
+    h = hashlib.blake2b(digest_size=16)
+    with open(filepath, "rb") as f:
+        while True:
+            block = f.read(_FINGERPRINT_READ_SIZE)
+            if not block:
+                break
+            h.update(block)
+    return f"{size}-{h.hexdigest()}"
+
+def stat_fingerprint(stats: os.stat_result) -> str:
+    """Return a metadata fingerprint "<size>-mtime-<mtime ns>" for files indexed by name only (no hashing)."""
+    return f"{stats.st_size}-mtime-{stats.st_mtime_ns}"
+
+def fingerprint_matches(filepath: str, fingerprint: str | None) -> bool:
+    """Check a file against a stored fingerprint, comparing sizes before hashing any bytes."""
+    if not fingerprint:
+        return False
+    try:
+        stats = os.stat(filepath)
+        if fingerprint.split("-", 1)[0] != str(stats.st_size):
+            return False
+        if "-mtime-" in fingerprint:
+            return stat_fingerprint(stats) == fingerprint
+        return file_fingerprint(filepath, stats.st_size) == fingerprint
+    except OSError:
+        return False
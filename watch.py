@@ -12,9 +12,10 @@ import threading
 
 import parsers
 import local_db
+import ingest
 from datetime import datetime
 from path_env import HOME_DIRECTORY, IGNORE_DIR, TRASH_DIR
-from util import is_hidden, walk
+from util import is_hidden, walk, fingerprint_matches
 
 _sync_in_progress = True
 
@@ -134,29 +135,10 @@ class FileEventHandler(FileSystemEventHandler):
         print("dir_moved_to", dir_moved_to)
         print("dir_deleted", dir_deleted)
 
-        # when a dir is moved or deleted, the files inside should be checked too
+        # moves are applied in place (payload rewrite, no re-encoding) when the source is indexed
         to_upsert = files_upsert | dir_upsert
         to_delete = files_deleted | dir_deleted
-        for src, dest in dir_moved_from.items():
-            to_delete.add(src)
-            to_upsert.add(dest)
-            children_list = walk(dest, self.paths_to_ignore)
-            children = []
-            for child in children_list:
-                child_abs = os.path.abspath(child)
-                if not os.path.isdir(child_abs):
-                    _, ext = os.path.splitext(child_abs)
-                    if ext and parsers.is_junk_ext(ext.lower()):
-                        continue
-                children.append(child_abs)
-            to_upsert.update(children)
-            # since the children is full path, need to get src + relative path
-            to_delete.update(map(lambda child: src + child[len(dest) :], children))
-
-        # handle single file moves and renames
-        for src, dest in files_moved_from.items():
-            to_delete.add(src)
-            to_upsert.add(dest)
+        to_move = list(dir_moved_from.items()) + list(files_moved_from.items())
 
         # Merge in previously deferred unstable paths for retry
         if self._deferred:
@@ -165,6 +147,7 @@ class FileEventHandler(FileSystemEventHandler):
 
         print("to_upsert", to_upsert)
         print("to_delete", to_delete)
+        print("to_move", to_move)
 
         # after all the processing
         # the to_upsert and to_delete still doesn't necessarily is 100% correct
@@ -181,6 +164,26 @@ class FileEventHandler(FileSystemEventHandler):
             except Exception as e:
                 print(f"ERROR: failed to delete {p} from Qdrant: {e}", file=sys.stderr)
 
+        # Process moves and renames
+        for src, dest in to_move:
+            try:
+                moved = local_db.move_path(src, dest)
+            except Exception as e:
+                print(f"ERROR: failed to move {src} to {dest} in Qdrant: {e}", file=sys.stderr)
+                moved = None
+            if moved is None:
+                # source was not indexed (or the move failed): index the destination from scratch
+                try:
+                    local_db.delete_path(src)
+                except Exception as e:
+                    print(f"ERROR: failed to delete {src} from Qdrant: {e}", file=sys.stderr)
+                to_upsert.add(dest)
+                if os.path.isdir(dest):
+                    to_upsert.update(self._walk_children(dest))
+            elif moved:
+                # the name is the indexed content (directories, metadata-only files)
+                to_upsert.add(dest)
+
         # Process upserts (with file stability check to avoid indexing mid-write)
         for p in to_upsert:
             try:
@@ -190,6 +193,11 @@ class FileEventHandler(FileSystemEventHandler):
                 if not os.path.isdir(p) and not is_file_stable(p):
                     self._deferred.add(p)
                     continue
+                # Touched but unchanged bytes: only refresh the modification time
+                if not os.path.isdir(p) and fingerprint_matches(p, local_db.get_fingerprint(p)):
+                    mtime = datetime.fromtimestamp(os.path.getmtime(p)).isoformat()
+                    local_db.refresh_updated_at(p, mtime)
+                    continue
                 doc = parsers.parse_file(p)
                 if doc is None:
                     continue  # Junk file, skip
@@ -197,6 +205,17 @@ class FileEventHandler(FileSystemEventHandler):
             except Exception as e:
                 print(f"ERROR: failed to index {p} in Qdrant: {e}", file=sys.stderr)
 
+    def _walk_children(self, directory: str) -> list[str]:
+        children = []
+        for child in walk(directory, self.paths_to_ignore):
+            child_abs = os.path.abspath(child)
+            if not os.path.isdir(child_abs):
+                _, ext = os.path.splitext(child_abs)
+                if ext and parsers.is_junk_ext(ext.lower()):
+                    continue
+            children.append(child_abs)
+        return children
+
     def on_any_event(self, event):
         if event.is_synthetic:
             return
@@ -243,40 +262,13 @@ def sync_directory(watch_dir: str, stop_event: threading.Event | None = None):
             disk_paths.add(p_abs)
         print(f"Sync: Found {len(disk_paths)} valid files/folders on disk.")
 
-        # Track database path info: path -> { updated_at, actual_chunks_found, expected_total_chunks }
+        # Indexed files from the local manifest: path -> { updated_at, total_chunks, fingerprint }
+        # Only completely indexed files are listed, so interrupted ones are re-indexed below
         db_paths = {}
         try:
-            offset = None
-            while True:
-                records, offset = local_db.client.scroll(
-                    collection_name=local_db.COLLECTION_NAME,
-                    limit=5000,
-                    with_payload=["path", "updated_at", "total_chunks"],
-                    with_vectors=False,
-                    offset=offset
-                )
-                for r in records:
-                    p = r.payload.get("path")
-                    updated_at = r.payload.get("updated_at")
-                    expected_total = r.payload.get("total_chunks", 1)  # Default to 1 if not set yet
-                    if p:
-                        p_abs = os.path.abspath(p)
-                        if p_abs not in db_paths:
-                            db_paths[p_abs] = {
-                                "updated_at": updated_at,
-                                "actual_chunks": 1,
-                                "expected_total": expected_total
-                            }
-                        else:
-                            db_paths[p_abs]["actual_chunks"] += 1
-                            if updated_at > db_paths[p_abs]["updated_at"]:
-                                db_paths[p_abs]["updated_at"] = updated_at
-                            if expected_total > db_paths[p_abs]["expected_total"]:
-                                db_paths[p_abs]["expected_total"] = expected_total
-                if offset is None:
-                    break
+            db_paths = local_db.load_manifest()
         except Exception as e:
-            print(f"Sync Error scrolling db paths: {e}", file=sys.stderr)
+            print(f"Sync Error loading manifest: {e}", file=sys.stderr)
 
         stale_candidates = set(db_paths.keys()) - disk_paths
         # Only delete entries for files confirmed gone from disk.
@@ -295,41 +287,39 @@ def sync_directory(watch_dir: str, stop_event: threading.Event | None = None):
                     print(f"Sync Error deleting {p}: {e}", file=sys.stderr)
 
         to_ingest = []
+        to_refresh = []
         for p in disk_paths:
             if not os.path.exists(p):
                 continue
             stats = os.stat(p)
             mtime = datetime.fromtimestamp(stats.st_mtime).isoformat()
             
-            is_incomplete = False
-            if p in db_paths:
-                info = db_paths[p]
-                is_incomplete = info["actual_chunks"] < info["expected_total"]
-                
             is_dir = os.path.isdir(p)
             # Re-index if:
-            # 1. Path is not in the database.
-            # 2. Disk file is newer than database record (files only).
-            # 3. Database is missing chunks (indexing was interrupted/aborted).
-            if p not in db_paths or (not is_dir and mtime > db_paths[p]["updated_at"]) or is_incomplete:
+            # 1. Path is not in the manifest (new, or indexing was interrupted/aborted).
+            # 2. Disk file is newer than database record and its content changed (files only).
+            if p not in db_paths:
                 to_ingest.append(p)
+            elif not is_dir and mtime > db_paths[p]["updated_at"]:
+                # Newer mtime but identical bytes (touch, git checkout, restores):
+                # refresh the timestamp instead of re-parsing and re-encoding
+                if fingerprint_matches(p, db_paths[p]["fingerprint"]):
+                    to_refresh.append((p, mtime))
+                else:
+                    to_ingest.append(p)
+
+        if to_refresh:
+            print(f"Sync: Refreshing timestamps of {len(to_refresh)} touched but unchanged files...")
+            for p, mtime in to_refresh:
+                try:
+                    local_db.refresh_updated_at(p, mtime)
+                except Exception as e:
+                    print(f"Sync Error refreshing {p}: {e}", file=sys.stderr)
 
         if to_ingest:
             print(f"Sync: Indexing {len(to_ingest)} new or modified files/folders...")
-            for idx, p in enumerate(to_ingest):
-                if stop_event and stop_event.is_set():
-                    print("Sync: Interrupted by shutdown signal.")
-                    break
-                try:
-                    doc = parsers.parse_file(p)
-                    if doc is None:
-                        continue  # Junk file, skip
-                    local_db.upsert_document(doc)
-                    if (idx + 1) % 50 == 0:
-                        print(f"  Indexed {idx + 1}/{len(to_ingest)} items...")
-                except Exception as e:
-                    print(f"Sync Error indexing {p}: {e}", file=sys.stderr)
-                time.sleep(0.002)
+            indexed = ingest.run(to_ingest, stop_event)
+            print(f"Sync: Indexed {indexed}/{len(to_ingest)} items.")
 
         print("Sync: Startup synchronization completed successfully!")
     except Exception as e: